@@ -1,32 +1,49 @@
 import os
 from datetime import datetime
-from importlib.metadata import version, PackageNotFoundError, metadata
-import re
 import sys
 import signal
 
 __package__ = "lyroi"
 creation_date = datetime(2025, 11, 26)
 
-try:
-    __version__ = version(__package__)
-except PackageNotFoundError:
-    __version__ = "0.0.0"
-
-meta = metadata(__package__)
-email_list = meta.get("Author-email", "")
-author_str = re.sub(r"<[^>]*>", "", email_list).strip()
-now_date = datetime.now()
-date_str = now_date.strftime("%Y") if creation_date.year == now_date.year else creation_date.strftime("%Y") + "-" + now_date.strftime("%Y")
-__copyright__ = "Copyright (c) " + date_str + " " + author_str + ", www.hzdr.de"
-__license__ = meta.get("License-Expression")
-
-__legal__ = ("Disclaimer:\n"
-            "This software is intended for research use only.\n"
-            "It is not a medical device and must not be used for clinical decisions.\n\n"
-            f"{__package__} {__version__}\n"
-            f"{__copyright__}\n"
-            f"License: {__license__}; models are licensed separately")
+# version, copyright and license come from the package metadata. importlib.metadata is slow to import, so they are
+# only looked up on first access (PEP 562), e.g. when the help of an entry point is shown
+_metadata = {}
+
+def _load_metadata():
+    from importlib.metadata import version, PackageNotFoundError, metadata
+    import re
+
+    try:
+        package_version = version(__package__)
+    except PackageNotFoundError:
+        package_version = "0.0.0"
+    meta = metadata(__package__)
+    email_list = meta.get("Author-email", "")
+    author_str = re.sub(r"<[^>]*>", "", email_list).strip()
+    now_date = datetime.now()
+    date_str = now_date.strftime("%Y") if creation_date.year == now_date.year else \
+        creation_date.strftime("%Y") + "-" + now_date.strftime("%Y")
+    copyright_str = "Copyright (c) " + date_str + " " + author_str + ", www.hzdr.de"
+    license_str = meta.get("License-Expression")
+    return {
+        "__version__": package_version,
+        "__copyright__": copyright_str,
+        "__license__": license_str,
+        "__legal__": ("Disclaimer:\n"
+                      "This software is intended for research use only.\n"
+                      "It is not a medical device and must not be used for clinical decisions.\n\n"
+                      f"{__package__} {package_version}\n"
+                      f"{copyright_str}\n"
+                      f"License: {license_str}; models are licensed separately"),
+    }
+
+def __getattr__(name):
+    if name in ("__version__", "__copyright__", "__license__", "__legal__"):
+        if not _metadata:
+            _metadata.update(_load_metadata())
+        return _metadata[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def error_handler(exctype, value, traceback):
   print()
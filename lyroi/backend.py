@@ -0,0 +1,182 @@
+import multiprocessing
+import sys
+from pathlib import Path
+
+# Persistent inference process for the GUI. The process keeps torch, nnU-Net and the networks of the selected mode
+# loaded, receives jobs over a pipe and sends back console output, progress events and the job status.
+#
+# Messages to the backend:   {"type": "preload", "mode": ..., "device": ...}
+#                            {"type": "predict", "input": [...], "output": ..., "mode": ..., "device": ...,
+#                             "preview": bool}
+#                            {"type": "shutdown"}
+# Messages from the backend: ("output", text), ("progress", jsonl line), ("preloaded", mode),
+#                            ("preload_failed", error), ("finished", status) with status "finished", "cancelled" or
+#                            "failed"
+
+
+class _ConnectionStream:
+    # file-like object that sends every line written to it through the pipe
+    def __init__(self, conn, kind):
+        self.conn = conn
+        self.kind = kind
+        self._buffer = ""
+
+    def write(self, text):
+        self._buffer += text
+        while "\n" in self._buffer:
+            line, self._buffer = self._buffer.split("\n", 1)
+            try:
+                self.conn.send((self.kind, line))
+            except (OSError, ValueError):
+                pass  # the GUI is gone
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def get_cli_device(device):
+    # the GUI device names use underscores (cpu_max), the command line ones dashes (cpu-max)
+    return device.replace("_", "-")
+
+def _serve(conn, cancel_event):
+    from lyroi.utils import setup_lyroi, check_model
+    setup_lyroi()
+    from lyroi.events import add_listener, remove_listener, set_cancel_check, Cancelled
+    from lyroi.inference import predict_from_folder, predict_from_files, preload_models
+    from lyroi.nnunet_interface import shutdown_worker_pools
+    from lyroi.progress import JsonlProgressWriter
+
+    sys.stdout = _ConnectionStream(conn, "output")
+    sys.stderr = sys.stdout
+
+    set_cancel_check(cancel_event.is_set)
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break  # the GUI is gone
+        if message["type"] == "shutdown":
+            break
+
+        mode, device = message["mode"], get_cli_device(message["device"])
+        if message["type"] == "preload":
+            try:
+                assert check_model(mode), ("The model for the selected mode is not installed or installation is "
+                                           "incomplete")
+                preload_models(mode, device)
+            except Exception as e:
+                conn.send(("preload_failed", str(e)))
+            else:
+                conn.send(("preloaded", mode))
+            continue
+
+        status = "finished"
+        try:
+            assert check_model(mode), "The model for the selected mode is not installed or installation is incomplete"
+            progress = JsonlProgressWriter(_ConnectionStream(conn, "progress"))
+            add_listener(progress)
+            try:
+                if len(message["input"]) == 1 and Path(message["input"][0]).is_dir():
+                    Path(message["output"]).mkdir(exist_ok=True, parents=True)
+                    predict_from_folder(message["input"][0], message["output"], mode, device, progress_bar=False,
+                                        preview=message.get("preview", False))
+                else:
+                    predict_from_files(message["input"], message["output"], mode, device, progress_bar=False,
+                                       preview=message.get("preview", False))
+            finally:
+                remove_listener(progress)
+        except Cancelled:
+            status = "cancelled"
+            # the workers may still preprocess or export cases of the cancelled job. The pools are drained and
+            # restarted by the next job
+            shutdown_worker_pools()
+        except Exception as e:
+            print("Error:", e)
+            status = "failed"
+        conn.send(("finished", status))
+
+    # the pools are not shut down at exit in a multiprocessing child
+    shutdown_worker_pools()
+
+
+class InferenceBackend:
+    def __init__(self):
+        self.process = None
+        self.conn = None
+        self.cancel_event = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def start(self):
+        if self.is_alive():
+            return
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.cancel_event = context.Event()
+        # not a daemon: daemonic processes cannot start the nnU-Net worker pools
+        self.process = context.Process(target=_serve, args=(child_conn, self.cancel_event), name="lyroi-backend")
+        self.process.start()
+        child_conn.close()
+
+    def preload(self, mode, device):
+        self.start()
+        self.conn.send({"type": "preload", "mode": mode, "device": device})
+
+    def submit(self, input_files, output, mode, device, preview=False):
+        self.start()
+        self.cancel_event.clear()
+        self.conn.send({"type": "predict", "input": [str(f) for f in input_files], "output": str(output),
+                        "mode": mode, "device": device, "preview": preview})
+
+    def receive(self, timeout=0.5):
+        # next message from the backend, None on timeout. A dead backend reports a failed job
+        if self.conn.poll(timeout):
+            try:
+                return self.conn.recv()
+            except EOFError:
+                pass
+        elif self.is_alive():
+            return None
+        self.stop()
+        return "finished", "failed"
+
+    def cancel(self):
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+
+    def stop(self, timeout=5):
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            try:
+                self.conn.send({"type": "shutdown"})
+            except (OSError, ValueError):
+                pass
+            self.process.join(timeout)
+        if self.process.is_alive():
+            self.kill()
+        self.process = None
+
+    def kill(self):
+        import psutil
+        if self.process is None:
+            return
+        # the worker pools of a job that does not react to the cancellation go down with the backend
+        try:
+            children = psutil.Process(self.process.pid).children(recursive=True)
+        except psutil.Error:
+            children = []
+        for process in children:
+            try:
+                process.kill()
+            except psutil.Error:
+                pass
+        self.process.kill()
+        self.process.join()
+        self.process = None
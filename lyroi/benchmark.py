@@ -0,0 +1,256 @@
+import json
+import platform
+import shutil
+import socket
+import statistics
+import sys
+import time
+from datetime import datetime
+from importlib.metadata import version, PackageNotFoundError
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+from lyroi import __version__
+from lyroi.modes import mode_list, get_folds, get_suffix_dict
+from lyroi.placement import describe_placement, get_core_count
+from lyroi.tuning import write_synthetic_cases
+from lyroi.utils import get_models_dir
+
+# nnU-Net default intensity statistics are replaced by plausible PET/CT values, the networks are not trained anyway
+INTENSITY_PROPERTIES = {
+    "CT": {"max": 1500.0, "mean": 40.0, "median": 40.0, "min": -1000.0, "percentile_00_5": -900.0,
+           "percentile_99_5": 1000.0, "std": 150.0},
+    "PET": {"max": 60.0, "mean": 4.0, "median": 3.0, "min": 0.0, "percentile_00_5": 0.0,
+            "percentile_99_5": 35.0, "std": 5.0},
+}
+
+
+def get_package_version(package):
+    try:
+        return version(package)
+    except PackageNotFoundError:
+        return None
+
+def get_architecture(plan, network="full"):
+    # approximation of the nnU-Net default (nnUNetPlans) and residual encoder (ResEnc M/L) 3d_fullres architectures.
+    # "small" keeps the topology but reduces the size, for quick runs on a laptop
+    residual = "ResEnc" in plan
+    if network == "small":
+        n_stages, features, patch_size = 4, [8, 16, 32, 64], [64, 64, 64]
+    else:
+        n_stages, features = 6, [32, 64, 128, 256, 320, 320]
+        patch_size = [160, 160, 160] if "ResEncUNetL" in plan else [128, 128, 128]
+    arch_kwargs = {
+        "n_stages": n_stages,
+        "features_per_stage": features,
+        "conv_op": "torch.nn.modules.conv.Conv3d",
+        "kernel_sizes": [[3, 3, 3]] * n_stages,
+        "strides": [[1, 1, 1]] + [[2, 2, 2]] * (n_stages - 1),
+        "conv_bias": True,
+        "norm_op": "torch.nn.modules.instancenorm.InstanceNorm3d",
+        "norm_op_kwargs": {"eps": 1e-05, "affine": True},
+        "dropout_op": None,
+        "dropout_op_kwargs": None,
+        "nonlin": "torch.nn.LeakyReLU",
+        "nonlin_kwargs": {"inplace": True},
+    }
+    if residual:
+        class_name = "dynamic_network_architectures.architectures.unet.ResidualEncoderUNet"
+        arch_kwargs["n_blocks_per_stage"] = [1, 3, 4, 6, 6, 6][:n_stages]
+        arch_kwargs["n_conv_per_stage_decoder"] = [1] * (n_stages - 1)
+    else:
+        class_name = "dynamic_network_architectures.architectures.unet.PlainConvUNet"
+        arch_kwargs["n_conv_per_stage"] = [2] * n_stages
+        arch_kwargs["n_conv_per_stage_decoder"] = [2] * (n_stages - 1)
+    architecture = {"network_class_name": class_name, "arch_kwargs": arch_kwargs,
+                    "_kw_requires_import": ["conv_op", "norm_op", "dropout_op", "nonlin"]}
+    return architecture, patch_size
+
+def get_plans(mode, plan, spacing, network="full"):
+    modalities = list(get_suffix_dict(mode).keys())
+    architecture, patch_size = get_architecture(plan, network)
+    resampling_kwargs = {"order_z": 0, "force_separate_z": None}
+    return {
+        "dataset_name": "Dataset001_LyROI",
+        "plans_name": plan,
+        "original_median_spacing_after_transp": list(spacing),
+        "original_median_shape_after_transp": [256, 192, 192],
+        "image_reader_writer": "SimpleITKIO",
+        "transpose_forward": [0, 1, 2],
+        "transpose_backward": [0, 1, 2],
+        "configurations": {
+            mode_list[mode].model_config: {
+                "data_identifier": plan + "_3d_fullres",
+                "preprocessor_name": "DefaultPreprocessor",
+                "batch_size": 2,
+                "patch_size": patch_size,
+                "median_image_size_in_voxels": [256, 192, 192],
+                "spacing": list(spacing),
+                "normalization_schemes": ["CTNormalization" if m == "CT" else "ZScoreNormalization"
+                                          for m in modalities],
+                "use_mask_for_norm": [False] * len(modalities),
+                "resampling_fn_data": "resample_data_or_seg_to_shape",
+                "resampling_fn_seg": "resample_data_or_seg_to_shape",
+                "resampling_fn_data_kwargs": {"is_seg": False, "order": 3, **resampling_kwargs},
+                "resampling_fn_seg_kwargs": {"is_seg": True, "order": 1, **resampling_kwargs},
+                "resampling_fn_probabilities": "resample_data_or_seg_to_shape",
+                "resampling_fn_probabilities_kwargs": {"is_seg": False, "order": 1, **resampling_kwargs},
+                "architecture": architecture,
+                "batch_dice": True,
+            }
+        },
+        "experiment_planner_used": "ExperimentPlanner",
+        "label_manager": "LabelManager",
+        "foreground_intensity_properties_per_channel": {str(i): INTENSITY_PROPERTIES[m]
+                                                        for i, m in enumerate(modalities)},
+    }
+
+def build_synthetic_models(mode, spacing=(3.0, 2.0, 2.0), network="full", seed=0):
+    # randomly initialized networks in the nnU-Net results tree, laid out like the installed LyROI models
+    import torch
+    from nnunetv2.utilities.get_network_from_plans import get_network_from_plans
+
+    torch.manual_seed(seed)
+    modalities = list(get_suffix_dict(mode).keys())
+    dataset = {"channel_names": {str(i): m for i, m in enumerate(modalities)},
+               "labels": {"background": 0, "lymphoma": 1},
+               "numTraining": 0,
+               "file_ending": ".nii.gz"}
+    for plan in mode_list[mode].model_plans:
+        # nnU-Net can only resolve the model folders once the dataset exists
+        folder = Path(get_models_dir(), "Dataset001_LyROI",
+                      "nnUNetTrainer__%s__%s" % (plan, mode_list[mode].model_config))
+        plans = get_plans(mode, plan, spacing, network)
+        architecture = plans["configurations"][mode_list[mode].model_config]["architecture"]
+        Path(folder).mkdir(exist_ok=True, parents=True)
+        Path(folder, "plans.json").write_text(json.dumps(plans, indent=2))
+        Path(folder, "dataset.json").write_text(json.dumps(dataset, indent=2))
+        Path(folder, "VERSION").write_text("synthetic")
+        for fold in get_folds(mode):
+            net = get_network_from_plans(architecture["network_class_name"], architecture["arch_kwargs"],
+                                         architecture["_kw_requires_import"], len(modalities),
+                                         len(dataset["labels"]), deep_supervision=False)
+            checkpoint = {"trainer_name": "nnUNetTrainer",
+                          "init_args": {"plans": plans, "configuration": mode_list[mode].model_config,
+                                        "fold": fold, "dataset_json": dataset},
+                          "inference_allowed_mirroring_axes": (0, 1, 2),
+                          "network_weights": net.state_dict()}
+            Path(folder, "fold_%s" % fold).mkdir(exist_ok=True)
+            torch.save(checkpoint, Path(folder, "fold_%s" % fold, "checkpoint_final.pth"))
+
+def write_synthetic_masks(folders, shape, n_cases, seed=0):
+    # binary masks as written by the submodels, slightly different per submodel
+    rng = np.random.default_rng(seed)
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    for i in range(n_cases):
+        centers = [[rng.integers(s // 4, 3 * s // 4) for s in shape] for _ in range(5)]
+        for folder in folders:
+            Path(folder).mkdir(exist_ok=True, parents=True)
+            mask = np.zeros(shape, dtype=bool)
+            for center in centers:
+                radius = rng.uniform(4, 10)
+                mask |= sum(((g - c) / radius) ** 2 for g, c in zip(grid, center)) < 1
+            nib.save(nib.Nifti1Image(mask.astype(np.uint8), np.eye(4)), Path(folder, "synthetic_%03d.nii.gz" % i))
+
+def get_environment():
+    environment = {
+        "lyroi_version": __version__,
+        "nnunetv2_version": get_package_version("nnunetv2"),
+        "torch_version": get_package_version("torch"),
+        "nibabel_version": nib.__version__,
+        "numpy_version": np.__version__,
+        "python_version": sys.version.split()[0],
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "host": socket.gethostname(),
+        "physical_cores": get_core_count(),
+        "cpu_placement": describe_placement(),
+    }
+    if "torch" in sys.modules:
+        # the micro benchmarks do not import torch
+        environment["torch_threads"] = sys.modules["torch"].get_num_threads()
+    return environment
+
+def summarize(times):
+    return {"times": [round(t, 6) for t in times],
+            "min": round(min(times), 6),
+            "median": round(statistics.median(times), 6),
+            "mean": round(statistics.mean(times), 6)}
+
+def is_regression(old, new, threshold=0.1, min_difference=0.001):
+    # differences below a millisecond are timer noise for the fastest micro benchmarks
+    return new > old * (1 + threshold) and new - old > min_difference
+
+def compare_results(baseline, current, threshold=0.1, metric="min"):
+    # returns (name, baseline time, current time) of all benchmarks that got slower by more than threshold
+    regressions = []
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        old, new = baseline["results"][name][metric], result[metric]
+        if is_regression(old, new, threshold):
+            regressions.append((name, old, new))
+    return regressions
+
+def print_comparison(baseline, current, threshold=0.1, metric="min"):
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            print(f"  {name}: {result[metric]:.4f} s (not in baseline)")
+            continue
+        old, new = baseline["results"][name][metric], result[metric]
+        change = (new - old) / old * 100 if old > 0 else 0
+        flag = " REGRESSION" if is_regression(old, new, threshold) else ""
+        print(f"  {name}: {old:.4f} s -> {new:.4f} s ({change:+.1f}%){flag}")
+    return compare_results(baseline, current, threshold, metric)
+
+def run_benchmarks(work_dir, mode="petct", shape=(192, 192, 256), spacing=(2.0, 2.0, 3.0), n_cases=3,
+                   n_folds=1, network="full", repeat=3, benchmarks=("predict_from_folder", "predict_from_files",
+                                                                      "merge_delineations")):
+    # runs on the cpu device. The nnU-Net results folder must point into work_dir (see bench_entrypoint)
+    from lyroi.inference import predict_from_folder, predict_from_files, merge_delineations
+
+    # fewer folds make the full pipeline affordable on a cpu. The mode is only used inside this process
+    mode_list[mode].folds = mode_list[mode].folds[:n_folds]
+    input_folder = Path(work_dir, "input")
+    output_folder = Path(work_dir, "output")
+
+    print(f"Building synthetic {network} models for mode {mode} ({n_folds} fold(s))")
+    build_synthetic_models(mode, spacing[::-1], network)  # plans list the spacing in the SimpleITK (z, y, x) order
+    print(f"Generating {n_cases} synthetic case(s) of shape {tuple(shape)}")
+    write_synthetic_cases(input_folder, mode, n_cases, shape, spacing)
+    n_plans = len(mode_list[mode].model_plans)
+    write_synthetic_masks([Path(work_dir, "masks", str(i)) for i in range(n_plans)], shape, n_cases)
+
+    suffixes = list(get_suffix_dict(mode).values())
+    case_files = [str(Path(input_folder, "synthetic_000" + suffix + ".nii.gz")) for suffix in suffixes]
+    mask_folders = [Path(work_dir, "masks", str(i)) for i in range(n_plans)]
+    runs = {
+        "predict_from_folder": lambda: predict_from_folder(input_folder, output_folder, mode, device="cpu",
+                                                           progress_bar=False),
+        "predict_from_files": lambda: predict_from_files(case_files, str(Path(output_folder, "single.nii.gz")),
+                                                         mode, device="cpu", progress_bar=False),
+        "merge_delineations": lambda: merge_delineations(mask_folders, output_folder),
+    }
+
+    results = {}
+    for name in benchmarks:
+        times = []
+        for i in range(repeat):
+            shutil.rmtree(output_folder, ignore_errors=True)
+            output_folder.mkdir(parents=True)
+            print(f"Running {name} ({i + 1}/{repeat})")
+            start_time = time.perf_counter()
+            runs[name]()
+            times.append(time.perf_counter() - start_time)
+        results[name] = summarize(times)
+
+    return {
+        "benchmark": "lyroi_bench",
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "environment": get_environment(),
+        "config": {"mode": mode, "device": "cpu", "shape": list(shape), "spacing": list(spacing),
+                   "cases": n_cases, "folds": n_folds, "network": network, "repeat": repeat},
+        "results": results,
+    }
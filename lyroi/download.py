@@ -0,0 +1,308 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import requests
+from tqdm import tqdm
+
+from lyroi.modes import get_archive_names, get_model_folders
+from lyroi.repository import get_session, get_file_sizes, TIMEOUT
+from lyroi.utils import (get_lyroi_dir, get_models_dir, get_system_models_dir, get_repository_url, format_file_size,
+                         write_manifest, get_pointer_path, get_manifest_path, wait_for_lock, release_lock)
+
+# Model archives can be installed from the online repository, from a mirror with the same file layout (archives,
+# VERSION and optionally checksums.json next to each other) or from a local folder with these files, e.g. a shared store
+# on a cluster populated with lyroi_install --download-to
+CHUNK_SIZE = 1 << 20
+CHECKSUM_FILE = "checksums.json"
+# how long to wait for another installation of the same mode, e.g., on another host whose process cannot be checked
+INSTALL_LOCK_TIMEOUT = 2 * 3600
+
+
+def get_download_dir():
+    return str(Path(get_lyroi_dir(), "downloads"))
+
+def is_local(source):
+    return not str(source).startswith(("http://", "https://"))
+
+def get_source(from_dir=None, mirror=None):
+    # base location of the archives. Returns the base and the repository record URL (None for mirrors and folders)
+    if from_dir is not None:
+        assert Path(from_dir).is_dir(), f"Directory {from_dir} does not exist"
+        return str(Path(from_dir).absolute()), None
+    if mirror is not None:
+        return mirror.rstrip("/"), None
+    repository_url = get_repository_url(refresh=True)  # never install an outdated version from the cache
+    return repository_url + "/files", repository_url
+
+def read_source_file(source, name, session):
+    if is_local(source):
+        return Path(source, name).read_text()
+    r = session.get(source + "/" + name, timeout=TIMEOUT)
+    r.raise_for_status()
+    return r.text
+
+def get_source_version(mode, source, session):
+    try:
+        return json.loads(read_source_file(source, "VERSION", session))[mode]
+    except Exception as e:
+        exit(f"Cannot find version info for mode {mode} in {source}!")
+
+def get_published_checksums(repository_url, session):
+    # the repository is an Invenio instance: the record API lists every file with its checksum ("md5:<hex>")
+    try:
+        r = session.get(repository_url.replace("/record/", "/api/records/"), timeout=TIMEOUT)
+        r.raise_for_status()
+        return {f["key"]: f["checksum"] for f in r.json().get("files", []) if "checksum" in f}
+    except Exception as e:
+        return {}
+
+def get_checksums(source, repository_url, session):
+    if repository_url is not None:
+        return get_published_checksums(repository_url, session)
+    try:
+        return json.loads(read_source_file(source, CHECKSUM_FILE, session))
+    except Exception as e:
+        return {}
+
+def compute_checksum(file, algorithm="md5"):
+    digest = hashlib.new(algorithm)
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return algorithm + ":" + digest.hexdigest()
+
+def verify_checksum(file, checksum):
+    # checksum as "<algorithm>:<hex>". Files without a published checksum cannot be verified
+    if checksum is None:
+        return True
+    return compute_checksum(file, checksum.split(":")[0]) == checksum
+
+
+class DownloadProgress:
+    # one progress bar for all parallel downloads. The total grows as the sizes become known
+    def __init__(self, disable=False):
+        self.bar = tqdm(total=0, unit="B", unit_scale=True, unit_divisor=1024, disable=disable)
+        self._lock = threading.Lock()
+
+    def add_total(self, size):
+        with self._lock:
+            self.bar.total += size
+            self.bar.refresh()
+
+    def update(self, size):
+        with self._lock:
+            self.bar.update(size)
+
+    def close(self):
+        self.bar.close()
+
+
+def get_expected_size(r, offset):
+    # size of the complete file, None if the server does not tell
+    if r.status_code == 416:
+        total = r.headers.get("content-range", "").rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    length = r.headers.get("content-length")
+    return offset + int(length) if length is not None else None
+
+def download_file(url, target, session, progress, checksum=None, retries=3):
+    # resumes a partial download (<target>.part) with an HTTP Range request. Servers without Range support send the
+    # whole file again, which restarts the download. Without a checksum, only the size of the result can be verified
+    target = Path(target)
+    part = Path(str(target) + ".part")
+    if checksum is None:
+        target.unlink(missing_ok=True)  # a complete file of an earlier attempt cannot be trusted
+    elif target.exists() and verify_checksum(target, checksum):
+        return target  # complete from an earlier attempt
+    counted = False
+    expected = None
+    for attempt in range(retries):
+        offset = part.stat().st_size if part.exists() else 0
+        headers = {"Range": "bytes=%d-" % offset} if offset > 0 else {}
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=60) as r:
+                if r.status_code == 416:
+                    # the partial download is as large as the file (complete) or larger (another version)
+                    expected = get_expected_size(r, offset)
+                    if expected == offset:
+                        break
+                    part.unlink()
+                    continue
+                r.raise_for_status()
+                if r.status_code != 206:
+                    offset = 0
+                expected = get_expected_size(r, offset)
+                if not counted:
+                    # bytes of a partial download from an earlier run count as done
+                    progress.add_total(expected if expected is not None else offset)
+                    progress.update(offset)
+                    counted = True
+                with open(part, "ab" if offset > 0 else "wb") as f:
+                    for chunk in r.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        progress.update(len(chunk))
+            break
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            if attempt == retries - 1:
+                raise
+            print(f"Download of {target.name} interrupted, resuming")
+    if not part.exists() or (expected is not None and part.stat().st_size != expected):
+        part.unlink(missing_ok=True)
+        raise Exception(f"Size mismatch for {target.name}! The download is incomplete, please try again")
+    part.replace(target)
+    if not verify_checksum(target, checksum):
+        target.unlink()
+        raise Exception(f"Checksum mismatch for {target.name}! The download is corrupted, please try again")
+    return target
+
+def fetch_archive(name, source, session, progress, checksums, download_dir):
+    # local archive path of a verified archive
+    checksum = checksums.get(name)
+    if is_local(source):
+        archive = Path(source, name)
+        assert archive.exists(), f"Archive {archive} not found"
+        assert verify_checksum(archive, checksum), f"Checksum mismatch for {archive}! The archive is corrupted"
+        return archive
+    return download_file(source + "/" + name, Path(download_dir, name), session, progress, checksum)
+
+def fetch_archives(names, source, session, checksums, download_dir, max_connections=3, progress_bar=True):
+    # yields the archives in the order in which they are completed, so that the first ones can be extracted while the
+    # others are still downloading
+    Path(download_dir).mkdir(exist_ok=True, parents=True)
+    progress = DownloadProgress(disable=not progress_bar or is_local(source))
+    try:
+        with ThreadPoolExecutor(max_workers=max_connections) as executor:
+            futures = [executor.submit(fetch_archive, name, source, session, progress, checksums, download_dir)
+                       for name in names]
+            for future in as_completed(futures):
+                yield future.result()
+    finally:
+        progress.close()
+
+def extract_archive(archive, target_dir):
+    with zipfile.ZipFile(archive) as zip_file:
+        zip_file.extractall(target_dir)
+
+def make_readable(folder):
+    # models in the system-wide store are used by all users
+    for path in [Path(folder), *Path(folder).rglob("*")]:
+        path.chmod(0o755 if path.is_dir() else 0o644)
+
+def set_current(store, mode, name):
+    # atomic switch to another installation. Runs that already started keep the files of the previous one
+    pointer = Path(get_pointer_path(store, mode))
+    tmp_pointer = Path(str(pointer) + ".%d.tmp" % os.getpid())
+    tmp_pointer.write_text(name)
+    tmp_pointer.replace(pointer)
+
+def remove_legacy_installation(store, mode):
+    # models that older LyROI versions extracted directly into the store
+    try:
+        folders = get_model_folders(mode, store)
+    except RuntimeError:
+        return
+    for folder in folders:
+        shutil.rmtree(folder, ignore_errors=True)
+    Path(get_manifest_path(mode, store)).unlink(missing_ok=True)
+    dataset = Path(folders[0]).parent
+    if not any(dataset.glob("nnUNetTrainer__*")):  # no models of other modes left
+        shutil.rmtree(dataset, ignore_errors=True)
+
+def remove_old_versions(store, mode, keep):
+    # keep: the new and the previous installation, which runs that started before may still use. Without a previous
+    # versioned installation, the previous one is the legacy installation
+    for folder in Path(store, "versions").glob(mode + "-*"):
+        if folder.name not in keep:
+            shutil.rmtree(folder, ignore_errors=True)
+    if all(name is not None for name in keep):
+        remove_legacy_installation(store, mode)
+
+def install_models(mode, from_dir=None, mirror=None, max_connections=3, progress_bar=True, system=False):
+    # the archives are extracted into a new versioned folder of the store, which only becomes the current installation
+    # once it is complete. A lock per store and mode serializes concurrent installations
+    store = get_system_models_dir() if system else get_models_dir()
+    assert store is not None, "Set LYROI_SYSTEM_DIR to install into the system-wide model store"
+    session = get_session(max_connections)
+    source, repository_url = get_source(from_dir, mirror)
+    version = get_source_version(mode, source, session)
+    names = get_archive_names(mode)
+    checksums = get_checksums(source, repository_url, session)
+    missing = [name for name in names if name not in checksums]
+    if len(missing) > 0:
+        print("No checksums available for " + ", ".join(missing) + ", the archives cannot be verified")
+
+    lock_path = Path(store, "locks", "install_" + mode + ".lock")
+    wait_for_lock(lock_path, INSTALL_LOCK_TIMEOUT, "Waiting for another installation of the same mode to finish")
+    try:
+        # leftovers of interrupted installations
+        for folder in Path(store, "versions").glob(mode + "-*.partial"):
+            shutil.rmtree(folder, ignore_errors=True)
+        name = "%s-%s-%s-%s" % (mode, version, time.strftime("%Y%m%d%H%M%S"), uuid.uuid4().hex[:8])
+        staging = Path(store, "versions", name + ".partial")
+        staging.mkdir(parents=True)
+
+        download_dir = get_download_dir()
+        print(f"Downloading {len(names)} model archives from {source}" if not is_local(source) else
+              f"Installing {len(names)} model archives from {source}")
+        for archive in fetch_archives(names, source, session, checksums, download_dir, max_connections, progress_bar):
+            print("Extracting " + archive.name)
+            extract_archive(archive, staging)
+            if not is_local(source):
+                archive.unlink()
+
+        # writing a current version
+        for folder in get_model_folders(mode, staging):
+            Path(folder, "VERSION").write_text(version)
+        print("Writing installation manifest")
+        write_manifest(mode, version, staging)
+        if system:
+            make_readable(staging)
+        staging.rename(staging.with_name(name))
+
+        pointer = Path(get_pointer_path(store, mode))
+        previous = pointer.read_text().strip() if pointer.exists() else None
+        set_current(store, mode, name)
+        remove_old_versions(store, mode, keep=[name, previous])
+    finally:
+        release_lock(lock_path)
+    print("Done")
+
+def download_models(mode, target_dir, mirror=None, max_connections=3, progress_bar=True):
+    # populates a folder that can be used with --from-dir or served as a mirror
+    session = get_session(max_connections)
+    source, repository_url = get_source(None, mirror)
+    names = get_archive_names(mode)
+    checksums = get_checksums(source, repository_url, session)
+    Path(target_dir).mkdir(exist_ok=True, parents=True)
+
+    print(f"Downloading {len(names)} model archives from {source}")
+    for archive in fetch_archives(names, source, session, checksums, target_dir, max_connections, progress_bar):
+        print("Downloaded " + archive.name + " (" + format_file_size(archive.stat().st_size) + ")")
+        if archive.name not in checksums:
+            checksums[archive.name] = compute_checksum(archive)
+
+    # VERSION and checksums of all modes stored in the folder so far
+    version_file = Path(target_dir, "VERSION")
+    versions = json.loads(version_file.read_text()) if version_file.exists() else {}
+    versions[mode] = get_source_version(mode, source, session)
+    version_file.write_text(json.dumps(versions, indent=2))
+    checksum_file = Path(target_dir, CHECKSUM_FILE)
+    stored = json.loads(checksum_file.read_text()) if checksum_file.exists() else {}
+    stored.update({name: checksums[name] for name in names})
+    checksum_file.write_text(json.dumps(stored, indent=2))
+    print("Model archives stored in " + str(target_dir))
+
+def get_source_size(mode, from_dir=None, mirror=None):
+    names = get_archive_names(mode)
+    source, repository_url = get_source(from_dir, mirror)
+    if is_local(source):
+        return sum(Path(source, name).stat().st_size for name in names)
+    return sum(get_file_sizes([source + "/" + name for name in names]))
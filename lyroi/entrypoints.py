@@ -1,9 +1,21 @@
+import argparse
 from pathlib import Path
-from packaging.version import Version
 from lyroi.utils import (check_model, install_model, setup_lyroi, check_version_local, check_version_online,
-                         yes_no_input, get_download_size, format_file_size, clean_temp_dir)
+                         yes_no_input, get_download_size, format_file_size, clean_temp_dir, verify_model,
+                         get_system_models_dir, get_store_root, get_scratch_dir, format_time)
 from lyroi.modes import get_mode_list, get_default_mode
-from lyroi import __legal__
+
+# placeholder for the legal notice in the epilogs, see HelpFormatter
+LEGAL_NOTICE = "<legal notice>"
+
+
+class HelpFormatter(argparse.RawDescriptionHelpFormatter):
+    # the legal notice needs the package metadata, which is slow to load. It is only filled in when the help is shown
+    def add_text(self, text):
+        if text is not None and LEGAL_NOTICE in text:
+            import lyroi
+            text = text.replace(LEGAL_NOTICE, lyroi.__legal__)
+        super().add_text(text)
 
 
 def predict_entrypoint():
@@ -12,7 +24,6 @@ def predict_entrypoint():
     mode_str = [mode + (" (default)" if mode == default_mode else "") for mode in all_modes]
     mode_str = ", ".join(mode_str)
 
-    import argparse
     parser = argparse.ArgumentParser(
         prog = "lyroi",
         description='Run lymphoma ROI prediction for the given input folder',
@@ -22,9 +33,9 @@ def predict_entrypoint():
             "  lyroi -i input_dir -o output_dir\n\n"
             "Segment ct_img.nii.gz and pet_img.nii.gz volume pair and save results as mask.nii.gz using cpu device at max power:\n"
             "  lyroi -i ct_img.nii.gz pet_img.nii.gz -o mask.nii.gz -d cpu-max\n\n"
-            f"{__legal__}"
+            f"{LEGAL_NOTICE}"
         ),
-        formatter_class=argparse.RawDescriptionHelpFormatter
+        formatter_class=HelpFormatter
     )
     parser.add_argument('-i', type=str, required=True, nargs='+', metavar="INPUT",
                         help='Input folder or list of files.'
@@ -45,8 +56,69 @@ def predict_entrypoint():
                              'To select specific gpu, execute "export CUDA_VISIBLE_DEVICES=..." before running LyROI')
     parser.add_argument('-np', '--no_progress_bar', action='store_true', default=False,
                         help="Disable progress bar")
+    parser.add_argument('--max-memory', type=str, default=None, metavar="SIZE",
+                        help='Memory budget for the run, e.g. 32G. Peak memory of each case is estimated from the '
+                             'image headers and the model plans, and cases are admitted in batches with worker pools '
+                             'sized to stay within the budget')
+    parser.add_argument('--out-of-core', type=str, default="auto", choices=["auto", "on", "off"],
+                        help='Accumulate the sliding window logits in memory-mapped files instead of device or main '
+                             'memory. "auto" (default) does so only for cases which are estimated not to fit in memory')
+    parser.add_argument('--scratch', type=str, default=None, metavar="DIR",
+                        help='Directory on fast local storage (e.g., /dev/shm or a local NVMe drive) for the '
+                             'intermediate results instead of the output folder, which only receives the final '
+                             'delineations. Defaults to $LYROI_SCRATCH if set. Falls back to the output folder if the '
+                             'estimated space is not available')
+    parser.add_argument('--preview', action='store_true', default=False,
+                        help='Write a quick preview (first model and fold, no test-time mirroring, non-overlapping '
+                             'tiles) to <output>_preview.nii.gz or the preview subfolder of the output folder first. '
+                             'The preview is removed once the full ensemble result is written')
+    parser.add_argument('--tta', type=str, default="full", choices=["full", "adaptive"],
+                        help='Test-time mirroring. "full" (default) mirrors every tile, "adaptive" mirrors only the '
+                             'tiles where the unmirrored predictions of the folds are uncertain or disagree')
+    parser.add_argument('--validate-tta', action='store_true', default=False,
+                        help='With --tta adaptive, additionally compute the result with full mirroring and report the '
+                             'agreement of the masks per case and model (slower than full mirroring alone)')
+    parser.add_argument('--cascade', type=float, nargs='?', default=None, const=0.1, metavar="THRESHOLD",
+                        help='Locate candidate regions with a quick pass (first fold, no mirroring, non-overlapping '
+                             'tiles) and run the full ensemble only on the tiles around them. Voxels with a foreground '
+                             'probability of at least THRESHOLD (default: 0.1) in the quick pass are candidates. '
+                             'Benchmark the thresholds on your data with lyroi_tune --cascade')
+    parser.add_argument('--early-exit', type=float, nargs='?', default=None, const=0.0, metavar="ML",
+                        help='Run the models from the fastest to the slowest and skip the remaining models for a case '
+                             'once the last model added at most ML milliliters (default: 0, i.e., nothing) to the '
+                             'union of the masks of the models before it. The cases that exited early and the saved '
+                             'compute time are reported at the end of the run. The order of the models is estimated from '
+                             'the sliding window times of earlier early exit runs on the device with the same test-time '
+                             'augmentation and cascade settings, or from the size of the model checkpoints before the '
+                             'first run')
+    placement = parser.add_mutually_exclusive_group()
+    placement.add_argument('--cpus', type=str, default=None, metavar="CPUS",
+                           help='Restrict LyROI and its worker processes to the given CPUs, e.g. "0-31" or "0-7,16-23"')
+    placement.add_argument('--numa-node', type=str, default=None, metavar="NODE",
+                           help='Restrict LyROI and its worker processes to the CPUs of the given NUMA node (socket). '
+                                'Use "auto" to run one instance per socket: each concurrent run claims a free node')
+    parser.add_argument('--report', type=str, default=None, metavar="FILE",
+                        help='Write a JSON report with the time spent in each stage (reading, preprocessing, model '
+                             'loading, sliding window, export, merging, writing) per case and model')
+    parser.add_argument('--telemetry', action='store_true', default=False,
+                        help='Sample memory, CPU and device memory usage of LyROI and its worker processes during the '
+                             'run. The time series and per-case peaks are written to lyroi_telemetry.json in the output '
+                             'folder (or <output>_telemetry.json next to the output file)')
+    parser.add_argument('--metrics-file', type=str, default=None, metavar="FILE",
+                        help='Periodically write throughput and latency metrics of the run to FILE in the Prometheus '
+                             'text format, e.g. for the node-exporter textfile collector')
+    parser.add_argument('--metrics-interval', type=float, default=15, metavar="SECONDS",
+                        help='Minimum time between two updates of the metrics file (default: 15)')
+    parser.add_argument('--progress-format', type=str, default="text", choices=["text", "jsonl"],
+                        help='"text" (default) shows progress bars. "jsonl" writes typed progress events (plans, cases, '
+                             'folds, tiles, stage timings, overall progress and ETA) as one JSON object per line '
+                             'instead, e.g. for GUIs and orchestration tools')
+    parser.add_argument('--progress-fd', type=int, default=None, metavar="FD",
+                        help='File descriptor to write the jsonl progress events to (default: stdout, interleaved '
+                             'with the log messages)')
     parser.add_argument('--cleanup', action='store_true', default=False,
-                        help="Do nothing, just clean temporary directory")
+                        help="Do nothing, just remove the temporary directories that interrupted runs with the same "
+                             "inputs left in the output folder and the scratch directory")
 
     args = parser.parse_args()
 
@@ -68,9 +140,21 @@ def predict_entrypoint():
         assert is_file_output, "Output appears to be a directory while input is a file (list). Input and output types should match!"
     assert dir_mode != file_mode, "Something is wrong with input/output specifications or inputs do not exist!"
 
+    assert not args.validate_tta or args.tta == "adaptive", "--validate-tta requires --tta adaptive"
+
+    if args.cleanup:
+        # temporary directories of interrupted runs. Directories of runs that are still going are kept
+        output_dir = Path(args.o) if dir_mode else Path(args.o).parent.absolute()
+        n_removed = clean_temp_dir(output_dir, args.mode, args.i[0] if dir_mode else args.i,
+                                   get_scratch_dir(args.scratch))
+        print(f"Removed {n_removed} temporary director{'y' if n_removed == 1 else 'ies'} of earlier runs")
+        return
+
     # import here to accelerate startup
-    setup_lyroi()
+    setup_lyroi(args.device, cpus=args.cpus, numa_node=args.numa_node)
     from lyroi.inference import predict_from_folder, predict_from_files
+    from lyroi.memory import parse_memory_size
+    max_memory = parse_memory_size(args.max_memory) if args.max_memory is not None else None
 
     if not check_model(args.mode):
         print("The model for the selected mode is not installed or installation is incomplete")
@@ -85,23 +169,66 @@ def predict_entrypoint():
     assert check_model(args.mode), (f"Something went wrong and the model has not been correctly installed! "
                                     f"Try 'lyroi_install -m {args.mode} -f' to force reinstall the model")
 
-    if dir_mode:
-        Path(args.o).mkdir(exist_ok=True, parents=True)
-        predict_from_folder(args.i[0], args.o, args.mode, device=args.device, progress_bar=not args.no_progress_bar)
+    report = None
+    if args.report is not None:
+        from lyroi.events import add_listener
+        from lyroi.report import RunReport
+        report = RunReport()
+        add_listener(report)
 
-    if file_mode:
-        predict_from_files(args.i, args.o, args.mode, device=args.device, progress_bar=not args.no_progress_bar)
+    progress_bar = not args.no_progress_bar
+    if args.progress_format == "jsonl":
+        import os
+        import sys
+        from lyroi.events import add_listener
+        from lyroi.progress import JsonlProgressWriter
+        stream = sys.stdout if args.progress_fd is None else os.fdopen(args.progress_fd, "w", buffering=1)
+        add_listener(JsonlProgressWriter(stream))
+        progress_bar = False  # progress is reported by the events
 
+    metrics = None
+    if args.metrics_file is not None:
+        from lyroi.events import add_listener
+        from lyroi.metrics import MetricsWriter
+        metrics = MetricsWriter(args.metrics_file, args.mode, args.device, args.metrics_interval).start()
+        add_listener(metrics)
 
-def install_model_entrypoint():
-    setup_lyroi()
+    telemetry_file = None
+    if args.telemetry:
+        if dir_mode:
+            telemetry_file = Path(args.o, "lyroi_telemetry.json")
+        else:
+            telemetry_file = Path(args.o).with_name(Path(args.o).name.removesuffix(".nii.gz") + "_telemetry.json")
+
+    try:
+        if dir_mode:
+            Path(args.o).mkdir(exist_ok=True, parents=True)
+            predict_from_folder(args.i[0], args.o, args.mode, device=args.device,
+                                progress_bar=progress_bar, max_memory=max_memory,
+                                out_of_core=args.out_of_core, telemetry_file=telemetry_file, preview=args.preview,
+                                scratch=args.scratch, tta=args.tta, validate_tta=args.validate_tta,
+                                cascade=args.cascade, early_exit=args.early_exit)
+
+        if file_mode:
+            predict_from_files(args.i, args.o, args.mode, device=args.device, progress_bar=progress_bar,
+                               max_memory=max_memory, out_of_core=args.out_of_core, telemetry_file=telemetry_file,
+                               preview=args.preview, scratch=args.scratch, tta=args.tta,
+                               validate_tta=args.validate_tta, cascade=args.cascade,
+                               early_exit=args.early_exit)
+    finally:
+        if metrics is not None:
+            metrics.stop()
+        if report is not None:
+            report.write(args.report)
+            print("Run report written to", args.report)
 
+
+def install_model_entrypoint():
     default_mode = get_default_mode()
     all_modes = get_mode_list()
     mode_str = [mode + (" (default)" if mode == default_mode else "") for mode in all_modes]
     mode_str = ", ".join(mode_str)
 
-    import argparse
     parser = argparse.ArgumentParser(
         prog="lyroi_install",
         description='Install the models required for running LyROI in the selected mode',
@@ -111,26 +238,70 @@ def install_model_entrypoint():
             "  lyroi_install\n\n"
             "Check if the models for \"petct\" mode are already installed and up to date:\n"
             "  lyroi -c -m petct\n\n"
-            f"{__legal__}"
+            "Additionally verify the sizes and checksums of all installed model files:\n"
+            "  lyroi_install -c --verify -m petct\n\n"
+            "Store the model archives in a shared folder and install them from there on other machines:\n"
+            "  lyroi_install --download-to /shared/lyroi_models\n"
+            "  lyroi_install --from-dir /shared/lyroi_models\n\n"
+            "Install the models once for all users of the machine (LYROI_SYSTEM_DIR must be set for all users):\n"
+            "  LYROI_SYSTEM_DIR=/opt/lyroi lyroi_install --system\n\n"
+            f"{LEGAL_NOTICE}"
         ),
-        formatter_class=argparse.RawDescriptionHelpFormatter
+        formatter_class=HelpFormatter
     )
     parser.add_argument('-f', '--force', action='store_true', default=False, help="Force reinstall the"
                                                                                   "model even if it is already installed and up to date.")
     parser.add_argument('-c', '--check', action='store_true', default=False, help="Check if the models are"
                                                                                   "already installed. Does not run the installation process itself")
+    parser.add_argument('--verify', action='store_true', default=False,
+                        help="Check the sizes and checksums of all model files against the installation manifest "
+                             "(implies -c)")
     parser.add_argument('-y', '--yes', action='store_true', default=False, help="Skip the confirmation prompts")
     parser.add_argument('-m', '--mode', type=str, default=default_mode, choices=all_modes, metavar="MODE",
                         help='Which mode of operation to install the models for: ' + mode_str)
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--from-dir', type=str, default=None, metavar="DIR",
+                        help='Install from a local folder with the model archives, the VERSION file and optionally '
+                             'checksums.json (as written by --download-to) instead of the online repository')
+    source.add_argument('--mirror', type=str, default=None, metavar="URL",
+                        help='Download the model archives from a mirror with the same file layout as --from-dir')
+    parser.add_argument('--download-to', type=str, default=None, metavar="DIR",
+                        help='Only download the model archives together with the VERSION file and their checksums '
+                             'into DIR, for later use with --from-dir or as a mirror')
+    parser.add_argument('--connections', type=int, default=3,
+                        help='Maximum number of parallel downloads (default: 3)')
+    parser.add_argument('--system', action='store_true', default=False,
+                        help='Install into (or check) the system-wide model store in $LYROI_SYSTEM_DIR, which is '
+                             'shared by all users. Models installed by a user take precedence over it')
     args = parser.parse_args()
     print("Selected mode:", args.mode)
-    is_installed = check_model(args.mode)
+
+    root = None  # installation that is used for inference
+    if args.system:
+        assert get_system_models_dir() is not None, "Set LYROI_SYSTEM_DIR to use the system-wide model store"
+        root = get_store_root(get_system_models_dir(), args.mode)
+
+    if args.download_to is not None:
+        assert args.from_dir is None, "--download-to cannot be combined with --from-dir"
+        from lyroi.download import download_models
+        download_models(args.mode, args.download_to, mirror=args.mirror, max_connections=args.connections)
+        return
+    is_installed = check_model(args.mode, root)
 
     # check flag handling
-    if args.check:
+    if args.check or args.verify:
+        if is_installed and args.verify:
+            problems = verify_model(args.mode, root)
+            if len(problems) > 0:
+                print("The model installation is corrupted:")
+                print("\n".join("  " + problem for problem in problems))
+                print(f"Use 'lyroi_install -m {args.mode} -f' to reinstall the model")
+                return
+            print("All model files match the installation manifest")
         if is_installed:
+            from packaging.version import Version
             try:
-                cur_version = Version(check_version_local(args.mode))
+                cur_version = Version(check_version_local(args.mode, root))
                 online_version = Version(check_version_online(args.mode))
                 if cur_version == online_version:
                     print("The model is installed and up to date. Current version:", cur_version)
@@ -149,8 +320,12 @@ def install_model_entrypoint():
         return
 
     try:
-        cur_version = check_version_local(args.mode)
-        online_version = check_version_online(args.mode)
+        cur_version = check_version_local(args.mode, root)
+        if args.from_dir is None and args.mirror is None:
+            online_version = check_version_online(args.mode)
+        else:
+            from lyroi.download import get_source, get_source_version, get_session
+            online_version = get_source_version(args.mode, get_source(args.from_dir, args.mirror)[0], get_session())
         up_to_date = cur_version == online_version
     except Exception as e:
         cur_version = "None"
@@ -160,8 +335,243 @@ def install_model_entrypoint():
         print("The installed model is up to date ( version:", cur_version, "). Use flag -f to force reinstall the model.")
         return
 
-    if not args.yes:
-        model_size = format_file_size(get_download_size(args.mode))
+    if not args.yes and args.from_dir is None:
+        if args.mirror is None:
+            model_size = format_file_size(get_download_size(args.mode))
+        else:
+            from lyroi.download import get_source_size
+            model_size = format_file_size(get_source_size(args.mode, mirror=args.mirror))
         print(f"This action will require downloading {model_size} of data from the internet")
         yes_no_input("\nProceed", "Download is aborted and the model will not be installed")
-    install_model(args.mode)
\ No newline at end of file
+    setup_lyroi()
+    install_model(args.mode, from_dir=args.from_dir, mirror=args.mirror, max_connections=args.connections,
+                  system=args.system)
+
+def tune_entrypoint():
+    default_mode = get_default_mode()
+    all_modes = get_mode_list()
+    mode_str = [mode + (" (default)" if mode == default_mode else "") for mode in all_modes]
+    mode_str = ", ".join(mode_str)
+
+    parser = argparse.ArgumentParser(
+        prog="lyroi_tune",
+        description='Benchmark thread and process settings on synthetic data and store the fastest combination as '
+                    'the performance profile of this machine',
+        epilog=(
+            "Examples:\n\n"
+            "Tune the settings for the gpu device:\n"
+            "  lyroi_tune\n\n"
+            "Tune the settings for the cpu-max device using all parameter combinations:\n"
+            "  lyroi_tune -d cpu-max --exhaustive\n\n"
+            "The profile is stored in $LYROI_DIR/profile.json and is used automatically by lyroi and lyroi_gui.\n\n"
+            "Benchmark the speed and sensitivity of lyroi --cascade with several thresholds on a reference set:\n"
+            "  lyroi_tune --cascade reference_cases --references reference_masks --thresholds 0.05 0.1 0.3\n\n"
+            f"{LEGAL_NOTICE}"
+        ),
+        formatter_class=HelpFormatter
+    )
+    parser.add_argument('-m', '--mode', type=str, default=default_mode, choices=all_modes, metavar="MODE",
+                        help='Mode of operation whose (installed) models are used for tuning: ' + mode_str)
+    parser.add_argument('-d', '--device', type=str, default='gpu', choices=['gpu', 'cpu', 'cpu-max', 'mps'], metavar="DEVICE",
+                        help='Computational device to tune the settings for. Choose from gpu (default), cpu, cpu-max and mps.')
+    parser.add_argument('--shape', type=int, nargs=3, default=[192, 192, 256], metavar=("X", "Y", "Z"),
+                        help='Matrix size of the synthetic volumes (default: 192 192 256)')
+    parser.add_argument('--cases', type=int, default=3,
+                        help='Number of synthetic cases per trial (default: 3)')
+    parser.add_argument('--folds', type=int, default=1,
+                        help='Number of folds to predict with in each trial (default: 1)')
+    parser.add_argument('--exhaustive', action='store_true', default=False,
+                        help="Try all parameter combinations instead of optimizing one parameter at a time (slow)")
+    cascade = parser.add_argument_group("cascade benchmark")
+    cascade.add_argument('--cascade', type=str, default=None, metavar="INPUT",
+                         help='Instead of tuning, compare the full ensemble with lyroi --cascade on the cases in INPUT '
+                              '(same layout as the lyroi input folder). The profile is not changed')
+    cascade.add_argument('--references', type=str, default=None, metavar="DIR",
+                         help='Reference masks (<case>.nii.gz) to measure the sensitivity against. Without them, the '
+                              'result of the full ensemble is the reference')
+    cascade.add_argument('--thresholds', type=float, nargs='+', default=[0.05, 0.1, 0.2, 0.3, 0.5],
+                         metavar="THRESHOLD", help='Candidate thresholds to benchmark (default: 0.05 0.1 0.2 0.3 0.5)')
+    cascade.add_argument('-o', type=str, default=None, metavar="OUTPUT",
+                         help='JSON file to write the benchmark results to')
+    args = parser.parse_args()
+
+    # the cascade benchmark predicts like lyroi on the device, the tuning trials set up their own threads
+    setup_lyroi(args.device if args.cascade is not None else None)
+    from lyroi.tuning import tune
+    from lyroi.modes import get_folds
+
+    assert check_model(args.mode), (f"The model for the selected mode is not installed. "
+                                    f"Run 'lyroi_install -m {args.mode}' first")
+
+    if args.cascade is not None:
+        from lyroi.tuning import benchmark_cascade
+        results = benchmark_cascade(args.mode, args.device, args.cascade, args.thresholds, args.references)
+        print("\nCascade benchmark (sensitivity against " +
+              ("the reference masks" if args.references is not None else "the full ensemble") + "):")
+        print("  threshold  sliding window  speedup  voxel sens.  lesion sens.  mean Dice")
+        for name, result in results.items():
+            speedup = f"{result['speedup']:.2f}x" if result["speedup"] is not None else "-"
+            print(f"  {name:>9}  {format_time(result['sliding_window_seconds']):>14}  {speedup:>7}  "
+                  f"{result['voxel_sensitivity']:>11.4f}  {result['lesion_sensitivity']:>12.4f}  "
+                  f"{result['mean_dice']:>9.4f}")
+        if args.o is not None:
+            import json
+            Path(args.o).write_text(json.dumps(results, indent=2))
+            print("Results written to", args.o)
+        return
+
+    print("Tuning performance settings for device:", args.device)
+    profile = tune(args.mode, args.device, shape=args.shape, n_cases=args.cases,
+                   folds=get_folds(args.mode)[:args.folds], exhaustive=args.exhaustive)
+    print("\nFastest settings:")
+    for key in ["torch_threads", "n_proc", "num_processes_preprocessing", "num_processes_segmentation_export"]:
+        print(f"  {key}: {profile[key]}")
+    print("Profile saved, it will be used for all subsequent runs on this device")
+
+def bench_entrypoint():
+    default_mode = get_default_mode()
+    all_modes = get_mode_list()
+    mode_str = [mode + (" (default)" if mode == default_mode else "") for mode in all_modes]
+    mode_str = ", ".join(mode_str)
+    all_benchmarks = ["predict_from_folder", "predict_from_files", "merge_delineations"]
+
+    parser = argparse.ArgumentParser(
+        prog="lyroi_bench",
+        description='Time the LyROI inference pipeline on the cpu with synthetic volumes and randomly initialized '
+                    'networks. No model download is required',
+        epilog=(
+            "Examples:\n\n"
+            "Run all benchmarks with the default settings and save the results:\n"
+            "  lyroi_bench -o bench.json\n\n"
+            "Quick run with small networks and volumes:\n"
+            "  lyroi_bench --network small --shape 96 96 128 --cases 2 --repeat 1\n\n"
+            f"{LEGAL_NOTICE}"
+        ),
+        formatter_class=HelpFormatter
+    )
+    parser.add_argument('-m', '--mode', type=str, default=default_mode, choices=all_modes, metavar="MODE",
+                        help='Mode of operation whose models are emulated: ' + mode_str)
+    parser.add_argument('-o', type=str, default=None, metavar="OUTPUT",
+                        help='JSON file to write the results and the environment metadata to')
+    parser.add_argument('--shape', type=int, nargs=3, default=[192, 192, 256], metavar=("X", "Y", "Z"),
+                        help='Matrix size of the synthetic volumes (default: 192 192 256)')
+    parser.add_argument('--spacing', type=float, nargs=3, default=[2.0, 2.0, 3.0], metavar=("X", "Y", "Z"),
+                        help='Voxel size of the synthetic volumes in mm (default: 2 2 3). The networks are planned '
+                             'for 2 x 2 x 3 mm, other values add resampling to the pipeline')
+    parser.add_argument('--cases', type=int, default=3,
+                        help='Number of synthetic cases (default: 3)')
+    parser.add_argument('--folds', type=int, default=1,
+                        help='Number of folds per model (default: 1)')
+    parser.add_argument('--network', type=str, default="full", choices=["full", "small"],
+                        help='Size of the emulated networks. "full" (default) approximates the real architectures, '
+                             '"small" uses reduced networks for quick runs')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of repetitions of each benchmark (default: 3)')
+    parser.add_argument('--benchmarks', type=str, nargs='+', default=all_benchmarks, choices=all_benchmarks,
+                        metavar="NAME", help='Benchmarks to run: ' + ", ".join(all_benchmarks) + ' (default: all)')
+    parser.add_argument('--baseline', type=str, default=None, metavar="FILE",
+                        help='Compare the results with an earlier result file and exit with an error if any '
+                             'benchmark regressed by more than the threshold')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative slowdown that counts as a regression (default: 0.1, i.e. 10%%)')
+    args = parser.parse_args()
+
+    import os
+    import json
+    import tempfile
+    with tempfile.TemporaryDirectory(prefix="lyroi-bench-") as work_dir:
+        # separate LyROI directory: the synthetic models must not touch the installed ones, and the performance
+        # profile of this machine is not applied, which keeps the results comparable
+        os.environ['LYROI_DIR'] = str(Path(work_dir, "lyroi"))
+        setup_lyroi("cpu")
+        from lyroi.benchmark import run_benchmarks
+        results = run_benchmarks(work_dir, args.mode, shape=args.shape, spacing=args.spacing, n_cases=args.cases,
+                                 n_folds=args.folds, network=args.network, repeat=args.repeat,
+                                 benchmarks=args.benchmarks)
+
+    print("\nResults (seconds):")
+    for name, result in results["results"].items():
+        print(f"  {name}: min {result['min']:.3f}, median {result['median']:.3f}, mean {result['mean']:.3f}")
+    if args.o is not None:
+        Path(args.o).write_text(json.dumps(results, indent=2))
+        print("Results written to", args.o)
+
+    if args.baseline is not None:
+        from lyroi.benchmark import print_comparison
+        print("\nComparison with the baseline:")
+        regressions = print_comparison(json.loads(Path(args.baseline).read_text()), results, args.threshold)
+        if len(regressions) > 0:
+            exit(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold * 100:.0f}%")
+        print("No regressions")
+
+def microbench_entrypoint():
+    from lyroi.microbench import MICRO_BENCHMARKS
+
+    parser = argparse.ArgumentParser(
+        prog="lyroi_microbench",
+        description='Time the helpers around the networks (NIfTI reading and writing, merging, file handling, '
+                    'progress parsing and start-up time) and compare the results with a stored baseline',
+        epilog=(
+            "Examples:\n\n"
+            "Run all micro benchmarks and store the results as baseline:\n"
+            "  lyroi_microbench --save-baseline\n\n"
+            "Run the merge benchmarks and fail if any of them is more than 20% slower than the baseline:\n"
+            "  lyroi_microbench --only merge --baseline --threshold 0.2\n\n"
+            "Compare two result files:\n"
+            "  lyroi_microbench --compare old.json new.json\n\n"
+            f"{LEGAL_NOTICE}"
+        ),
+        formatter_class=HelpFormatter
+    )
+    parser.add_argument('-o', type=str, default=None, metavar="OUTPUT",
+                        help='JSON file to write the results to')
+    parser.add_argument('--only', type=str, nargs='+', default=MICRO_BENCHMARKS, choices=MICRO_BENCHMARKS,
+                        metavar="NAME", help='Benchmarks to run: ' + ", ".join(MICRO_BENCHMARKS) + ' (default: all)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of repetitions of each measurement (default: 5)')
+    parser.add_argument('--shapes', type=str, nargs='+', default=["128x128x160", "256x256x400"], metavar="XxYxZ",
+                        help='Volume sizes for the NIfTI and merge benchmarks (default: 128x128x160 256x256x400)')
+    parser.add_argument('--save-baseline', action='store_true', default=False,
+                        help='Store the results as the baseline in $LYROI_DIR/benchmarks/microbench_baseline.json')
+    parser.add_argument('--baseline', type=str, nargs='?', default=None, const="", metavar="FILE",
+                        help='Compare the results with a baseline file (default: the stored baseline) and exit with '
+                             'an error if any benchmark regressed by more than the threshold')
+    parser.add_argument('--compare', type=str, nargs=2, default=None, metavar=("BASELINE", "RESULTS"),
+                        help='Only compare two existing result files, do not run any benchmarks')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative slowdown that counts as a regression (default: 0.1, i.e. 10%%)')
+    args = parser.parse_args()
+
+    import json
+    import tempfile
+    from lyroi.benchmark import print_comparison
+    from lyroi.microbench import run_micro_benchmarks, get_baseline_path
+
+    if args.compare is not None:
+        baseline, results = [json.loads(Path(f).read_text()) for f in args.compare]
+    else:
+        shapes = [tuple(int(s) for s in shape.lower().split("x")) for shape in args.shapes]
+        assert all(len(shape) == 3 for shape in shapes), "Volume sizes must be given as XxYxZ, e.g. 128x128x160"
+        with tempfile.TemporaryDirectory(prefix="lyroi-microbench-") as work_dir:
+            results = run_micro_benchmarks(work_dir, args.only, args.repeat, shapes)
+        print("\nResults (min of %d, seconds):" % args.repeat)
+        for name, result in results["results"].items():
+            print(f"  {name}: {result['min']:.4f}")
+        if args.o is not None:
+            Path(args.o).write_text(json.dumps(results, indent=2))
+            print("Results written to", args.o)
+        if args.save_baseline:
+            Path(get_baseline_path()).parent.mkdir(exist_ok=True, parents=True)
+            Path(get_baseline_path()).write_text(json.dumps(results, indent=2))
+            print("Baseline saved to", get_baseline_path())
+        if args.baseline is None:
+            return
+        baseline_file = args.baseline or get_baseline_path()
+        assert Path(baseline_file).exists(), f"Baseline {baseline_file} does not exist. Use --save-baseline first"
+        baseline = json.loads(Path(baseline_file).read_text())
+
+    print("\nComparison with the baseline:")
+    regressions = print_comparison(baseline, results, args.threshold)
+    if len(regressions) > 0:
+        exit(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold * 100:.0f}%")
+    print("No regressions")
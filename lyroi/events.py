@@ -0,0 +1,46 @@
+import time
+from contextlib import contextmanager
+
+# Lightweight hook layer. Inference code emits events (dicts with an "event" key), listeners such as run reports
+# subscribe to them. Events are only emitted in the main process.
+_listeners = []
+_cancel_check = None
+
+
+class Cancelled(Exception):
+    pass
+
+
+def add_listener(listener):
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+def remove_listener(listener):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+def emit(event: str, **data):
+    if len(_listeners) == 0:
+        return
+    data["event"] = event
+    data.setdefault("time", time.time())
+    for listener in list(_listeners):
+        listener(data)
+
+def set_cancel_check(check):
+    global _cancel_check
+    _cancel_check = check
+
+def check_cancelled():
+    # called by the inference loop at plan, case and fold boundaries. These run in the main thread before nnU-Net
+    # starts the data loader thread of a fold, cancelling from a tile would leave it behind
+    if _cancel_check is not None and _cancel_check():
+        raise Cancelled("Cancelled by the user")
+
+@contextmanager
+def stage(name: str, **data):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        emit("stage", stage=name, seconds=time.perf_counter() - start, **data)
@@ -0,0 +1,218 @@
+import time
+from pathlib import Path
+
+from PyQt5.QtWidgets import QGroupBox, QVBoxLayout, QHBoxLayout, QListWidget, QListWidgetItem, QPushButton, QLabel
+from PyQt5.QtCore import Qt, pyqtSignal
+
+
+def format_eta(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+class Job:
+    def __init__(self, input_files, output, mode, device, preview=False):
+        self.input_files = input_files
+        self.output = output
+        self.mode = mode
+        self.device = device
+        self.preview = preview
+        self.status = "pending"  # pending, running, finished, failed or cancelled
+        self.progress = 0
+        self.eta = None
+        self.start_time = None
+        self.seconds = None
+        self.batch = len(input_files) == 1 and Path(input_files[0]).is_dir()
+        from lyroi.inference import get_cases  # imports nibabel, which would slow down the start of the GUI
+        self.n_cases = max(len(get_cases(input_files[0], mode)), 1) if self.batch else 1
+
+    def describe(self):
+        if self.batch:
+            source = "%s (%d cases)" % (self.input_files[0], self.n_cases)
+        else:
+            source = ", ".join(Path(f).name for f in self.input_files)
+        options = [self.mode, self.device] + (["preview"] if self.preview else [])
+        return "%s -> %s [%s]" % (source, self.output, ", ".join(options))
+
+    def start(self):
+        self.status = "running"
+        self.progress = 0
+        self.eta = None
+        self.start_time = time.time()
+
+    def finish(self, status):
+        self.status = status
+        self.eta = None
+        self.seconds = time.time() - self.start_time
+
+
+class JobQueue:
+    # jobs in execution order. Finished, failed and cancelled jobs stay in the list until they are cleared
+    def __init__(self):
+        self.jobs = []
+
+    def add(self, job):
+        self.jobs.append(job)
+
+    def get_pending(self):
+        return [job for job in self.jobs if job.status == "pending"]
+
+    def get_running(self):
+        return next((job for job in self.jobs if job.status == "running"), None)
+
+    def next_pending(self):
+        return next((job for job in self.jobs if job.status == "pending"), None)
+
+    def move(self, job, offset):
+        # only pending jobs can be reordered, and only among each other
+        if job.status != "pending":
+            return False
+        pending = self.get_pending()
+        index = pending.index(job)
+        if not 0 <= index + offset < len(pending):
+            return False
+        other = pending[index + offset]
+        i, j = self.jobs.index(job), self.jobs.index(other)
+        self.jobs[i], self.jobs[j] = other, job
+        return True
+
+    def remove(self, job):
+        if job.status != "running":
+            self.jobs.remove(job)
+
+    def clear_done(self):
+        self.jobs = [job for job in self.jobs if job.status in ("pending", "running")]
+
+    def get_seconds_per_case(self):
+        # from the completed jobs, or projected from the progress of the running job
+        done = [job for job in self.jobs if job.status == "finished"]
+        if len(done) > 0:
+            return sum(job.seconds for job in done) / sum(job.n_cases for job in done)
+        running = self.get_running()
+        if running is not None and running.progress >= 5:
+            elapsed = time.time() - running.start_time
+            return elapsed * 100 / running.progress / running.n_cases
+        return None
+
+    def get_eta(self):
+        seconds_per_case = self.get_seconds_per_case()
+        running = self.get_running()
+        eta = 0
+        if running is not None:
+            if running.eta is not None:
+                eta += running.eta
+            elif seconds_per_case is not None:
+                eta += seconds_per_case * running.n_cases * (1 - running.progress / 100)
+            else:
+                return None
+        pending = self.get_pending()
+        if len(pending) > 0:
+            if seconds_per_case is None:
+                return None
+            eta += seconds_per_case * sum(job.n_cases for job in pending)
+        return eta
+
+
+class QueuePanel(QGroupBox):
+    # list of the queued jobs with their status, reordering and cancellation of single jobs
+    cancel_signal = pyqtSignal(object)
+
+    def __init__(self, queue: JobQueue, parent=None):
+        super().__init__("Queue", parent)
+        self.queue = queue
+
+        self.list = QListWidget()
+        self.btn_up = QPushButton("Up")
+        self.btn_down = QPushButton("Down")
+        self.btn_cancel = QPushButton("Cancel Job")
+        self.btn_clear = QPushButton("Clear Finished")
+        self.summary_label = QLabel("")
+        self.summary_label.setProperty("type", "note")
+
+        self.btn_up.clicked.connect(lambda: self.move_selected(-1))
+        self.btn_down.clicked.connect(lambda: self.move_selected(1))
+        self.btn_cancel.clicked.connect(self.cancel_selected)
+        self.btn_clear.clicked.connect(self.clear_done)
+        self.list.currentRowChanged.connect(self.update_buttons)
+
+        button_layout = QHBoxLayout()
+        button_layout.addWidget(self.btn_up)
+        button_layout.addWidget(self.btn_down)
+        button_layout.addWidget(self.btn_cancel)
+        button_layout.addWidget(self.btn_clear)
+        button_layout.addStretch()
+        button_layout.addWidget(self.summary_label)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.list)
+        layout.addLayout(button_layout)
+        self.setLayout(layout)
+        self.list.setMaximumHeight(120)
+
+        self.refresh()
+
+    def selected_job(self):
+        item = self.list.currentItem()
+        return item.data(Qt.UserRole) if item is not None else None
+
+    def move_selected(self, offset):
+        job = self.selected_job()
+        if job is not None and self.queue.move(job, offset):
+            self.refresh()
+
+    def cancel_selected(self):
+        job = self.selected_job()
+        if job is None:
+            return
+        if job.status == "running":
+            self.cancel_signal.emit(job)
+        elif job.status == "pending":
+            job.status = "cancelled"
+        else:
+            self.queue.remove(job)
+        self.refresh()
+
+    def clear_done(self):
+        self.queue.clear_done()
+        self.refresh()
+
+    def update_buttons(self):
+        job = self.selected_job()
+        pending = job is not None and job.status == "pending"
+        self.btn_up.setEnabled(pending)
+        self.btn_down.setEnabled(pending)
+        self.btn_cancel.setEnabled(job is not None)
+        self.btn_cancel.setText("Remove Job" if job is not None and job.status not in ("pending", "running")
+                                else "Cancel Job")
+
+    def refresh(self):
+        selected = self.selected_job()
+        self.list.clear()
+        for job in self.queue.jobs:
+            status = job.status.capitalize()
+            if job.status == "running":
+                status += " %d%%" % job.progress
+            item = QListWidgetItem("%s: %s" % (status, job.describe()))
+            item.setData(Qt.UserRole, job)
+            self.list.addItem(item)
+            if job is selected:
+                self.list.setCurrentItem(item)
+        self.update_buttons()
+        self.update_summary()
+
+    def update_summary(self):
+        n_remaining = len(self.queue.get_pending()) + (self.queue.get_running() is not None)
+        if n_remaining == 0:
+            self.summary_label.setText("No jobs waiting")
+            return
+        eta = self.queue.get_eta()
+        eta = format_eta(eta) if eta is not None else "estimating..."
+        self.summary_label.setText("%d job(s) remaining, ETA %s" % (n_remaining, eta))
+
+    def update_job(self, job):
+        # progress update of a single job, cheaper than rebuilding the list
+        index = self.queue.jobs.index(job) if job in self.queue.jobs else -1
+        if index >= 0 and index < self.list.count():
+            self.list.item(index).setText("%s %d%%: %s" % (job.status.capitalize(), job.progress, job.describe()))
+        self.update_summary()
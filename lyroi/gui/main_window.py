@@ -3,18 +3,20 @@ from PyQt5.QtWidgets import (
     QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
     QPushButton, QLabel, QLineEdit, QTextEdit,
     QFileDialog, QComboBox, QRadioButton, QGroupBox,
-    QMessageBox, QProgressBar, QGridLayout, QSizePolicy, QAction, QStyle
+    QMessageBox, QProgressBar, QGridLayout, QSizePolicy, QAction, QStyle, QCheckBox
 )
 from PyQt5.QtCore import Qt, QTimer, QThread, QEventLoop
 
 from lyroi.devices import DeviceManager
-from lyroi.gui.worker import CommandWorker, PyWorker
+from lyroi.gui.worker import CommandWorker, BackendWorker, PyWorker
+from lyroi.backend import InferenceBackend
 from lyroi.gui.model_manager import ModelManager
 from lyroi.gui.settings import Settings
 from lyroi.gui.utils import visualize_grid, set_property_and_update, set_ui_scale
 from lyroi.gui.components import LoadingOverlay, DirectoryDialog, FileSelector, DualProgressBar
+from lyroi.gui.job_queue import Job, JobQueue, QueuePanel
 
-from lyroi import __legal__
+import lyroi
 
 
 class MainWindow(QMainWindow):
@@ -32,6 +34,12 @@ class MainWindow(QMainWindow):
 
         self.worker = None
         self.gui_tasks = []
+        # persistent inference process, keeps the networks of the selected mode loaded between jobs
+        self.backend = InferenceBackend()
+        # prediction jobs are executed back-to-back by the backend
+        self.queue = JobQueue()
+        self.current_job = None
+        self.queue_running = False
 
         self.define_styles()
         self.init_ui()
@@ -89,7 +97,7 @@ class MainWindow(QMainWindow):
 
         def show_about():
             QMessageBox.about(self, "About",
-                              __legal__)
+                              lyroi.__legal__)
 
         # Help
         help_menu = self.menuBar().addMenu("&Help")
@@ -186,6 +194,7 @@ class MainWindow(QMainWindow):
         self.model_dropdown.currentIndexChanged.connect(self.update_online_version)
         self.model_dropdown.currentIndexChanged.connect(self.update_notes)
         self.model_dropdown.currentIndexChanged.connect(self.update_inputs_visibility)
+        self.model_dropdown.currentIndexChanged.connect(self.preload_backend)
 
 
         model_version_layout = QGridLayout()
@@ -210,7 +219,11 @@ class MainWindow(QMainWindow):
         # -------- Run Section -------- #
         run_layout = QHBoxLayout()
         self.btn_run = QPushButton("Run")
+        self.btn_enqueue = QPushButton("Add to Queue")
         self.btn_stop = QPushButton("Stop")
+        self.preview_checkbox = QCheckBox("Quick preview")
+        self.preview_checkbox.setToolTip("Write a quick preview result with a single model first, which is replaced "
+                                         "by the full ensemble result when it is finished")
         self.device_label = QLabel("Select device")
         self.device_dropdown = QComboBox()
         self.device_status_label = QLabel("")
@@ -225,11 +238,14 @@ class MainWindow(QMainWindow):
         self.device_label.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
 
         self.btn_run.clicked.connect(self.start_prediction)
+        self.btn_enqueue.clicked.connect(self.enqueue_prediction)
         self.btn_stop.clicked.connect(self.stop_command)
         self.device_dropdown.currentIndexChanged.connect(self.update_device_availability)
 
         run_layout.addWidget(self.btn_run)
+        run_layout.addWidget(self.btn_enqueue)
         run_layout.addWidget(self.btn_stop)
+        run_layout.addWidget(self.preview_checkbox)
         run_layout.addWidget(QWidget())
         run_layout.addWidget(self.device_label)
         run_layout.addWidget(self.device_dropdown)
@@ -241,6 +257,11 @@ class MainWindow(QMainWindow):
         self.progress_bar = DualProgressBar(self)
         layout.addWidget(self.progress_bar)
 
+        # -------- Queue -------- #
+        self.queue_panel = QueuePanel(self.queue, self)
+        self.queue_panel.cancel_signal.connect(self.cancel_job)
+        layout.addWidget(self.queue_panel)
+
         # -------- Console -------- #
         self.console = QTextEdit()
         self.console.setReadOnly(True)
@@ -268,11 +289,13 @@ class MainWindow(QMainWindow):
     def set_active_state(self):
         self.btn_run.setEnabled(False)
         self.btn_stop.setEnabled(True)
+        self.btn_install.setEnabled(False)
         self.progress_bar.set_active()
 
     def set_idle_state(self, deactivate_progress = True):
         self.btn_run.setEnabled(True)
         self.btn_stop.setEnabled(False)
+        self.btn_install.setEnabled(True)
         if deactivate_progress:
             self.progress_bar.set_inactive()
 
@@ -336,11 +359,13 @@ class MainWindow(QMainWindow):
         pretty_name = self.model_manager.get_pretty_name(model)
         self.console.clear()
         self.console.append("Installing models for " + pretty_name + " mode\n")
+        self.backend.stop()  # release the loaded models before they are replaced
         self.worker = CommandWorker(
             ["lyroi_install", "--mode", model, "-y", "-f"])
         self.connect_worker()
         self.worker.set_n_models(self.model_manager.get_n_archives(model))
         self.worker.finished_signal.connect(self.update_installed_version) # extra connection specific for install
+        self.worker.finished_signal.connect(self.preload_backend)
         self.worker.start()
         self.set_active_state()
 
@@ -381,6 +406,7 @@ class MainWindow(QMainWindow):
             if is_available:
                 self.device_status_label.setText("Status: Available")
                 set_property_and_update(self.device_status_label, "status", "good")
+                self.preload_backend()
             else:
                 set_property_and_update(self.device_status_label, "status", "bad")
                 self.device_status_label.setText("Status: Not Available")
@@ -397,20 +423,52 @@ class MainWindow(QMainWindow):
 
     # ---------------- Run Logic ---------------- #
 
-    def start_prediction(self):
+    def create_job(self):
         model = self.model_dropdown.currentData()
         device = self.device_dropdown.currentData()
-        if not self.validate_fields():
+        if not self.validate_fields() or device is None:
+            return None
+        if self.radio_batch.isChecked():
+            input_files = [self.batch_input.line_edit.text()]
+            output = self.batch_output.line_edit.text()
+        else:
+            pet = self.pet_file.line_edit.text() if self.pet_file.is_visible() else None
+            ct = self.ct_file.line_edit.text() if self.ct_file.is_visible() else None
+            input_files = [f for f in [ct, pet] if f is not None]
+            output = self.output_file.line_edit.text()
+        return Job(input_files, output, model, device, preview=self.preview_checkbox.isChecked())
+
+    def enqueue_prediction(self):
+        job = self.create_job()
+        if job is None:
+            return False
+        self.queue.add(job)
+        self.queue_panel.refresh()
+        self.console.append("Added to queue: " + job.describe())
+        return True
+
+    def start_prediction(self):
+        # runs the queued jobs, or the job defined by the input fields if nothing is queued
+        if self.queue.next_pending() is None and not self.enqueue_prediction():
             return False
 
         self.console.clear()
-        self.console.append("Starting prediction with model " + model)
+        self.queue_running = True
+        self.start_next_job()
+        return True
+
+    def start_next_job(self):
+        job = self.queue.next_pending()
+        if job is None:
+            self.queue_running = False
+            return False
+
+        self.console.append("Starting prediction with model " + job.mode)
 
         font_metrics = QFontMetrics(self.console.font())
 
-        if self.radio_batch.isChecked():
-            input_dir = self.batch_input.line_edit.text()
-            output_dir = self.batch_output.line_edit.text()
+        if job.batch:
+            input_dir, output_dir = job.input_files[0], job.output
 
             tab_width = font_metrics.horizontalAdvance("Output directory:") + 15
             self.console.insertHtml(f"""
@@ -421,46 +479,67 @@ class MainWindow(QMainWindow):
                 <br>
             """)
 
-            cmd = [
-                "lyroi",
-                "-i", input_dir,
-                "-o", output_dir,
-                "--mode", model,
-                "--device", device
-            ]
-
         else:
-            pet = self.pet_file.line_edit.text() if self.pet_file.is_visible() else None
-            ct = self.ct_file.line_edit.text() if self.ct_file.is_visible() else None
-            output_file = self.output_file.line_edit.text()
-
             tab_width = font_metrics.horizontalAdvance("Output file:") + 15
+            inputs = [name for name in ["CT", "PET"] if name in self.model_manager.get_inputs(job.mode)]
+            rows = "".join(f"<tr><td width=\"{tab_width}\">{name} file:</td><td>{f}</td></tr>"
+                           for name, f in zip(inputs, job.input_files))
             self.console.insertHtml(f"""
                 <table width="100%" cellpadding="2">
-                    <tr><td width="{tab_width}">CT file:</td><td>{ct}</td></tr>
-                    <tr><td width="{tab_width}">PET file:</td><td>{pet}</td></tr>
-                    <tr><td width="{tab_width}">Output file:</td><td>{output_file}</td></tr>
+                    {rows}
+                    <tr><td width="{tab_width}">Output file:</td><td>{job.output}</td></tr>
                 </table>
                 <br>
             """)
 
-            cmd = [
-                "lyroi",
-                "-i", ct, pet,
-                "-o", output_file,
-                "--mode", model,
-                "--device", device
-            ]
-
-        n_folds = self.model_manager.get_n_folds(model)
-        self.worker = CommandWorker(cmd, n_folds = n_folds)
+        self.current_job = job
+        job.start()
+        self.worker = BackendWorker(self.backend, job.input_files, job.output, job.mode, job.device, job.preview)
         self.connect_worker()
+        self.worker.progress_total_signal.connect(self.update_job_progress)
+        self.worker.eta_signal.connect(self.update_job_eta)
         self.worker.start()
         self.set_active_state()
+        self.queue_panel.refresh()
 
         return True
 
+    def update_job_progress(self, progress):
+        if self.current_job is not None:
+            self.current_job.progress = progress
+            self.queue_panel.update_job(self.current_job)
+
+    def update_job_eta(self, eta):
+        if self.current_job is not None:
+            self.current_job.eta = eta
+
+    def cancel_job(self, job):
+        # cancels only the running job, the queue continues with the next one
+        if job is self.current_job and self.worker:
+            self.console.append("Cancelling the current job")
+            self.worker.stop()
+
+    def preload_backend(self):
+        # load the networks of the selected mode and device in the background, before the user starts a job
+        model = self.model_dropdown.currentData()
+        device = self.device_dropdown.currentData()
+        if model is None or device is None or self.worker is not None:
+            return
+        if not self.device_manager.has_availability(device) or not self.device_manager.is_available(device):
+            return
+        if not self.model_manager.is_installed(model):
+            return
+        self.backend.preload(model, device)
+
+    def closeEvent(self, event):
+        if self.worker:
+            self.worker.stop()
+        self.backend.stop()
+        super().closeEvent(event)
+
     def stop_command(self):
+        # stops the running job and pauses the queue. Run continues with the remaining jobs
+        self.queue_running = False
         if self.worker:
             self.console.append("Stop requested")
             self.console.repaint()
@@ -469,8 +548,16 @@ class MainWindow(QMainWindow):
 
     def finish_handler(self):
         is_terminated = self.worker.get_error_status()
+        self.worker.wait()  # the thread must not be destroyed before run() returned, the next job replaces it
+        if self.current_job is not None:
+            self.current_job.finish(self.worker.get_status() or "failed")
+            self.current_job = None
         self.worker = None
         self.console.append("\nFinished.\n")
+        if self.queue_running and self.start_next_job():
+            return
+        self.queue_running = False
+        self.queue_panel.refresh()
         self.set_idle_state(is_terminated)
 
     def connect_worker(self):
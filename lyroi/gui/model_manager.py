@@ -27,6 +27,9 @@ class ModelManager:
         suffixes = get_suffix_dict(model)
         return suffixes.keys()
 
+    def is_installed(self, model):
+        return check_model(model)
+
     def get_installed_version(self, model):
         if not check_model(model):
             return "Not installed"
@@ -1,5 +1,4 @@
 import os
-import re
 import signal
 import subprocess
 import sys
@@ -7,6 +6,8 @@ import time
 
 from PyQt5.QtCore import QThread, pyqtSignal, QObject, pyqtSlot
 
+from lyroi.progress import ProgressParser, ProgressEventParser
+
 
 # Only for Windows
 def send_ctrl_break(pid):
@@ -27,23 +28,12 @@ class CommandWorker(QThread):
     progress_signal = pyqtSignal(int)
     progress_total_signal = pyqtSignal(int)
 
-    tqdm_re = re.compile(r"(\d+)%\|")
-    cases_re = re.compile(r"There are (\d+) cases in the source folder")
-    models_re = re.compile(r"Predicting with model (\d+)/(\d+)")
-    download_re = re.compile("Downloading pretrained model from url:")
-
     def __init__(self, command, n_folds=1):
         super().__init__()
         self.command = command
         self.process = None
         self.error_status = False
-        self._in_tqdm = False
-        self._current_fold = 0
-        self._current_case = -1
-        self._current_model = -1
-        self.n_cases = 1
-        self.n_models = 1
-        self.n_folds = n_folds
+        self.parser = ProgressParser(n_folds)
 
     def run(self):
         safe_command = [str(x) for x in self.command]
@@ -89,77 +79,19 @@ class CommandWorker(QThread):
         self.finished_signal.emit()
 
     def handle_output(self, text: str):
-        text = text.rstrip("\n")
-
-        # matching percent indication
-        match = self.tqdm_re.search(text)
-        if match:
-            if not self._in_tqdm:
-                self.output_signal.emit("Task in progress...\n")
-                self._current_case += 1  # increment case counter of tqdm loop start
-            self._in_tqdm = True
-            self.progress_signal.emit(self.task_progress(match.group(1)))
-            self.progress_total_signal.emit(self.total_progress(match.group(1)))
-            return  # DO NOT send tqdm lines to console
-
-        # skip empty lines in tqdm loop and track the current fold
-        if self._in_tqdm and text.strip() == "":
-            self._current_fold += 1
-            return
-
-        # tdqm loop is over. Reset
-        self._current_fold = 0
-        self._in_tqdm = False
-
-        ### prediction parsing
-        # matching case count
-        match = self.cases_re.search(text)
-        if match:
-            self.set_n_cases(match.group(1))
-            self._current_case = -1  # will become 0 as soon as the first tqdm line is received
-
-        # matching model count
-        match = self.models_re.search(text)
-        if match:
-            self.set_current_model(match.group(1))
-            self.set_n_models(match.group(2))
-
-        ### installation parsing
-        match = self.download_re.search(text)
-        if match:
-            self._current_model += 1
-            self._current_case = -1
-
-        # everything else goes to console
-        self.output_signal.emit(text)
-
-    def set_n_cases(self, n_cases):
-        n_cases = int(n_cases)
-        self.n_cases = n_cases
+        output, progress = self.parser.parse(text)
+        if output is not None:
+            self.output_signal.emit(output)
+        if progress is not None:
+            self.progress_signal.emit(progress[0])
+            self.progress_total_signal.emit(progress[1])
 
     def set_n_models(self, n_models):
-        n_models = int(n_models)
-        self.n_models = n_models
-
-    def set_current_model(self, index):
-        index = int(index)
-        index = index - 1
-        self._current_model = index
+        self.parser.set_n_models(n_models)
 
     def get_error_status(self):
         return self.error_status
 
-    def task_progress(self, percent):
-        percent = int(percent)
-        percent = (100 * self._current_fold + percent) / self.n_folds
-        return round(percent)
-
-    def total_progress(self, percent):
-        percent = self.task_progress(percent)  # taking care of folds
-        percent = (100 * self._current_case + percent) / self.n_cases  # taking care of cases
-        percent = (100 * self._current_model + percent) / self.n_models  # taking care of models
-        return round(percent)
-
     def term_process(self):
         if os.name == "nt":
             # Windows
@@ -193,6 +125,80 @@ class CommandWorker(QThread):
                     self.process.kill()
 
 
+class BackendWorker(QThread):
+    # runs one job in the persistent inference backend. Same signals as CommandWorker
+    output_signal = pyqtSignal(str)
+    finished_signal = pyqtSignal()
+    progress_signal = pyqtSignal(int)
+    progress_total_signal = pyqtSignal(int)
+    eta_signal = pyqtSignal(float)
+
+    # seconds until a backend that does not react to the cancellation is restarted. The backend stops at the next case
+    # or fold, which can take a while on the CPU
+    cancel_timeout = 120
+
+    def __init__(self, backend, input_files, output, mode, device, preview=False):
+        super().__init__()
+        self.backend = backend
+        self.job = (input_files, output, mode, device, preview)
+        self.error_status = False
+        self.status = None
+        self.event_parser = ProgressEventParser()
+        self._cancel_time = None
+
+    def run(self):
+        self.progress_signal.emit(0)
+        self.progress_total_signal.emit(0)
+        try:
+            self.backend.submit(*self.job)
+        except Exception as e:
+            self.output_signal.emit("Error: " + e.__str__())
+            self.error_status = True
+            self.status = "failed"
+            self.finished_signal.emit()
+            return
+
+        while True:
+            message = self.backend.receive()
+            if message is None:
+                if self._cancel_time is not None and time.time() - self._cancel_time > self.cancel_timeout:
+                    self.output_signal.emit("The backend does not respond, restarting it")
+                    self.backend.kill()
+                    self.status = "cancelled"
+                    break
+                continue
+            kind, value = message
+            if kind == "output":
+                self.output_signal.emit(value)
+            elif kind == "preload_failed":
+                # the job loads the models itself and reports the error again if it persists
+                self.output_signal.emit("Preloading the models failed: " + value)
+            elif kind == "progress":
+                progress = self.event_parser.parse(value)
+                if progress is not None:
+                    self.progress_signal.emit(progress[0])
+                    self.progress_total_signal.emit(progress[1])
+                    if self.event_parser.eta is not None:
+                        self.eta_signal.emit(self.event_parser.eta)
+            elif kind == "finished":
+                self.error_status = self.error_status or value != "finished"
+                self.status = value
+                break
+        self.finished_signal.emit()
+
+    def get_error_status(self):
+        return self.error_status
+
+    def get_status(self):
+        # finished, failed or cancelled
+        return self.status
+
+    def stop(self):
+        self.error_status = True
+        self._cancel_time = time.time()
+        self.backend.cancel()
+
+
 class PyWorker(QObject):
     finished = pyqtSignal()
     result = pyqtSignal(object)
@@ -2,25 +2,36 @@ import time
 import nibabel as nib
 import numpy as np
 
-from lyroi.utils import get_tmp_dir, validate_extensions, format_time, clean_temp_dir, delete_dir
+from lyroi.utils import (create_run_dir, release_run_dir, validate_extensions, format_time, clean_temp_dir, delete_dir,
+                         load_profile, update_profile, format_file_size, get_scratch_dir, get_model_root)
+from lyroi.memory import load_plan_info, estimate_case_memory, estimate_peak, schedule_cases, estimate_scratch_size
 from lyroi.modes import get_model_folders, get_folds, get_suffixes
-from lyroi.nnunet_interface import nnunet_predict, get_torch_device
+from lyroi.placement import describe_placement
+from lyroi.events import emit, stage, add_listener, remove_listener, check_cancelled
+from lyroi.telemetry import ResourceSampler
 from pathlib import Path
-from shutil import move
+from shutil import move, disk_usage
 
-def merge_delineations(input_folders, output_folder, strategy="u", force = True):
+def merge_delineations(input_folders, output_folder, strategy="u", force = True, allow_missing=False):
+    # with allow_missing, cases that left the ensemble early (see predict_from_folder) may be missing in all but the
+    # first folder. They are merged from the available delineations
     assert strategy in ["u", "i", "m"], "Invalid merging strategy"
 
     input_files = [list(Path(input_dir).glob("*.nii.gz")) for input_dir in input_folders]
-    assert len(set([len(l) for l in input_files])) == 1, "Number of images in the submodel output folders do not match. Something went wrong with the predictions"
+    if not allow_missing:
+        assert len(set([len(l) for l in input_files])) == 1, "Number of images in the submodel output folders do not match. Something went wrong with the predictions"
 
     input_basenames = [[input_file.name for input_file in input_folder] for input_folder in input_files]
     __ = [input_dir.sort() for input_dir in input_basenames]  # sort lists
-    assert input_basenames.count(input_basenames[0]) == len(input_basenames), "Files in the submodel output folders do not match. Something went wrong with the predictions"
+    if allow_missing:
+        assert all(set(names) <= set(input_basenames[0]) for names in input_basenames), "Files in the submodel output folders do not match. Something went wrong with the predictions"
+    else:
+        assert input_basenames.count(input_basenames[0]) == len(input_basenames), "Files in the submodel output folders do not match. Something went wrong with the predictions"
 
     for file_name in input_basenames[0]:
-        files_in = [Path(input_dir, file_name) for input_dir in input_folders]
+        files_in = [Path(input_dir, file_name) for input_dir in input_folders if Path(input_dir, file_name).exists()]
         file_out = Path(output_folder, file_name)
+        case_id = file_name.removesuffix(".nii.gz")
 
         if file_out.exists():
             if force:
@@ -30,20 +41,24 @@ def merge_delineations(input_folders, output_folder, strategy="u", force = True)
 
         if len(files_in) == 1:
             # no need to merge anything. Just move files
-            move(files_in[0], file_out)
+            with stage("write", case=case_id):
+                move(files_in[0], file_out)
         else:
             # okay, now we actually need to read files and save results
-            imgs_in = [nib.load(file) for file in files_in]
-            vols_in = [nifti.get_fdata() for nifti in imgs_in]
-
-            if strategy == "u":
-                result = np.logical_or.reduce(vols_in)
-            if strategy == "i":
-                result = np.logical_and.reduce(vols_in)
-            if strategy == "m":
-                result = np.average(vols_in, axis=0) > 0.5
-            nifti_out = nib.Nifti1Image(result.astype(np.uint8), affine=imgs_in[0].affine, header=imgs_in[0].header)
-            nib.save(nifti_out, file_out)
+            with stage("merge", case=case_id):
+                imgs_in = [nib.load(file) for file in files_in]
+                vols_in = [nifti.get_fdata() for nifti in imgs_in]
+
+                if strategy == "u":
+                    result = np.logical_or.reduce(vols_in)
+                if strategy == "i":
+                    result = np.logical_and.reduce(vols_in)
+                if strategy == "m":
+                    result = np.average(vols_in, axis=0) > 0.5
+            with stage("write", case=case_id):
+                nifti_out = nib.Nifti1Image(result.astype(np.uint8), affine=imgs_in[0].affine, header=imgs_in[0].header)
+                nib.save(nifti_out, file_out)
+        emit("case_complete", case=case_id)
 
 def check_inputs(input_folder, mode):
     suffixes = get_suffixes(mode)
@@ -62,6 +77,48 @@ def check_inputs(input_folder, mode):
         names = "\n".join(unpaired)
         exit("Cannot proceed, the following patients are missing either CT or PET:\n" + names)
 
+def get_cases(input_folder, mode):
+    suffixes = get_suffixes(mode)
+    cases = {}
+    for file in sorted(Path(input_folder).glob("*" + suffixes[0] + ".nii.gz")):
+        case_id = file.name.removesuffix(suffixes[0] + ".nii.gz")
+        cases[case_id] = [str(Path(input_folder, case_id + suffix + ".nii.gz")) for suffix in suffixes]
+    return cases
+
+def schedule_batches(cases, model_folders, max_memory, max_preprocessing, max_export):
+    plan_infos = [load_plan_info(folder) for folder in model_folders]
+    case_estimates = {}
+    for case_id, files in cases.items():
+        # plans are run one after another, so the most demanding plan defines the case footprint
+        estimates = [estimate_case_memory(files, plan_info) for plan_info in plan_infos]
+        case_estimates[case_id] = {key: max(e[key] for e in estimates) for key in estimates[0]}
+    batches = schedule_cases(case_estimates, max_memory, max_preprocessing, max_export, len(model_folders))
+    return batches, case_estimates
+
+def get_run_dir(output_folder, mode, run_id, cases, model_folders, scratch=None, out_of_core="auto",
+                preview_folder=None):
+    # temporary directory of the run, in the scratch directory if it has enough free space for the intermediates,
+    # including the preprocessing cache (see get_preprocessing_caches). Only the final delineations are written to the
+    # output folder then
+    scratch = get_scratch_dir(scratch)
+    if scratch is not None:
+        Path(scratch).mkdir(exist_ok=True, parents=True)
+        plan_infos = [load_plan_info(folder) for folder in model_folders]
+        # one cache per shared fingerprint
+        cached_plan_infos = {fingerprint: load_plan_info(folder)
+                             for folder, fingerprint in get_shared_fingerprints(model_folders, preview_folder).items()
+                             if fingerprint is not None}
+        estimates = [estimate_scratch_size(files, plan_infos, out_of_core, list(cached_plan_infos.values()))
+                     for files in cases.values()]
+        required = sum(e["masks"] + e["preprocessed"] for e in estimates) + \
+            max([e["logits"] for e in estimates], default=0)
+        free = disk_usage(scratch).free
+        if required < free:
+            return create_run_dir(output_folder, mode, run_id, scratch)
+        print(f"Not enough free space in the scratch directory {scratch} ({format_file_size(required)} estimated, "
+              f"{format_file_size(free)} free). Intermediate results are stored in the output folder")
+    return create_run_dir(output_folder, mode, run_id)
+
 def transfer_input_files(input_files, target_folder, mode, pname = 'patient_001'):
     suffixes = get_suffixes(mode)
     n_channels = len(suffixes)
@@ -74,26 +131,253 @@ def transfer_output_files(input_folder, output_file, pname = 'patient_001'):
     Path(output_file).unlink(missing_ok=True)
     move(Path(input_folder, pname + ".nii.gz"), output_file)
 
-def predict_from_folder(input_folder, output_folder, mode, device='gpu', progress_bar=True):
+def preload_models(mode, device='gpu'):
+    # loads the networks of all models of the mode into the predictor cache and starts the worker pools, so that
+    # subsequent predictions in this process skip the model loading. Models of other modes and devices are released
+    from lyroi.nnunet_interface import (get_predictor, get_predictor_key, clear_predictor_cache, get_torch_device,
+                                        start_worker_pools)
+    profile = load_profile(device)
+    torch_device = get_torch_device(device, profile.get("torch_threads"))
+    folds = get_folds(mode)
+    model_folders = get_model_folders(mode)
+    keys = [get_predictor_key(folder, folds, torch_device) for folder in model_folders]
+    clear_predictor_cache(keep=keys)
+    for folder in model_folders:
+        get_predictor(folder, folds, torch_device, cache=True)
+    start_worker_pools({"preprocessing": profile.get("num_processes_preprocessing", 3),
+                        "export": profile.get("num_processes_segmentation_export", 3)})
+
+def get_timing_key(tta, validate_tta, cascade):
+    # settings that change the sliding window time of the plans. The device is the key of the profile
+    return f"tta={tta},validate_tta={validate_tta},cascade={cascade}"
+
+def get_plan_order(model_folders, folds, plan_seconds=None):
+    # fastest plans first, estimated from the sliding window time per case that earlier runs with the same settings
+    # measured for every plan (see save_plan_seconds). Without measurements for all plans, the size of their checkpoints
+    # is a rough stand-in
+    plan_seconds = plan_seconds or {}
+    if all(Path(folder).name in plan_seconds for folder in model_folders):
+        return sorted(model_folders, key=lambda folder: plan_seconds[Path(folder).name])
+
+    def get_size(folder):
+        return sum(checkpoint.stat().st_size for fold in folds
+                   for checkpoint in [Path(folder, f"fold_{fold}", "checkpoint_final.pth")] if checkpoint.exists())
+    return sorted(model_folders, key=get_size)
+
+def save_plan_seconds(device, key, sliding_window_seconds):
+    # mean sliding window time per case and plan of this run, used to order the plans of later runs with the same
+    # settings (key, see get_timing_key)
+    def update(profile):
+        plan_seconds = profile.get("plan_seconds", {})
+        for plan, seconds in sliding_window_seconds.items():
+            if len(seconds) > 0:
+                plan_seconds.setdefault(key, {})[plan] = round(sum(seconds.values()) / len(seconds), 3)
+        return {**profile, "plan_seconds": plan_seconds}
+
+    try:
+        update_profile(device, update)
+    except TimeoutError as e:
+        print("The plan timings were not stored:", e)
+
+def get_added_volume(mask_files, new_file):
+    # volume in ml that the mask in new_file adds to the union of the masks in mask_files
+    new = nib.load(new_file)
+    union = np.logical_or.reduce([np.asarray(nib.load(file).dataobj) > 0 for file in mask_files])
+    added = np.count_nonzero((np.asarray(new.dataobj) > 0) & ~union)
+    return added * float(np.prod(new.header.get_zooms()[:3])) / 1000
+
+def get_preview_path(output):
+    # <name>_preview.nii.gz next to an output file, or the preview subfolder of an output folder
+    if str(output).endswith(".nii.gz"):
+        return Path(str(output).removesuffix(".nii.gz") + "_preview.nii.gz")
+    return Path(output, "preview")
+
+def get_shared_fingerprints(model_folders, preview_folder=None):
+    # preprocessing fingerprint of every model folder (including the model folder of the preview) that shares its
+    # preprocessing with another plan or the preview, None for the others
+    from lyroi.nnunet_interface import get_preprocessing_fingerprint
+    folders = list(model_folders) + ([preview_folder] if preview_folder is not None else [])
+    fingerprints = [get_preprocessing_fingerprint(folder) for folder in folders]
+    return {folder: fingerprint if fingerprints.count(fingerprint) > 1 else None
+            for folder, fingerprint in zip(folders, fingerprints)}
+
+def get_preprocessing_caches(model_folders, tmp_dir, preview_folder=None):
+    # cache folder for the preprocessed cases of every model folder, including the model folder of the preview. Plans
+    # with the same preprocessing fingerprint share one, plans whose preprocessing is not shared get None
+    return {folder: Path(tmp_dir, "preprocessed", fingerprint) if fingerprint is not None else None
+            for folder, fingerprint in get_shared_fingerprints(model_folders, preview_folder).items()}
+
+def is_on_scratch(tmp_dir, scratch=None):
+    # whether the run dir was created in the scratch directory rather than in the output folder
+    scratch = get_scratch_dir(scratch)
+    return scratch is not None and Path(tmp_dir).parent == Path(scratch)
+
+def predict_preview(input_folder, preview_folder, mode, model_folder, device, tmp_dir, progress_bar=True,
+                    start_time=None, preprocessing_cache=None):
+    # quick first result with the first model and fold only, replaced by the result of the full ensemble later
+    from lyroi.nnunet_interface import nnunet_predict, get_torch_device
+    if start_time is None:
+        start_time = time.time()
+    profile = load_profile(device)
+    torch_device = get_torch_device(device, profile.get("torch_threads"))
+    tmp_subdir = Path(tmp_dir, "preview")
+
+    check_cancelled()
+    print("Predicting preview with the first model and fold")
+    emit("preview_start", plan=Path(model_folder).name)
+    nnunet_predict(input_folder, tmp_subdir, model_folder, get_folds(mode), torch_device, progress_bar=progress_bar,
+                   num_processes_preprocessing=profile.get("num_processes_preprocessing", 3),
+                   num_processes_segmentation_export=profile.get("num_processes_segmentation_export", 3),
+                   scratch_dir=Path(tmp_dir, "scratch"), preview=True, preprocessing_cache=preprocessing_cache)
+    Path(preview_folder).mkdir(exist_ok=True, parents=True)
+    for file in tmp_subdir.glob("*.nii.gz"):
+        move(file, Path(preview_folder, file.name))
+    delete_dir(tmp_subdir)
+
+    seconds = time.time() - start_time
+    emit("preview_end", output=str(preview_folder), seconds=seconds)
+    return seconds
+
+def print_early_exit_summary(exited, n_cases, model_folders, case_seconds):
+    # the time of a skipped prediction is estimated from the mean time per case of the same model. Models that did not
+    # run at all get the mean of the last model that did: the models run in the order of their speed, so this is a
+    # lower bound
+    plans = [Path(folder).name for folder in model_folders]
+    mean_seconds = {}
+    for plan in plans:
+        if len(case_seconds.get(plan, {})) > 0:
+            mean_seconds[plan] = sum(case_seconds[plan].values()) / len(case_seconds[plan])
+        elif len(mean_seconds) > 0:
+            mean_seconds[plan] = list(mean_seconds.values())[-1]
+    n_skipped = sum(len(plans) - models for models in exited.values())
+    seconds = sum(mean_seconds.get(plan, 0) for models in exited.values() for plan in plans[models:])
+    print(f"Early exit for {len(exited)} of {n_cases} case(s): {n_skipped} of {n_cases * len(plans)} model "
+          f"prediction(s) skipped, about {format_time(seconds)} saved")
+    emit("early_exit_summary", cases=len(exited), skipped=n_skipped, predictions=n_cases * len(plans),
+         seconds=seconds)
+
+def predict_from_folder(input_folder, output_folder, mode, device='gpu', progress_bar=True, max_memory=None,
+                        out_of_core="auto", telemetry_file=None, preview=False, scratch=None, tta="full",
+                        validate_tta=False, cascade=None, early_exit=None, run_dir=None, model_root=None):
+    # run_dir: temporary directory of a run created (and released) by the caller, used instead of a new one. model_root:
+    # installation of the models resolved by the caller
+    # torch is only imported when a prediction is actually run
+    from lyroi.nnunet_interface import nnunet_predict, get_torch_device, remove_cached_case
     check_inputs(input_folder, mode)
 
-    model_folders = get_model_folders(mode)
+    # the installation is resolved once, so that an installation finishing during the run cannot mix model versions
+    model_root = get_model_root(mode) if model_root is None else model_root
+    model_folders = get_model_folders(mode, model_root)
+    preview_model_folder = model_folders[0]  # the preview always uses the first model, whatever the order of the run
     folds = get_folds(mode)
-    tmp_dir = get_tmp_dir(Path(output_folder), mode, input_folder)
-    delete_dir(tmp_dir)  # cleanup is some trash is left from previous similar runs
+    profile = load_profile(device)
+    timing_key = get_timing_key(tta, validate_tta, cascade)
+    if early_exit is not None:
+        # with the early exit, the fastest models go first
+        model_folders = get_plan_order(model_folders, folds, profile.get("plan_seconds", {}).get(timing_key))
     tmp_subdirs = []
 
     print("Starting predictions. Wait until all models finish prediction to see the results")
-    torch_device = get_torch_device(device)
+    torch_device = get_torch_device(device, profile.get("torch_threads"))
+    pools = (profile.get("num_processes_preprocessing", 3), profile.get("num_processes_segmentation_export", 3))
+
+    cases = get_cases(input_folder, mode)
+    if max_memory is None:
+        batches = [{"cases": None, "pools": pools}]  # the whole folder at once
+    else:
+        batches, case_estimates = schedule_batches(cases, model_folders, max_memory, *pools)
+        print(f"Memory budget: {format_file_size(max_memory)}, {len(cases)} cases in {len(batches)} batch(es)")
+
+    # one sampler for the telemetry and the measured peaks of the memory budget
+    sampler = None
+    if telemetry_file is not None or max_memory is not None:
+        sampler = ResourceSampler(torch_device).start()
+
     start_time = time.time()
+    emit("run_start", mode=mode, device=device, input=str(input_folder), output=str(output_folder),
+         plans=[Path(folder).name for folder in model_folders], folds=list(folds), pools=list(pools),
+         max_memory=max_memory, cases=len(cases), tta=tta, cascade=cascade, early_exit=early_exit)
+    tmp_dir = None
+    status = "failed"
+    # per plan and case: seconds spent, to estimate the compute saved by the early exit, and the sliding window seconds
+    # alone, to order the plans of later runs
+    case_seconds = {}
+    sliding_window_seconds = {}
+
+    def collect_seconds(event):
+        if (event["event"] == "stage" and event.get("case") is not None and event.get("plan") is not None
+                and not event.get("preview")):
+            for collected in [case_seconds] + ([sliding_window_seconds] if event["stage"] == "sliding_window" else []):
+                plan_seconds = collected.setdefault(event["plan"], {})
+                plan_seconds[event["case"]] = plan_seconds.get(event["case"], 0) + event["seconds"]
+
+    add_listener(collect_seconds)
     try:
+        tmp_dir = run_dir if run_dir is not None else \
+            get_run_dir(Path(output_folder), mode, input_folder, cases, model_folders, scratch, out_of_core,
+                        preview_model_folder if preview else None)
+        # the preprocessed cases are only cached on the scratch directory: in the output folder, often a network share,
+        # writing and reading them costs more than preprocessing them again
+        if is_on_scratch(tmp_dir, scratch):
+            caches = get_preprocessing_caches(model_folders, tmp_dir, preview_model_folder if preview else None)
+        else:
+            caches = {folder: None for folder in model_folders + [preview_model_folder]}
+        # the last plan that reads a cache removes the cases from it
+        last_readers = {cache: folder for folder in model_folders for cache in [caches[folder]] if cache is not None}
+        remaining = list(cases)  # cases that have not left the ensemble early
+        exited = {}
+        saved_seconds = 0
+        if preview:
+            time_to_preview = predict_preview(input_folder, get_preview_path(output_folder), mode,
+                                              preview_model_folder, device, tmp_dir, progress_bar=progress_bar,
+                                              start_time=start_time,
+                                              preprocessing_cache=caches[preview_model_folder])
+            print("Preview written to " + str(get_preview_path(output_folder)) + " after " +
+                  format_time(time_to_preview))
+
         counter = 0
         for folder in model_folders:
+            if early_exit is not None and len(remaining) == 0:
+                break  # all cases left the ensemble early
             counter += 1
             print(f"Predicting with model {counter}/{len(model_folders)}")
             tmp_subdir = Path(tmp_dir, Path(folder).stem)
             tmp_subdirs.append(tmp_subdir)
-            nnunet_predict(input_folder, tmp_subdir, folder, folds, torch_device, progress_bar=progress_bar)
+            check_cancelled()
+            emit("plan_start", plan=Path(folder).name)
+            for batch in batches:
+                batch_cases = [c for c in (cases if batch["cases"] is None else batch["cases"]) if c in remaining]
+                if len(batch_cases) == 0:
+                    continue
+                if batch["cases"] is None and len(batch_cases) == len(cases):
+                    inputs = input_folder
+                else:
+                    inputs = [cases[c] for c in batch_cases]
+                saved_seconds += nnunet_predict(inputs, tmp_subdir, folder, folds, torch_device,
+                                                progress_bar=progress_bar,
+                                                num_processes_preprocessing=batch["pools"][0],
+                                                num_processes_segmentation_export=batch["pools"][1],
+                                                out_of_core=out_of_core, scratch_dir=Path(tmp_dir, "scratch"),
+                                                preprocessing_cache=caches[folder],
+                                                release_cache=last_readers.get(caches[folder]) == folder, tta=tta,
+                                                validate_tta=validate_tta, cascade=cascade)
+            emit("plan_end", plan=Path(folder).name)
+
+            # early exit: the case leaves the ensemble once the last model adds at most early_exit ml to the union of
+            # the masks of the models before it
+            if early_exit is not None and 1 < counter < len(model_folders):
+                for case_id in list(remaining):
+                    added = get_added_volume([Path(d, case_id + ".nii.gz") for d in tmp_subdirs[:-1]],
+                                             Path(tmp_subdir, case_id + ".nii.gz"))
+                    if added <= early_exit:
+                        remaining.remove(case_id)
+                        exited[case_id] = counter
+                        for cache in set(last_readers):
+                            remove_cached_case(cache, case_id)
+                        skipped = [Path(f).name for f in model_folders[counter:]]
+                        print(f"Case {case_id}: model {counter} added {added:.2f} ml to the union, skipping "
+                              f"{len(skipped)} model(s)")
+                        emit("early_exit", case=case_id, models=counter, added_volume=added, skipped=skipped)
 
         # import multiprocessing as mp
         # mp.set_start_method("spawn", force=True)
@@ -115,34 +399,89 @@ def predict_from_folder(input_folder, output_folder, mode, device='gpu', progres
         # for p in procs:
         #     p.join()
         print("Merging delineations...")
-        merge_delineations(tmp_subdirs, output_folder)
+        merge_delineations(tmp_subdirs, output_folder, allow_missing=early_exit is not None)
+        if preview:
+            delete_dir(get_preview_path(output_folder))  # replaced by the final delineations
+            print("Time to first mask: " + format_time(time_to_preview))
         print("Execution time: " + format_time(time.time() - start_time))
+        if saved_seconds > 0:
+            print("Preprocessing time saved by sharing the preprocessed cases between models: " +
+                  format_time(saved_seconds))
+        if early_exit is not None:
+            print_early_exit_summary(exited, len(cases), model_folders, case_seconds)
+        if max_memory is not None:
+            # measured: peak of the process and its workers while the case was predicted or exported
+            case_stats = sampler.get_case_stats()
+            for batch in batches:
+                for case_id in batch["cases"]:
+                    estimated = estimate_peak(case_estimates[case_id], *batch["pools"], len(model_folders))
+                    measured = case_stats.get(case_id, {}).get("rss_peak", 0)
+                    print(f"Case {case_id}: estimated peak memory {format_file_size(estimated)}, "
+                          f"measured {format_file_size(measured)} (pools: {batch['pools'][0]} preprocessing, "
+                          f"{batch['pools'][1]} export, {len(batch['cases'])} case(s) in batch)")
+        print("CPU placement: " + describe_placement())
+        if early_exit is not None:
+            save_plan_seconds(device, timing_key, sliding_window_seconds)
+        if telemetry_file is not None:
+            sampler.stop()
+            sampler.print_summary()
+        status = "finished"
     except Exception as e:
         print("Execution halted: ", e.args[0])
         raise e
     finally:
+        remove_listener(collect_seconds)
+        emit("run_end", seconds=time.time() - start_time, status=status)
+        if sampler is not None:
+            sampler.stop()
+        if telemetry_file is not None:
+            sampler.write(telemetry_file)
         print("Cleaning up...")
-        delete_dir(tmp_dir)
+        if tmp_dir is not None and run_dir is None:
+            release_run_dir(tmp_dir)
 
-def predict_from_files(input_files, output_file, mode, device='gpu', progress_bar=True):
+def predict_from_files(input_files, output_file, mode, device='gpu', progress_bar=True, max_memory=None,
+                       out_of_core="auto", telemetry_file=None, preview=False, scratch=None, tta="full",
+                       validate_tta=False, cascade=None, early_exit=None):
     validate_extensions(input_files + [output_file], ".nii.gz")
 
     out_dir = Path(output_file).parent.absolute()
     assert out_dir.exists(), f"Output directory {out_dir} does not exist"
 
-    tmp_dir = get_tmp_dir(out_dir, mode, input_files)
-    delete_dir(tmp_dir) # cleanup is some trash is left from previous similar runs
-    tmp_input_dir = Path(tmp_dir, "input")
-    tmp_output_dir = Path(tmp_dir, "output")
+    tmp_dir = None
     try:
+        model_root = get_model_root(mode)
+        model_folders = get_model_folders(mode, model_root)
+        tmp_dir = get_run_dir(out_dir, mode, input_files, {"patient_001": input_files}, model_folders, scratch,
+                              out_of_core)
+        tmp_input_dir = Path(tmp_dir, "input")
+        tmp_output_dir = Path(tmp_dir, "output")
         tmp_input_dir.mkdir(exist_ok=True, parents=True)
         tmp_output_dir.mkdir(exist_ok=True, parents=True)
         transfer_input_files(input_files, tmp_input_dir, mode)
-        predict_from_folder(tmp_input_dir, tmp_output_dir, mode, device, progress_bar=progress_bar)
+        if preview:
+            start_time = time.time()
+            tmp_preview_dir = Path(tmp_dir, "preview_output")
+            time_to_preview = predict_preview(tmp_input_dir, tmp_preview_dir, mode, model_folders[0], device,
+                                              tmp_dir, progress_bar=progress_bar)
+            transfer_output_files(tmp_preview_dir, get_preview_path(output_file))
+            print("Preview written to " + str(get_preview_path(output_file)) + " after " +
+                  format_time(time_to_preview))
+        # the intermediates go to the temporary directory of this run, which already is on the scratch directory if
+        # it has enough space
+        predict_from_folder(tmp_input_dir, tmp_output_dir, mode, device, progress_bar=progress_bar,
+                            max_memory=max_memory, out_of_core=out_of_core, telemetry_file=telemetry_file,
+                            scratch=scratch, tta=tta, validate_tta=validate_tta, cascade=cascade,
+                            early_exit=early_exit, run_dir=tmp_dir, model_root=model_root)
         transfer_output_files(tmp_output_dir, output_file)
+        if preview:
+            get_preview_path(output_file).unlink(missing_ok=True)  # replaced by the final delineation
+            print("Time to first mask: " + format_time(time_to_preview) + ", total time: " +
+                  format_time(time.time() - start_time))
     except Exception as e:
         print("Execution halted: ", e.args[0])
         raise e
     finally:
         print("Final cleanup...")
-        delete_dir(tmp_dir)
+        if tmp_dir is not None:
+            release_run_dir(tmp_dir)
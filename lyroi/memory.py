@@ -0,0 +1,169 @@
+import json
+import re
+from pathlib import Path
+from typing import List, Dict
+
+import nibabel as nib
+import numpy as np
+import psutil
+
+from lyroi.utils import format_file_size
+
+# rough resident size of a process that has imported torch and nnU-Net
+PROCESS_OVERHEAD = 400 * 1024 ** 2
+# share of a checkpoint_final.pth file that is kept in memory as network weights. nnU-Net saves the fp32 weights with
+# the state of its SGD optimizer, whose momentum buffer has one entry per parameter, so the weights are about half of
+# the file. The remaining entries (grad scaler, training log) are small
+WEIGHTS_PER_CHECKPOINT = 0.5
+
+
+def parse_memory_size(size_str: str) -> int:
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*", size_str, re.IGNORECASE)
+    assert match, f"Cannot parse memory size '{size_str}'. Use e.g. 32G or 16000M"
+    power = " KMGT".index(match.group(2).upper() or " ")
+    return int(float(match.group(1)) * 1024 ** power)
+
+def read_image_info(image_file):
+    # only the header is read, no decompression of the image data
+    header = nib.load(image_file).header
+    return tuple(int(s) for s in header.get_data_shape()[:3]), tuple(float(z) for z in header.get_zooms()[:3])
+
+def get_configuration(plans, configuration, visited=()):
+    # resolves "inherits_from" like nnU-Net's PlansManager.get_configuration
+    assert configuration not in visited, f"Circular inheritance of the configurations {visited + (configuration,)}"
+    config = plans["configurations"][configuration]
+    if "inherits_from" in config:
+        config = {**get_configuration(plans, config["inherits_from"], visited + (configuration,)), **config}
+    return config
+
+def load_plan_info(model_folder, configuration="3d_fullres"):
+    plans = json.loads(Path(model_folder, "plans.json").read_text())
+    dataset = json.loads(Path(model_folder, "dataset.json").read_text())
+    config = get_configuration(plans, configuration)
+    checkpoints = list(Path(model_folder).glob("fold_*/checkpoint_final.pth"))
+    return {
+        "spacing": config["spacing"],
+        "patch_size": config["patch_size"],
+        "transpose_forward": plans["transpose_forward"],
+        "reverse_axes": "SimpleITK" in plans["image_reader_writer"],
+        "n_classes": len(dataset["labels"]),
+        "n_folds": len(checkpoints),
+        "checkpoint_size": max([c.stat().st_size for c in checkpoints], default=0),
+    }
+
+def get_resampled_shape(shape, spacing, plan_info):
+    if plan_info["reverse_axes"]:
+        # SimpleITK returns arrays in z, y, x order
+        shape, spacing = shape[::-1], spacing[::-1]
+    shape = [shape[i] for i in plan_info["transpose_forward"]]
+    spacing = [spacing[i] for i in plan_info["transpose_forward"]]
+    new_shape = [int(round(s * sp / tsp)) for s, sp, tsp in zip(shape, spacing, plan_info["spacing"])]
+    # sliding window pads the volume to at least one patch
+    return [max(s, p) for s, p in zip(new_shape, plan_info["patch_size"])]
+
+def estimate_case_memory(image_files: List[str], plan_info: dict) -> Dict[str, int]:
+    shape, spacing = read_image_info(image_files[0])
+    n_channels = len(image_files)
+    n_classes = plan_info["n_classes"]
+    voxels = int(np.prod(shape))
+    voxels_resampled = int(np.prod(get_resampled_shape(shape, spacing, plan_info)))
+
+    # preprocessing worker: original image (float32 copy during conversion) and the resampled result
+    preprocessing = n_channels * voxels * 4 * 2 + n_channels * voxels_resampled * 4
+    # main process: input tensor, fp16 logits and weights of the sliding window and the fold accumulator
+    prediction = n_channels * voxels_resampled * 4 + (2 * n_classes + 1) * voxels_resampled * 2
+    # export worker: logits resampled to the original grid in fp32, probabilities and segmentation
+    export = n_classes * voxels_resampled * 2 + 2 * n_classes * voxels * 4 + voxels
+    # queued items: one preprocessed case per preprocessing worker, up to two predictions waiting for export
+    queued_data = n_channels * voxels_resampled * 4
+    queued_logits = n_classes * voxels_resampled * 2
+    # network weights of all folds plus one complete checkpoint while it is being loaded
+    checkpoint_size = plan_info["checkpoint_size"]
+    model = int(plan_info["n_folds"] * checkpoint_size * WEIGHTS_PER_CHECKPOINT) + checkpoint_size
+    return {"preprocessing": preprocessing, "prediction": prediction, "export": export,
+            "queued_data": queued_data, "queued_logits": queued_logits, "model": model,
+            "merge": voxels * 8}
+
+def estimate_sliding_window_memory(data_shape, n_heads, patch_size, tta="full", validate_tta=False,
+                                   cascade=False) -> Dict[str, int]:
+    # data_shape is the shape of the preprocessed data (channels first)
+    voxels = int(np.prod([max(s, p) for s, p in zip(data_shape[1:], patch_size)]))
+    estimate = {"data": data_shape[0] * voxels * 4,
+                "logits": (n_heads + 1) * voxels * 2,  # fp16 logits and gaussian weights
+                "ensemble": 2 * n_heads * voxels * 2}  # fold accumulator and the logits of the current fold on cpu
+    if tta == "adaptive" or cascade:
+        # LyroiPredictor._predict_tiles: fp32 ensemble, fp16 logits of the current fold, fp32 weights with and
+        # without the mirrored tiles
+        estimate["logits"] = n_heads * voxels * 6 + voxels * 8
+        estimate["ensemble"] = 0
+        if tta == "adaptive":
+            # int16 segmentations of the first and the current fold, disagreement and uncertainty masks
+            estimate["logits"] += voxels * 6
+        if tta == "adaptive" and validate_tta:
+            # fp32 ensemble with full mirroring
+            estimate["logits"] += n_heads * voxels * 4
+        if cascade:
+            # fp16 logits of the coarse pass and the dilated candidates (fp32), always on the cpu
+            estimate["ensemble"] = n_heads * voxels * 2 + voxels * 4
+    return estimate
+
+def estimate_scratch_size(image_files: List[str], plan_infos: List[dict], out_of_core="auto",
+                          cached_plan_infos: List[dict] = ()) -> Dict[str, int]:
+    # disk space a case needs in the temporary directory: the segmentation of every plan (uint8, an upper bound for the
+    # compressed files, kept until the merge), the preprocessed data in the cache of every shared preprocessing
+    # fingerprint (fp32, one plan of each in cached_plan_infos) and the fp16 logits and fp32 weights if it is predicted
+    # out-of-core (only one case at a time)
+    shape, spacing = read_image_info(image_files[0])
+    masks = len(plan_infos) * int(np.prod(shape))
+    preprocessed = sum(len(image_files) * int(np.prod(get_resampled_shape(shape, spacing, plan_info))) * 4
+                       for plan_info in cached_plan_infos)
+    logits = 0
+    for plan_info in plan_infos:
+        resampled = get_resampled_shape(shape, spacing, plan_info)
+        voxels_resampled = int(np.prod(resampled))
+        estimate = estimate_sliding_window_memory((len(image_files), *resampled), plan_info["n_classes"],
+                                                  plan_info["patch_size"])
+        # same decision as the predictor, which falls back to disk if the case does not fit in main memory
+        if out_of_core == "on" or out_of_core == "auto" and \
+                sum(estimate.values()) >= 0.7 * psutil.virtual_memory().available:
+            logits = max(logits, (plan_info["n_classes"] * 2 + 4) * voxels_resampled)
+    return {"masks": masks, "preprocessed": preprocessed, "logits": logits}
+
+def estimate_peak(estimate: Dict[str, int], n_preprocessing: int, n_export: int, n_plans: int = 1) -> int:
+    peak = PROCESS_OVERHEAD * (1 + n_preprocessing + n_export)
+    peak += estimate["model"] + estimate["prediction"] + 2 * estimate["queued_logits"]
+    peak += n_preprocessing * (estimate["preprocessing"] + estimate["queued_data"])
+    peak += n_export * estimate["export"]
+    # merging happens after all predictions are done, so it only matters if it is larger than everything else
+    return max(peak, PROCESS_OVERHEAD + n_plans * estimate["merge"])
+
+def get_pool_sizes(estimate, budget, max_preprocessing, max_export, n_plans=1):
+    n_preprocessing, n_export = max_preprocessing, max_export
+    # shrink the larger pool first until the estimated peak fits into the budget
+    while estimate_peak(estimate, n_preprocessing, n_export, n_plans) > budget:
+        if n_preprocessing == 1 and n_export == 1:
+            return 1, 1, False
+        if n_export >= n_preprocessing and n_export > 1:
+            n_export -= 1
+        else:
+            n_preprocessing -= 1
+    return n_preprocessing, n_export, True
+
+def schedule_cases(case_estimates: Dict[str, Dict[str, int]], budget, max_preprocessing=3, max_export=3,
+                   n_plans=1):
+    # admission control: cases are processed in batches, each batch with pools sized for its largest case.
+    # Largest cases go first, so that small cases can use larger pools
+    order = sorted(case_estimates, key=lambda c: estimate_peak(case_estimates[c], 1, 1, n_plans), reverse=True)
+    batches = []
+    for case in order:
+        n_pre, n_exp, fits = get_pool_sizes(case_estimates[case], budget, max_preprocessing, max_export, n_plans)
+        if not fits:
+            print(f"Warning: case {case} is estimated to need "
+                  f"{format_file_size(estimate_peak(case_estimates[case], 1, 1, n_plans))} "
+                  f"which exceeds the memory budget of {format_file_size(budget)}")
+        if len(batches) > 0 and batches[-1]["pools"] == (n_pre, n_exp) and fits:
+            batches[-1]["cases"].append(case)
+        else:
+            batches.append({"cases": [case], "pools": (n_pre, n_exp)})
+    return batches
+
@@ -0,0 +1,144 @@
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+# upper bounds of the case latency histogram buckets in seconds
+LATENCY_BUCKETS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+
+def format_labels(labels: dict) -> str:
+    return ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels.items())
+
+def write_atomic(file, text):
+    # a scraper must never see a partially written file: write to a temporary file in the same folder and rename it
+    file = Path(file)
+    fd, tmp_file = tempfile.mkstemp(prefix="." + file.name, suffix=".tmp", dir=file.parent)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp_file, file)
+    except BaseException:
+        Path(tmp_file).unlink(missing_ok=True)
+        raise
+
+
+class MetricsWriter:
+    # aggregates the inference events into counters, gauges and histograms and periodically writes them as an
+    # Prometheus text file (e.g., for the node-exporter textfile collector). Event handling only updates the values,
+    # the file is written by a background thread
+    def __init__(self, metrics_file, mode, device, interval=15):
+        self.metrics_file = Path(metrics_file)
+        self.labels = {"mode": mode, "device": device}
+        self.interval = interval
+        self.completed = 0
+        self.failed = 0
+        self.queue_depth = 0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self.model_load = {}
+        self.run_cases = set()
+        self.case_starts = {}
+        self._lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __call__(self, event):
+        name = event["event"]
+        if event.get("preview", False):
+            return  # cases of a preview are predicted again by the full ensemble
+        with self._lock:
+            if name == "run_start":
+                self.run_cases = set()
+                self.queue_depth = event.get("cases", 0)
+            elif name == "case_start":
+                # the latency of a case runs from its prediction with the first model to its merged delineation
+                self.case_starts.setdefault(event["case"], event["time"])
+            elif name == "case_complete":
+                start = self.case_starts.pop(event["case"], None)
+                if start is not None:
+                    self.observe_latency(event["time"] - start)
+                self.completed += 1
+                self.run_cases.add(event["case"])
+                self.queue_depth = max(self.queue_depth - 1, 0)
+            elif name == "stage" and event["stage"] == "model_load":
+                self.model_load[event.get("plan")] = event["seconds"]
+            elif name == "run_end":
+                if event.get("status") != "finished":
+                    self.failed += self.queue_depth
+                self.queue_depth = 0
+                self.case_starts.clear()
+            else:
+                return
+        self._dirty.set()
+        if name == "run_end":
+            self.write()
+
+    def observe_latency(self, seconds):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.latency_buckets[i] += 1
+                break
+        else:
+            self.latency_buckets[-1] += 1
+        self.latency_sum += seconds
+        self.latency_count += 1
+
+    def render(self) -> str:
+        labels = format_labels(self.labels)
+        lines = [
+            "# HELP lyroi_cases_completed_total Cases for which the final delineation has been written.",
+            "# TYPE lyroi_cases_completed_total counter",
+            "lyroi_cases_completed_total{%s} %d" % (labels, self.completed),
+            "# HELP lyroi_cases_failed_total Cases that were not completed because the run failed.",
+            "# TYPE lyroi_cases_failed_total counter",
+            "lyroi_cases_failed_total{%s} %d" % (labels, self.failed),
+            "# HELP lyroi_queue_depth Cases of the current run that are not completed yet.",
+            "# TYPE lyroi_queue_depth gauge",
+            "lyroi_queue_depth{%s} %d" % (labels, self.queue_depth),
+            "# HELP lyroi_case_latency_seconds Time from the start of the prediction of a case with the first model "
+            "to the write of its merged delineation.",
+            "# TYPE lyroi_case_latency_seconds histogram",
+        ]
+        cumulative = 0
+        for bound, count in zip(list(LATENCY_BUCKETS) + ["+Inf"], self.latency_buckets):
+            cumulative += count
+            lines.append("lyroi_case_latency_seconds_bucket{%s,le=\"%s\"} %d" % (labels, bound, cumulative))
+        lines.append("lyroi_case_latency_seconds_sum{%s} %.3f" % (labels, self.latency_sum))
+        lines.append("lyroi_case_latency_seconds_count{%s} %d" % (labels, self.latency_count))
+        lines.append("# HELP lyroi_model_load_seconds Time needed to load the most recent model of each plan.")
+        lines.append("# TYPE lyroi_model_load_seconds gauge")
+        for plan, seconds in self.model_load.items():
+            lines.append("lyroi_model_load_seconds{%s} %.3f" % (format_labels({**self.labels, "plan": plan}),
+                                                                 seconds))
+        lines.append("# TYPE lyroi_last_update_timestamp_seconds gauge")
+        lines.append("lyroi_last_update_timestamp_seconds{%s} %.3f" % (labels, time.time()))
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        with self._lock:
+            text = self.render()
+            self._dirty.clear()
+        write_atomic(self.metrics_file, text)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self._dirty.is_set():
+                self.write()
+
+    def start(self):
+        self.metrics_file.parent.mkdir(exist_ok=True, parents=True)
+        self.write()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write()
@@ -0,0 +1,180 @@
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+from importlib.util import find_spec
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+from lyroi.benchmark import get_environment, summarize, write_synthetic_masks
+from lyroi.inference import check_inputs, get_cases, merge_delineations
+from lyroi.modes import get_suffixes
+from lyroi.progress import ProgressParser
+from lyroi.utils import get_tmp_dir, get_lyroi_dir
+
+# focused benchmarks of the helpers around the networks. None of them imports torch or PyQt
+MICRO_BENCHMARKS = ["nifti_io", "merge", "files", "progress", "startup"]
+
+# commands whose start time is measured in a fresh interpreter. None of them may import the modules in HEAVY_MODULES
+STARTUP_COMMANDS = {
+    "lyroi -h": "import sys; sys.argv = ['lyroi', '-h']\n"
+                "from lyroi.entrypoints import predict_entrypoint; predict_entrypoint()",
+    "lyroi_install -h": "import sys; sys.argv = ['lyroi_install', '-h']\n"
+                        "from lyroi.entrypoints import install_model_entrypoint; install_model_entrypoint()",
+    "check_model": "from lyroi.utils import check_model; check_model('petct')",
+    "gui import": "import lyroi.gui.start",
+}
+HEAVY_MODULES = ["torch", "nnunetv2", "nibabel", "requests"]
+
+
+def get_baseline_path():
+    return str(Path(get_lyroi_dir(), "benchmarks", "microbench_baseline.json"))
+
+def time_call(func, repeat, setup=None):
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return times
+
+def shape_str(shape):
+    return "x".join(str(s) for s in shape)
+
+def bench_nifti_io(work_dir, shapes, repeat, levels=(1, 6, 9)):
+    # nibabel writes gzip level 1 by default. Level 0 stands for uncompressed .nii files
+    results = {}
+    rng = np.random.default_rng(0)
+    default_level = nib.openers.Opener.default_compresslevel
+    try:
+        for shape in shapes:
+            volumes = {"pet": nib.Nifti1Image(rng.gamma(2.0, 0.5, size=shape).astype(np.float32), np.eye(4)),
+                       "mask": nib.Nifti1Image((rng.random(shape) > 0.99).astype(np.uint8), np.eye(4))}
+            for level in (0,) + tuple(levels):
+                nib.openers.Opener.default_compresslevel = max(level, 1)
+                extension = ".nii" if level == 0 else ".nii.gz"
+                for name, img in volumes.items():
+                    file = Path(work_dir, name + extension)
+                    tag = f"[{name},{shape_str(shape)},{'nii' if level == 0 else 'gz%d' % level}]"
+                    results["nifti_write" + tag] = summarize(time_call(lambda: nib.save(img, file), repeat))
+                    results["nifti_read" + tag] = summarize(time_call(lambda: nib.load(file).get_fdata(), repeat))
+                    file.unlink()
+    finally:
+        nib.openers.Opener.default_compresslevel = default_level
+    return results
+
+def bench_merge(work_dir, shapes, repeat, input_counts=(2, 3, 5), n_cases=2):
+    results = {}
+    output_folder = Path(work_dir, "merged")
+    output_folder.mkdir(exist_ok=True)
+    for shape in shapes:
+        for n_inputs in input_counts:
+            folders = [Path(work_dir, "masks", f"{shape_str(shape)}_{n_inputs}_{i}") for i in range(n_inputs)]
+            write_synthetic_masks(folders, shape, n_cases)
+            for strategy in ["u", "i", "m"]:
+                tag = f"[{strategy},{shape_str(shape)},{n_inputs} inputs]"
+                results["merge" + tag] = summarize(
+                    time_call(lambda: merge_delineations(folders, output_folder, strategy), repeat))
+    return results
+
+def bench_files(work_dir, repeat, n_files=10000, mode="petct"):
+    # file name handling on large input folders. Empty files are enough, the images are never opened
+    input_folder = Path(work_dir, "many_files")
+    input_folder.mkdir(exist_ok=True)
+    suffixes = get_suffixes(mode)
+    n_cases = n_files // len(suffixes)
+    for i in range(n_cases):
+        for suffix in suffixes:
+            Path(input_folder, "case_%05d%s.nii.gz" % (i, suffix)).touch()
+    file_list = sorted(str(f) for f in input_folder.iterdir())
+    tag = f"[{len(file_list)} files]"
+    return {
+        "check_inputs" + tag: summarize(time_call(lambda: check_inputs(input_folder, mode), repeat)),
+        "get_cases" + tag: summarize(time_call(lambda: get_cases(input_folder, mode), repeat)),
+        "get_tmp_dir[folder]": summarize(time_call(lambda: get_tmp_dir(work_dir, mode, str(input_folder)), repeat)),
+        "get_tmp_dir" + tag: summarize(time_call(lambda: get_tmp_dir(work_dir, mode, file_list), repeat)),
+    }
+
+def get_progress_stream(n_models=3, n_cases=20, n_folds=5, n_steps=100):
+    # console output of a lyroi run as seen by the GUI: nnU-Net messages and tqdm updates of the sliding window
+    lines = []
+    for model in range(n_models):
+        lines.append(f"Predicting with model {model + 1}/{n_models}")
+        lines.append(f"There are {n_cases} cases in the source folder")
+        lines.append(f"I am process 0 out of 1 (max process ID is 0, we start counting with 0!)")
+        for case in range(n_cases):
+            lines.append(f"Predicting case_{case:03d}:")
+            lines.append("perform_everything_on_device: True")
+            for fold in range(n_folds):
+                for step in range(n_steps + 1):
+                    percent = 100 * step // n_steps
+                    bar = ("█" * (percent // 10)).ljust(10)
+                    lines.append(f"{percent:3d}%|{bar}| {step}/{n_steps} [00:{step // 10:02d}<00:10,  9.87it/s]")
+                lines.append("")
+            lines.append("sending off prediction to background worker for resampling and export")
+            lines.append(f"done with case_{case:03d}")
+    return lines
+
+def bench_progress(repeat):
+    lines = get_progress_stream()
+
+    def parse_all():
+        parser = ProgressParser(n_folds=5)
+        for line in lines:
+            parser.parse(line)
+
+    return {f"progress_parse[{len(lines)} lines]": summarize(time_call(parse_all, repeat))}
+
+def time_startup(code, env):
+    # wall time of a fresh interpreter running code and the heavy modules it imported
+    code = "try:\n    exec(%r)\nexcept SystemExit:\n    pass\n" % code + \
+           "import sys; print('HEAVY_MODULES', *[m for m in %r if m in sys.modules])" % HEAVY_MODULES
+    start_time = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True)
+    seconds = time.perf_counter() - start_time
+    assert result.returncode == 0, result.stderr
+    heavy = result.stdout.strip().splitlines()[-1].split()[1:]
+    return seconds, heavy
+
+def bench_startup(work_dir, repeat):
+    # time to argument parsing, status checks and the GUI window, on an empty LyROI directory
+    env = dict(os.environ, LYROI_DIR=str(Path(work_dir, "lyroi")))
+    results = {}
+    for name, code in STARTUP_COMMANDS.items():
+        if name == "gui import" and find_spec("PyQt5") is None:
+            continue
+        times = []
+        for i in range(repeat):
+            seconds, heavy = time_startup(code, env)
+            assert len(heavy) == 0, f"'{name}' imports {', '.join(heavy)}, which slows down the start"
+            times.append(seconds)
+        results[f"startup[{name}]"] = summarize(times)
+    return results
+
+def run_micro_benchmarks(work_dir, benchmarks=MICRO_BENCHMARKS, repeat=5,
+                         shapes=((128, 128, 160), (256, 256, 400))):
+    results = {}
+    for name in benchmarks:
+        print("Running", name)
+        if name == "nifti_io":
+            results.update(bench_nifti_io(work_dir, shapes, repeat))
+        elif name == "merge":
+            results.update(bench_merge(work_dir, shapes, repeat))
+        elif name == "files":
+            results.update(bench_files(work_dir, repeat))
+        elif name == "progress":
+            results.update(bench_progress(repeat))
+        elif name == "startup":
+            results.update(bench_startup(work_dir, repeat))
+    return {
+        "benchmark": "lyroi_microbench",
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "environment": get_environment(),
+        "config": {"benchmarks": list(benchmarks), "repeat": repeat, "shapes": [list(s) for s in shapes]},
+        "results": results,
+    }
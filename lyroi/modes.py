@@ -1,3 +1,4 @@
+from pathlib import Path
 from typing import Union, List, Dict
 
 class ModeInfo:
@@ -59,11 +60,18 @@ def get_default_mode() -> str:
 def get_pretty_name(mode: str) -> str:
     return mode_list[mode].pretty_name
 
-def get_model_folders(mode: str) -> List[str]:
-    from nnunetv2.utilities.file_path_utilities import get_output_folder
+def get_model_folders(mode: str, root: str = None) -> List[str]:
+    # same layout as nnU-Net's get_output_folder for dataset 1, without importing nnunetv2 (and torch). The root is the
+    # folder of one installation in the model store, by default the one that is used for inference
+    from lyroi.utils import get_model_root
 
+    root = get_model_root(mode) if root is None else root
+    datasets = sorted(Path(root).glob("Dataset001_*"))
+    if len(datasets) == 0:
+        raise RuntimeError("Could not find a dataset with the ID 1 in " + str(root))
     mode_info = mode_list[mode]
-    folder_list = [get_output_folder(1, 'nnUNetTrainer', plan, mode_info.model_config) for plan in mode_info.model_plans]
+    folder_list = [str(Path(datasets[0], "nnUNetTrainer__%s__%s" % (plan, mode_info.model_config)))
+                   for plan in mode_info.model_plans]
     return folder_list
 
 def get_folds(mode: str) -> List[Union[int, str]]:
@@ -1,47 +1,844 @@
 # Parts taken and modified after https://github.com/MIC-DKFZ/nnUNet/
+import atexit
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
 import psutil
 import torch
+from acvl_utils.cropping_and_padding.bounding_boxes import bounding_box_to_slice
+from acvl_utils.cropping_and_padding.padding import pad_nd_image
+from nnunetv2.configuration import default_num_processes
+from nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape
 from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.sliding_window_prediction import compute_gaussian
+from nnunetv2.utilities.file_path_utilities import check_workers_alive_and_busy
+from nnunetv2.utilities.helpers import empty_cache, dummy_context
+from torch._dynamo import OptimizedModule
+from tqdm import tqdm
+
+from lyroi.placement import get_core_count
+from lyroi.memory import estimate_sliding_window_memory, get_configuration
+from lyroi.events import emit, stage, check_cancelled
+
 
+# loaded predictors, reused by all subsequent predictions of the process (see lyroi.backend)
+predictor_cache = {}
+# adaptive test-time augmentation: voxels whose ensemble probability is below this value (or above 1 - it for region
+# based models) are close to the decision boundary
+TTA_CONFIDENCE = 0.9
+# cascade: margin around the candidate voxels of the coarse pass, in voxels of the network resolution
+CASCADE_MARGIN = 8
+# preprocessing and export worker pools, shared by all plans and cases of the process. Every worker of a new pool
+# imports torch and nnU-Net, which takes seconds
+worker_pools = {}
 
-def get_torch_device(device='gpu'):
+
+def get_torch_device(device='gpu', torch_threads=None):
     assert device in ['cpu', 'cpu-max', 'gpu',
                       'mps'], f'-device must be either cpu, cpu-max, gpu or mps. Other devices are not tested/supported. Got: {device}'
     if device == 'cpu':
-        torch.set_num_threads(8)
+        torch.set_num_threads(torch_threads or min(8, get_core_count()))
         device = torch.device('cpu')
     if device == 'cpu-max':
-        torch.set_num_threads(psutil.cpu_count(logical=False))
+        torch.set_num_threads(torch_threads or get_core_count())
         device = torch.device('cpu')
     if device == 'gpu':
-        torch.set_num_threads(1)
+        torch.set_num_threads(torch_threads or 1)
         device = torch.device('cuda')
     if device == 'mps':
         device = torch.device('mps')
 
     return device
 
-def nnunet_predict(input_folder, output_folder, model_folder, folds, torch_device, progress_bar = True):
-    predictor = nnUNetPredictor(tile_step_size=0.5,
-                                use_gaussian=True,
-                                use_mirroring=True,
-                                perform_everything_on_device=True,
-                                device=torch_device,
-                                verbose=False,
-                                verbose_preprocessing=False,
-                                allow_tqdm=progress_bar)
-
-    predictor.initialize_from_trained_model_folder(
-        model_folder,
-        folds,
-        checkpoint_name='checkpoint_final.pth'
-    )
-
-    predictor.predict_from_files(str(input_folder), str(output_folder),
-                                 save_probabilities=False,
-                                 overwrite=True,
-                                 num_processes_preprocessing=3,
-                                 num_processes_segmentation_export=3,
-                                 folder_with_segs_from_prev_stage=None,
-                                 num_parts=1,
-                                 part_id=0)
\ No newline at end of file
+def warm_up_worker(index):
+    time.sleep(0.05)  # the other workers get a task as well
+    return os.getpid()
+
+def start_worker_pools(sizes):
+    # sizes: number of processes per kind ("preprocessing", "export"). A pool of another size replaces the existing
+    # one. New pools are started together, so that their workers import in parallel
+    started = {}
+    start_time = time.perf_counter()
+    for kind, n_processes in sizes.items():
+        if kind in worker_pools:
+            if worker_pools[kind][1] == n_processes:
+                continue
+            pool, size = worker_pools.pop(kind)
+            pool.close()
+            pool.join()
+        started[kind] = multiprocessing.get_context("spawn").Pool(n_processes)
+        worker_pools[kind] = (started[kind], n_processes)
+    if len(started) == 0:
+        return
+    # the workers start importing with their first task. Waiting for all of them makes the startup time visible
+    pids = {kind: set() for kind in started}
+    for attempt in range(3):
+        results = {kind: pool.map_async(warm_up_worker, range(worker_pools[kind][1]), chunksize=1)
+                   for kind, pool in started.items() if len(pids[kind]) < worker_pools[kind][1]}
+        for kind, result in results.items():
+            pids[kind].update(result.get())
+    seconds = time.perf_counter() - start_time
+    print("Started %s worker(s) in %.1f s" % (" and ".join("%d %s" % (worker_pools[kind][1], kind)
+                                                          for kind in started), seconds))
+    emit("stage", stage="pool_startup", seconds=seconds, pools=list(started))
+
+def get_worker_pool(kind, n_processes):
+    start_worker_pools({kind: n_processes})
+    return worker_pools[kind][0]
+
+def shutdown_worker_pools():
+    # workers import lyroi and would exit noisily on the SIGTERM sent when the pool is terminated
+    for kind in list(worker_pools.keys()):
+        pool, size = worker_pools.pop(kind)
+        pool.close()
+        pool.join()
+
+atexit.register(shutdown_worker_pools)
+
+def get_case_id(ofile):
+    return os.path.basename(ofile)
+
+def get_preprocessing_fingerprint(model_folder, configuration="3d_fullres"):
+    # everything DefaultPreprocessor.run_case depends on. Plans with the same fingerprint produce identical
+    # preprocessed data, so that it only has to be computed once per case
+    plans = json.loads(Path(model_folder, "plans.json").read_text())
+    dataset = json.loads(Path(model_folder, "dataset.json").read_text())
+    config = get_configuration(plans, configuration)
+    key = {
+        "configuration": {k: config.get(k) for k in ("preprocessor_name", "spacing", "normalization_schemes",
+                                                     "use_mask_for_norm", "resampling_fn_data",
+                                                     "resampling_fn_data_kwargs")},
+        "transpose_forward": plans["transpose_forward"],
+        "image_reader_writer": plans["image_reader_writer"],
+        "intensity_properties": plans["foreground_intensity_properties_per_channel"],
+        "channel_names": dataset["channel_names"],
+    }
+    return hashlib.md5(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+def get_cache_files(cache_dir, ofile):
+    case_id = get_case_id(ofile)
+    return Path(cache_dir, case_id + ".npy"), Path(cache_dir, case_id + ".pkl")
+
+def store_cached_case(cache_dir, ofile, data, data_properties, timings):
+    # the properties are written last and mark the entry as complete
+    data_file, info_file = get_cache_files(cache_dir, ofile)
+    Path(cache_dir).mkdir(exist_ok=True, parents=True)
+    np.save(data_file, data)
+    tmp_file = info_file.with_suffix(".tmp")
+    with open(tmp_file, "wb") as f:
+        pickle.dump({'data_properties': data_properties, 'timings': timings}, f)
+    tmp_file.replace(info_file)
+
+def load_cached_case(cache_dir, ofile):
+    # preprocessed data of another plan with the same fingerprint, memory-mapped (copy on write)
+    start_time = time.perf_counter()
+    data_file, info_file = get_cache_files(cache_dir, ofile)
+    with open(info_file, "rb") as f:
+        info = pickle.load(f)
+    data = torch.from_numpy(np.load(data_file, mmap_mode="c"))
+    return {'data': data, 'data_properties': info['data_properties'], 'ofile': ofile,
+            'timings': {'cache_load': time.perf_counter() - start_time},
+            'saved': sum(info['timings'].values())}
+
+def remove_files(files):
+    for file in files:
+        try:
+            Path(file).unlink(missing_ok=True)
+        except OSError:
+            pass  # still mapped (Windows), removed with the run dir
+
+def remove_cached_case(cache_dir, ofile):
+    remove_files(get_cache_files(cache_dir, ofile))
+
+def preprocess_case(image_files, ofile, plans_manager, configuration_manager, dataset_json, verbose=False,
+                    cache_dir=None):
+    # executed in the preprocessing workers. Same as DefaultPreprocessor.run_case, but with timings
+    start_time = time.perf_counter()
+    rw = plans_manager.image_reader_writer_class()
+    data, data_properties = rw.read_images(image_files)
+    read_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
+    data, _ = preprocessor.run_case_npy(data, None, data_properties, plans_manager, configuration_manager,
+                                        dataset_json)
+    data = data.astype(np.float32, copy=False)
+    timings = {'read': read_time, 'preprocessing': time.perf_counter() - start_time}
+    if cache_dir is not None:
+        store_cached_case(cache_dir, ofile, data, data_properties, timings)
+    data = torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format)
+    return {'data': data, 'data_properties': data_properties, 'ofile': ofile, 'timings': timings}
+
+def convert_logits_file_to_segmentation(logits_file, plans_manager, configuration_manager, label_manager, properties):
+    # same as convert_predicted_logits_to_segmentation_with_correct_shape for the logits file of an out-of-core
+    # prediction, one channel at a time so that the resampled logits are never all in memory: the resampling works per
+    # channel, the argmax of the softmax is the argmax of the logits, and regions are thresholded independently
+    logits = np.memmap(logits_file["file"], dtype=logits_file["dtype"], mode="r", shape=logits_file["shape"])
+    logits = logits[logits_file["slicer"]]
+    shape = properties['shape_after_cropping_and_before_resampling']
+    spacing_transposed = [properties['spacing'][i] for i in plans_manager.transpose_forward]
+    current_spacing = configuration_manager.spacing if len(configuration_manager.spacing) == len(shape) else \
+        [spacing_transposed[0], *configuration_manager.spacing]
+    segmentation = np.zeros(shape, dtype=np.uint8 if len(label_manager.foreground_labels) < 255 else np.uint16)
+    maximum = None
+    for i in range(logits.shape[0]):
+        channel = configuration_manager.resampling_fn_probabilities(np.array(logits[i:i + 1]), shape, current_spacing,
+                                                                    spacing_transposed)
+        channel = torch.as_tensor(np.asarray(channel)).float()
+        if label_manager.has_regions:
+            region = label_manager.apply_inference_nonlin(channel)[0] > 0.5
+            segmentation[region.numpy()] = label_manager.regions_class_order[i]
+        elif maximum is None:
+            maximum = channel[0]
+        else:
+            segmentation[(channel[0] > maximum).numpy()] = i
+            maximum = torch.maximum(maximum, channel[0])
+    del logits
+
+    # revert cropping and transpose
+    segmentation_reverted_cropping = np.zeros(properties['shape_before_cropping'], dtype=segmentation.dtype)
+    segmentation_reverted_cropping[bounding_box_to_slice(properties['bbox_used_for_cropping'])] = segmentation
+    return segmentation_reverted_cropping.transpose(plans_manager.transpose_backward)
+
+def export_case(predicted_logits, properties, configuration_manager, plans_manager, dataset_json, ofile):
+    # executed in the export workers. Same as export_prediction_from_logits, but with timings. predicted_logits is
+    # either the logits or the logits file of an out-of-core prediction (see LyroiPredictor.logits_file), which is
+    # removed once it is read
+    start_time = time.perf_counter()
+    label_manager = plans_manager.get_label_manager(dataset_json)
+    if isinstance(predicted_logits, dict):
+        segmentation = convert_logits_file_to_segmentation(predicted_logits, plans_manager, configuration_manager,
+                                                           label_manager, properties)
+        remove_files([predicted_logits["file"]])
+    else:
+        segmentation = convert_predicted_logits_to_segmentation_with_correct_shape(
+            predicted_logits, plans_manager, configuration_manager, label_manager, properties)
+    del predicted_logits
+    export_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    rw = plans_manager.image_reader_writer_class()
+    rw.write_seg(segmentation, ofile + dataset_json['file_ending'], properties)
+    return {'export': export_time, 'write': time.perf_counter() - start_time}
+
+def get_worker_result(result, pool, workers, timeout=0.5):
+    # the task of a worker that died is never completed, and the pool silently replaces the worker. Poll the result
+    # and check the workers that were running when the task was submitted. The lost task would block closing the
+    # pool, so it is terminated and the next prediction starts a new one
+    while not result.ready():
+        if not all(worker.is_alive() for worker in workers):
+            for kind in [kind for kind, (p, size) in worker_pools.items() if p is pool]:
+                del worker_pools[kind]
+            pool.terminate()
+            raise RuntimeError("A background worker died. This could be because of an error (look for an error "
+                               "message) or because it was killed by the OS due to running out of RAM. Reducing the "
+                               "number of workers might help")
+        result.wait(timeout)
+    return result.get()
+
+def preprocessing_iterator(list_of_lists, output_filenames_truncated, plans_manager, dataset_json,
+                           configuration_manager, num_processes, pin_memory=False, verbose=False, cache_dir=None):
+    # at most num_processes cases are preprocessed or waiting to be picked up at any time. Cases found in the
+    # preprocessing cache are loaded from there instead
+    pool = get_worker_pool("preprocessing", num_processes)
+    workers = list(pool._pool)
+    num_processes = max(1, min(num_processes, len(list_of_lists)))
+    pending = []
+    for files, ofile in zip(list_of_lists, output_filenames_truncated):
+        if cache_dir is not None and get_cache_files(cache_dir, ofile)[1].exists():
+            pending.append(CachedResult(cache_dir, ofile))
+        else:
+            pending.append(pool.apply_async(preprocess_case, (files, ofile, plans_manager, configuration_manager,
+                                                              dataset_json, verbose, cache_dir)))
+        if len(pending) < num_processes:
+            continue
+        item = get_worker_result(pending.pop(0), pool, workers)
+        if pin_memory:
+            item['data'] = item['data'].pin_memory()
+        yield item
+    for result in pending:
+        item = get_worker_result(result, pool, workers)
+        if pin_memory:
+            item['data'] = item['data'].pin_memory()
+        yield item
+
+
+class CachedResult:
+    # same interface as the AsyncResult of a preprocessing worker, so that the order of the cases is kept
+    def __init__(self, cache_dir, ofile):
+        self.cache_dir = cache_dir
+        self.ofile = ofile
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return load_cached_case(self.cache_dir, self.ofile)
+
+
+class LyroiPredictor(nnUNetPredictor):
+    def __init__(self, *args, out_of_core="auto", scratch_dir=None, plan=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.out_of_core = out_of_core
+        self.scratch_dir = scratch_dir
+        self.plan = plan
+        self.preview = False  # the events of a preview are tagged with preview=True
+        self.preprocessing_cache = None  # folder of the preprocessed cases shared with other plans
+        self.release_cache = False  # remove the cases from the cache once predicted (last plan that reads it)
+        self.tta = "full"  # test-time mirroring: "full" or "adaptive"
+        self.validate_tta = False  # compare adaptive mirroring with full mirroring
+        self.cascade = None  # candidate threshold of the coarse pass, None to predict all tiles with the ensemble
+        self.saved_seconds = 0  # preprocessing time saved through the cache in the current prediction
+        self.logits_file = None  # file, dtype, shape and slicer of the logits of the last out-of-core prediction
+        self.on_device = self.perform_everything_on_device
+        # progress of the current case, reported as fold and tile events
+        self._case = None
+        self._fold = 0
+        self._n_fold_steps = 1  # folds, or passes over the folds, reported in the fold events
+        self._n_tiles = 0
+        self._tiles_done = 0
+
+    def _internal_get_data_iterator_from_lists_of_filenames(self, input_list_of_lists, seg_from_prev_stage_files,
+                                                            output_filenames_truncated, num_processes):
+        return preprocessing_iterator(input_list_of_lists, output_filenames_truncated, self.plans_manager,
+                                      self.dataset_json, self.configuration_manager, num_processes,
+                                      self.device.type == 'cuda', self.verbose_preprocessing, self.preprocessing_cache)
+
+    def predict_from_data_iterator(self, data_iterator, save_probabilities: bool = False,
+                                   num_processes_segmentation_export: int = default_num_processes):
+        # same as nnUNetPredictor.predict_from_data_iterator, but with stage timings and without probabilities
+        assert not save_probabilities, "Saving probabilities is not supported"
+        export_pool = get_worker_pool("export", num_processes_segmentation_export)
+        worker_list = [i for i in export_pool._pool]
+        r = []
+        exports = []
+
+        def collect_exports(wait=False):
+            for case_id, result in list(exports):
+                if wait or result.ready():
+                    for name, seconds in get_worker_result(result, export_pool, worker_list)[0].items():
+                        emit("stage", stage=name, seconds=seconds, case=case_id, **self._get_tags())
+                    emit("case_end", case=case_id, **self._get_tags())
+                    exports.remove((case_id, result))
+
+        for preprocessed in data_iterator:
+            data = preprocessed['data']
+            ofile = preprocessed['ofile']
+            case_id = get_case_id(ofile)
+            check_cancelled()
+            print(f'\nPredicting {case_id}:')
+            emit("case_start", case=case_id, **self._get_tags())
+            for name, seconds in preprocessed.get('timings', {}).items():
+                emit("stage", stage=name, seconds=seconds, case=case_id, **self._get_tags())
+            if 'saved' in preprocessed:
+                self.saved_seconds += preprocessed['saved']
+                emit("preprocessing_reused", case=case_id, seconds=preprocessed['saved'], **self._get_tags())
+
+            properties = preprocessed['data_properties']
+
+            # let's not get into a runaway situation where the GPU predicts so fast that the disk has to be
+            # swamped with npy files
+            proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
+            while not proceed:
+                time.sleep(0.1)
+                proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
+
+            self._case = case_id
+            with stage("sliding_window", case=case_id, **self._get_tags()):
+                prediction = self.predict_logits_from_preprocessed_data(data).cpu()
+            if self.logits_file is not None:
+                # out-of-core: the export worker reads the logits from the file instead of receiving them
+                prediction, self.logits_file = self.logits_file, None
+            if self.preprocessing_cache is not None and self.release_cache:
+                del data, preprocessed  # the memory-mapped entry
+                remove_cached_case(self.preprocessing_cache, ofile)
+
+            print('sending off prediction to background worker for resampling and export')
+            result = export_pool.starmap_async(
+                export_case,
+                ((prediction, properties, self.configuration_manager, self.plans_manager,
+                  self.dataset_json, ofile),)
+            )
+            r.append(result)
+            exports.append((case_id, result))
+            collect_exports()
+            print(f'done with {case_id}')
+        collect_exports(wait=True)
+
+        # clear lru cache
+        compute_gaussian.cache_clear()
+        # clear device cache
+        empty_cache(self.device)
+
+    def select_accumulation(self, data_shape):
+        # where the logits of a case are accumulated: "device", "cpu" or "disk"
+        if self.out_of_core == "on":
+            return "disk"
+        default = "device" if self.on_device else "cpu"
+        if self.out_of_core == "off" or default == "device" and self.device.type != "cuda":
+            return default  # there is no free memory query for other accelerators
+
+        mirroring = self.use_mirroring and self.allowed_mirroring_axes is not None
+        estimate = estimate_sliding_window_memory(data_shape, self.label_manager.num_segmentation_heads,
+                                                  self.configuration_manager.patch_size,
+                                                  self.tta if mirroring else "full", self.validate_tta,
+                                                  self.cascade is not None)
+        if default == "device":
+            free_device, _ = torch.cuda.mem_get_info(self.device)
+            # leave room for the network activations
+            if estimate["data"] + estimate["logits"] < 0.7 * free_device - 2 * 1024 ** 3:
+                return "device"
+        free_ram = psutil.virtual_memory().available
+        if estimate["data"] + estimate["logits"] + estimate["ensemble"] < 0.7 * free_ram:
+            return "cpu"
+        return "disk"
+
+    def _get_tags(self):
+        # plan of the events, listeners that aggregate the full predictions skip the tagged events of a preview
+        return {"plan": self.plan, "preview": True} if self.preview else {"plan": self.plan}
+
+    def _start_fold(self):
+        check_cancelled()
+        emit("fold_start", case=self._case, fold=self._fold, n_folds=self._n_fold_steps, **self._get_tags())
+
+    def _end_fold(self):
+        emit("fold_end", case=self._case, fold=self._fold, n_folds=self._n_fold_steps, **self._get_tags())
+        self._fold += 1
+
+    def _start_tiles(self, n_tiles):
+        self._n_tiles = n_tiles
+        self._tiles_done = 0
+
+    def _end_tile(self):
+        self._tiles_done += 1
+        emit("tile", case=self._case, fold=self._fold, n_folds=self._n_fold_steps, tile=self._tiles_done,
+             n_tiles=self._n_tiles, **self._get_tags())
+
+    def _internal_maybe_mirror_and_predict(self, x: torch.Tensor) -> torch.Tensor:
+        prediction = super()._internal_maybe_mirror_and_predict(x)
+        self._end_tile()
+        return prediction
+
+    def _internal_predict_sliding_window_return_logits(self, data, slicers, do_on_device: bool = True):
+        self._start_tiles(len(slicers))
+        return super()._internal_predict_sliding_window_return_logits(data, slicers, do_on_device)
+
+    def predict_sliding_window_return_logits(self, input_image: torch.Tensor):
+        # called once per fold by nnUNetPredictor.predict_logits_from_preprocessed_data
+        self._start_fold()
+        prediction = super().predict_sliding_window_return_logits(input_image)
+        self._end_fold()
+        return prediction
+
+    def predict_logits_from_preprocessed_data(self, data: torch.Tensor) -> torch.Tensor:
+        self._fold = 0
+        self.logits_file = None
+        self._n_fold_steps = len(self.list_of_parameters)
+        accumulation = self.select_accumulation(data.shape)
+        if accumulation != "disk":
+            self.perform_everything_on_device = accumulation == "device"
+            if self.cascade is not None:
+                return self._predict_cascade(data, accumulation == "device")
+            if self.tta == "adaptive" and self.use_mirroring and self.allowed_mirroring_axes is not None:
+                return self._predict_tiles(data, accumulation == "device")
+            return super().predict_logits_from_preprocessed_data(data)
+
+        print(f"The case is too large to be predicted in memory, accumulating the logits on disk in {self.scratch_dir}")
+        n_threads = torch.get_num_threads()
+        torch.set_num_threads(default_num_processes if default_num_processes < n_threads else n_threads)
+        try:
+            with torch.no_grad():
+                self.network = self.network.to(self.device)
+                self.network.eval()
+                with torch.autocast(self.device.type, enabled=True) if self.device.type == 'cuda' else dummy_context():
+                    data, slicer_revert_padding = pad_nd_image(data, self.configuration_manager.patch_size,
+                                                               'constant', {'value': 0}, True, None)
+                    slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
+                    # the logits file is kept for the export worker
+                    logits = self._create_buffer((self.label_manager.num_segmentation_heads, *data.shape[1:]),
+                                                 np.float16, keep=True)
+                    weights = self._create_buffer(data.shape[1:], np.float32)
+
+                    for i, params in enumerate(self.list_of_parameters):
+                        self._load_parameters(params)
+                        # gaussian weights are identical for all folds
+                        self._start_fold()
+                        self._predict_sliding_window_out_of_core(data, slicers, logits, weights if i == 0 else None)
+                        self._end_fold()
+
+                    # normalize slab by slab, so that memory stays bounded
+                    n_folds = len(self.list_of_parameters)
+                    slab = self.configuration_manager.patch_size[0]
+                    for start in range(0, logits.shape[1], slab):
+                        normalized = logits[:, start:start + slab].astype(np.float32)
+                        normalized /= weights[start:start + slab] * n_folds
+                        if np.any(np.isinf(normalized)):
+                            raise RuntimeError('Encountered inf in predicted array. Aborting...')
+                        logits[:, start:start + slab] = normalized
+                    logits.flush()
+                    empty_cache(self.device)
+        finally:
+            torch.set_num_threads(n_threads)
+        # revert padding. The result is still backed by the file on disk
+        revert_padding = (slice(None), *slicer_revert_padding[1:])
+        self.logits_file = {"file": logits.filename, "dtype": "float16", "shape": logits.shape,
+                            "slicer": revert_padding}
+        return torch.from_numpy(logits[revert_padding])
+
+    def _load_parameters(self, params):
+        if not isinstance(self.network, OptimizedModule):
+            self.network.load_state_dict(params)
+        else:
+            self.network._orig_mod.load_state_dict(params)
+
+    def _get_mirror_axes(self):
+        axes = [m + 2 for m in self.allowed_mirroring_axes]
+        return [c for i in range(len(axes)) for c in itertools.combinations(axes, i + 1)]
+
+    def _predict_mirrored(self, x):
+        # sum of the predictions of the mirrored variants of x, without the unmirrored one
+        prediction = None
+        for axes in self._get_mirror_axes():
+            mirrored = torch.flip(self.network(torch.flip(x, axes)), axes)
+            prediction = mirrored if prediction is None else prediction + mirrored
+        return prediction
+
+    def _get_probabilities(self, logits, weights=None):
+        # probabilities slab by slab, the nonlinearity works on float32 copies
+        slab = self.configuration_manager.patch_size[0]
+        for start in range(0, logits.shape[1], slab):
+            normalized = logits[:, start:start + slab].float()
+            if weights is not None:
+                normalized = normalized / weights[start:start + slab]
+            yield start, self.label_manager.apply_inference_nonlin(normalized)
+
+    def _get_segmentation(self, logits, weights):
+        segmentation = torch.zeros(logits.shape[1:], dtype=torch.int16, device=logits.device)
+        for start, probabilities in self._get_probabilities(logits, weights):
+            slab = self.label_manager.convert_probabilities_to_segmentation(probabilities)
+            segmentation[start:start + slab.shape[0]] = slab
+        return segmentation
+
+    def _get_uncertain(self, logits, weights):
+        uncertain = torch.zeros(logits.shape[1:], dtype=torch.bool, device=logits.device)
+        for start, probabilities in self._get_probabilities(logits, weights):
+            if self.label_manager.has_regions:
+                slab = ((probabilities > 1 - TTA_CONFIDENCE) & (probabilities < TTA_CONFIDENCE)).any(0)
+            else:
+                slab = probabilities.max(0)[0] < TTA_CONFIDENCE
+            uncertain[start:start + slab.shape[0]] = slab
+        return uncertain
+
+    def _predict_cascade(self, data, do_on_device=True):
+        # coarse pass with the first fold, without mirroring and with non-overlapping tiles. The full ensemble then only
+        # predicts the tiles with candidate voxels (foreground probability of at least self.cascade) within a margin of
+        # CASCADE_MARGIN voxels. The coarse logits are kept for all other voxels
+        n_passes = 2 if self.use_mirroring and self.allowed_mirroring_axes is not None else 1
+        self._n_fold_steps = 1 + n_passes * len(self.list_of_parameters)
+        parameters, use_mirroring, tile_step_size = self.list_of_parameters, self.use_mirroring, self.tile_step_size
+        self.list_of_parameters, self.use_mirroring, self.tile_step_size = parameters[:1], False, 1.0
+        try:
+            coarse = super().predict_logits_from_preprocessed_data(data)
+        finally:
+            self.list_of_parameters, self.use_mirroring, self.tile_step_size = parameters, use_mirroring, tile_step_size
+
+        candidates = torch.zeros(coarse.shape[1:], dtype=torch.bool)
+        for start, probabilities in self._get_probabilities(coarse):
+            if self.label_manager.has_regions:
+                slab = probabilities.max(0)[0] >= self.cascade
+            else:
+                slab = 1 - probabilities[0] >= self.cascade
+            candidates[start:start + slab.shape[0]] = slab
+        candidates = torch.nn.functional.max_pool3d(candidates[None, None].float(), 2 * CASCADE_MARGIN + 1, stride=1,
+                                                    padding=CASCADE_MARGIN)[0]
+        return self._predict_tiles(data, do_on_device, candidates, coarse)
+
+    def _predict_tiles(self, data, do_on_device=True, candidates=None, coarse=None):
+        # same fallback as nnUNetPredictor.predict_sliding_window_return_logits: if the buffers do not fit on the
+        # device, the case is predicted again with the results on the cpu
+        n_threads = torch.get_num_threads()
+        torch.set_num_threads(default_num_processes if default_num_processes < n_threads else n_threads)
+        try:
+            if do_on_device and self.device.type != "cpu":
+                fold = self._fold
+                try:
+                    return self._accumulate_tiles(data, True, candidates, coarse)
+                except RuntimeError:
+                    print("Prediction on device was unsuccessful, probably due to a lack of memory. Moving results "
+                          "arrays to CPU")
+                # outside of the except block, so that the buffers of the failed attempt are released
+                empty_cache(self.device)
+                self._fold = fold
+            return self._accumulate_tiles(data, False, candidates, coarse)
+        finally:
+            torch.set_num_threads(n_threads)
+
+    def _accumulate_tiles(self, data, do_on_device=True, candidates=None, coarse=None):
+        # sliding window in two passes over the folds: all tiles without mirroring first, then the mirrored variants.
+        # With adaptive test-time augmentation, the mirrored variants are only added for tiles with uncertain voxels in
+        # their center, where the ensemble probability is close to the decision boundary or the folds disagree. If all
+        # tiles are uncertain, the result equals full mirroring. With candidates (cascade), only the tiles that
+        # contain candidate voxels are predicted, the other voxels get the coarse logits
+        results_device = self.device if do_on_device else torch.device('cpu')
+        patch_size = self.configuration_manager.patch_size
+        n_folds = len(self.list_of_parameters)
+        n_mirrors = len(self._get_mirror_axes()) if self.use_mirroring and self.allowed_mirroring_axes else 0
+        adaptive = self.tta == "adaptive" and n_mirrors > 0
+        self._n_fold_steps = self._fold + (2 if n_mirrors > 0 else 1) * n_folds
+        with torch.no_grad():
+            self.network = self.network.to(self.device)
+            self.network.eval()
+            with torch.autocast(self.device.type, enabled=True) if self.device.type == 'cuda' else dummy_context():
+                data, slicer_revert_padding = pad_nd_image(data, patch_size, 'constant', {'value': 0}, True, None)
+                data = data.to(results_device)
+                slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
+                if candidates is not None:
+                    candidates, _ = pad_nd_image(candidates, patch_size, 'constant', {'value': 0}, True, None)
+                    n_tiles = len(slicers)
+                    slicers = [sl for sl in slicers if candidates[sl].any()]
+                    del candidates
+                    print(f"Cascade: full ensemble for {len(slicers)} of {n_tiles} tiles "
+                          f"({100 * len(slicers) / n_tiles:.1f}%)")
+                    emit("cascade", case=self._case, tiles=len(slicers), n_tiles=n_tiles, **self._get_tags())
+                shape = (self.label_manager.num_segmentation_heads, *data.shape[1:])
+                if self.use_gaussian:
+                    gaussian = compute_gaussian(tuple(patch_size), sigma_scale=1. / 8, value_scaling_factor=10,
+                                                device=results_device)
+                else:
+                    gaussian = torch.ones(tuple(patch_size), device=results_device)
+                weights = torch.zeros(data.shape[1:], dtype=torch.float32, device=results_device)
+                for sl in slicers:
+                    weights[sl[1:]] += gaussian
+
+                # first pass: unmirrored tiles, ensemble and disagreement of the folds
+                ensemble = torch.zeros(shape, dtype=torch.float32, device=results_device)
+                reference = disagree = None
+                for params in self.list_of_parameters:
+                    self._load_parameters(params)
+                    self._start_fold()
+                    self._start_tiles(len(slicers))
+                    logits = torch.zeros(shape, dtype=torch.half, device=results_device)
+                    for sl in tqdm(slicers, disable=not self.allow_tqdm):
+                        logits[sl] += self.network(data[sl][None].to(self.device))[0].to(results_device) * gaussian
+                        self._end_tile()
+                    ensemble += logits
+                    if adaptive:
+                        segmentation = self._get_segmentation(logits, weights)
+                        if reference is None:
+                            reference, disagree = segmentation, torch.zeros_like(segmentation, dtype=torch.bool)
+                        else:
+                            disagree |= segmentation != reference
+                    del logits
+                    self._end_fold()
+
+                selected = list(range(len(slicers)))
+                if adaptive:
+                    uncertain = disagree | self._get_uncertain(ensemble, weights * n_folds)
+                    del reference, disagree
+                    # with a step size of at most half a patch, the centers of the tiles cover the volume if the centers
+                    # of the first and last tile on each axis are stretched to the border
+                    selected = [i for i, sl in enumerate(slicers)
+                                if uncertain[tuple(slice(0 if s.start == 0 else s.start + p // 4,
+                                                         n if s.stop == n else s.stop - p // 4)
+                                                   for s, p, n in zip(sl[1:], patch_size, uncertain.shape))].any()]
+                    del uncertain
+
+                # second pass: mirrored variants of the selected tiles (of all tiles for the validation)
+                validate = adaptive and self.validate_tta
+                full = ensemble.clone() if validate else None
+                tta_weights = weights.clone()
+                for i in selected:
+                    tta_weights[slicers[i][1:]] += n_mirrors * gaussian
+                mirrored_tiles = range(len(slicers)) if validate else selected
+                selected_set = set(selected)
+                for params in self.list_of_parameters if n_mirrors > 0 else []:
+                    self._load_parameters(params)
+                    self._start_fold()
+                    self._start_tiles(len(mirrored_tiles))
+                    for i in tqdm(mirrored_tiles, disable=not self.allow_tqdm):
+                        sl = slicers[i]
+                        prediction = self._predict_mirrored(data[sl][None].to(self.device))[0].to(results_device)
+                        prediction *= gaussian
+                        if i in selected_set:
+                            ensemble[sl] += prediction
+                        if full is not None:
+                            full[sl] += prediction
+                        self._end_tile()
+                    self._end_fold()
+
+                if adaptive:
+                    summary = {"tiles": len(selected), "n_tiles": len(slicers)}
+                    print(f"Full test-time augmentation for {len(selected)} of {len(slicers)} tiles "
+                          f"({100 * len(selected) / max(len(slicers), 1):.1f}%)")
+                    if full is not None:
+                        adaptive_mask = self._get_segmentation(ensemble, tta_weights * n_folds) > 0
+                        full_mask = self._get_segmentation(full, weights * (n_mirrors + 1) * n_folds) > 0
+                        del full
+                        overlap = (adaptive_mask & full_mask).sum().item()
+                        volume = adaptive_mask.sum().item() + full_mask.sum().item()
+                        summary["dice"] = 2 * overlap / volume if volume > 0 else 1.0
+                        summary["differing_voxels"] = (adaptive_mask != full_mask).sum().item()
+                        print(f"Agreement with full test-time augmentation: Dice {summary['dice']:.4f}, "
+                              f"{summary['differing_voxels']} differing voxel(s)")
+                    emit("tta", case=self._case, **summary, **self._get_tags())
+
+                covered = tta_weights > 0
+                tta_weights[~covered] = 1
+                ensemble /= tta_weights
+                ensemble /= n_folds
+                if torch.any(torch.isinf(ensemble)):
+                    raise RuntimeError('Encountered inf in predicted array. Aborting...')
+                empty_cache(self.device)
+
+        revert_padding = (slice(None), *slicer_revert_padding[1:])
+        prediction = ensemble[revert_padding].to('cpu')
+        if coarse is not None:
+            uncovered = ~covered[revert_padding[1:]].to('cpu')
+            prediction[:, uncovered] = coarse[:, uncovered].float()
+        return prediction
+
+    def _create_buffer(self, shape, dtype, keep=False):
+        Path(self.scratch_dir).mkdir(exist_ok=True, parents=True)
+        fd, file_name = tempfile.mkstemp(prefix="logits-", suffix=".dat", dir=self.scratch_dir)
+        os.close(fd)
+        buffer = np.memmap(file_name, dtype=dtype, mode="w+", shape=tuple(shape))
+        if os.name != "nt" and not keep:
+            os.unlink(file_name)  # the mapping stays valid, the space is released as soon as the buffer is gone
+        return buffer
+
+    def _predict_sliding_window_out_of_core(self, data, slicers, logits, weights=None):
+        # tiles are processed in slabs along the first axis: each slab is accumulated in memory (fp32)
+        # and added to the reduced-precision buffer on disk once
+        if self.use_gaussian:
+            gaussian = compute_gaussian(tuple(self.configuration_manager.patch_size), sigma_scale=1. / 8,
+                                        value_scaling_factor=10, device=torch.device('cpu')).float()
+        else:
+            gaussian = torch.ones(self.configuration_manager.patch_size)
+        slab_size = self.configuration_manager.patch_size[0]
+
+        self._start_tiles(len(slicers))
+        slabs = {}
+        for sl in slicers:
+            slabs.setdefault(sl[1].start, []).append(sl)
+
+        with tqdm(total=len(slicers), disable=not self.allow_tqdm) as progress:
+            for slab_start, slab_slicers in sorted(slabs.items()):
+                slab_logits = torch.zeros((logits.shape[0], slab_size, *logits.shape[2:]), dtype=torch.float32)
+                slab_weights = torch.zeros((slab_size, *logits.shape[2:]), dtype=torch.float32)
+                for sl in slab_slicers:
+                    workon = data[sl][None].to(self.device)
+                    prediction = self._internal_maybe_mirror_and_predict(workon)[0].to('cpu', torch.float32)
+                    local_sl = (slice(0, slab_size), *sl[2:])
+                    slab_logits[(slice(None), *local_sl)] += prediction * gaussian
+                    slab_weights[local_sl] += gaussian
+                    progress.update()
+
+                target = slice(slab_start, slab_start + slab_size)
+                logits[:, target] = (torch.from_numpy(logits[:, target].astype(np.float32)) + slab_logits).half().numpy()
+                if weights is not None:
+                    weights[target] += slab_weights.numpy()
+
+
+def get_case_lists(input_folder, file_ending):
+    # same as nnU-Net's create_lists_from_splitted_dataset_folder, but without its worker pool: forking this process
+    # once torch and the monitoring threads are running can deadlock
+    files = sorted(f.name for f in Path(input_folder).iterdir() if f.name.endswith(file_ending))
+    crop = len(file_ending) + 5  # channel index _XXXX
+    case_lists = {}
+    for file in files:
+        case_lists.setdefault(file[:-crop], []).append(str(Path(input_folder, file)))
+    return [case_lists[case_id] for case_id in sorted(case_lists)]
+
+def get_predictor_key(model_folder, folds, torch_device):
+    return str(model_folder), tuple(folds), str(torch_device)
+
+def get_predictor(model_folder, folds, torch_device, cache=False):
+    # predictors in the cache keep their networks and checkpoints loaded between runs
+    key = get_predictor_key(model_folder, folds, torch_device)
+    if key in predictor_cache:
+        return predictor_cache[key]
+
+    plan = Path(model_folder).name
+    predictor = LyroiPredictor(tile_step_size=0.5,
+                               use_gaussian=True,
+                               use_mirroring=True,
+                               perform_everything_on_device=True,
+                               device=torch_device,
+                               verbose=False,
+                               verbose_preprocessing=False,
+                               allow_tqdm=True,
+                               plan=plan)
+
+    with stage("model_load", plan=plan):
+        predictor.initialize_from_trained_model_folder(
+            model_folder,
+            folds,
+            checkpoint_name='checkpoint_final.pth'
+        )
+    if cache:
+        predictor_cache[key] = predictor
+    return predictor
+
+def clear_predictor_cache(keep=()):
+    for key in list(predictor_cache.keys()):
+        if key not in keep:
+            del predictor_cache[key]
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+def nnunet_predict(input_folder, output_folder, model_folder, folds, torch_device, progress_bar = True,
+                   num_processes_preprocessing=3, num_processes_segmentation_export=3, out_of_core="auto",
+                   scratch_dir=None, preview=False, preprocessing_cache=None, release_cache=False, tta="full",
+                   validate_tta=False, cascade=None):
+    # returns the preprocessing time in seconds that was saved by reusing cases from preprocessing_cache
+    if scratch_dir is None:
+        scratch_dir = Path(output_folder, ".scratch")
+    if preview and get_predictor_key(model_folder, folds, torch_device) not in predictor_cache:
+        folds = folds[:1]  # a preloaded predictor is reused, otherwise only the first fold is loaded
+    predictor = get_predictor(model_folder, folds, torch_device)
+    predictor.allow_tqdm = progress_bar
+    predictor.out_of_core = out_of_core
+    predictor.scratch_dir = scratch_dir
+    predictor.preprocessing_cache = preprocessing_cache
+    predictor.release_cache = release_cache
+    predictor.saved_seconds = 0
+    predictor.tta = tta
+    predictor.validate_tta = validate_tta
+    predictor.cascade = None if preview else cascade
+
+    # a preview uses the first fold only, without test-time mirroring and with non-overlapping tiles
+    settings = (predictor.list_of_parameters, predictor.plan, predictor.use_mirroring, predictor.tile_step_size)
+    if preview:
+        predictor.list_of_parameters = settings[0][:1]
+        predictor.plan = "preview"
+        predictor.use_mirroring = False
+        predictor.tile_step_size = 1.0
+        predictor.preview = True
+
+    # input_folder can also be a list of lists of input files (one list per case)
+    if not isinstance(input_folder, list):
+        input_folder = get_case_lists(input_folder, predictor.dataset_json['file_ending'])
+    start_worker_pools({"preprocessing": num_processes_preprocessing, "export": num_processes_segmentation_export})
+    try:
+        predictor.predict_from_files(input_folder, str(output_folder),
+                                     save_probabilities=False,
+                                     overwrite=True,
+                                     num_processes_preprocessing=num_processes_preprocessing,
+                                     num_processes_segmentation_export=num_processes_segmentation_export,
+                                     folder_with_segs_from_prev_stage=None,
+                                     num_parts=1,
+                                     part_id=0)
+    finally:
+        predictor.list_of_parameters, predictor.plan, predictor.use_mirroring, predictor.tile_step_size = settings
+        predictor.preview = False
+        predictor.preprocessing_cache = None
+        predictor.release_cache = False
+    return predictor.saved_seconds
\ No newline at end of file
@@ -0,0 +1,121 @@
+import atexit
+import os
+from pathlib import Path
+from typing import List, Dict, Optional
+
+import psutil
+
+from lyroi.utils import get_lyroi_dir, acquire_lock, release_lock
+
+# placement applied by apply_placement, reported in the run summary
+applied_placement = {}
+
+
+def parse_cpu_list(cpu_str: str) -> List[int]:
+    # Linux cpulist format, e.g. "0-3,8,10-11"
+    cpus = []
+    for part in cpu_str.replace(" ", ",").split(","):
+        if part == "":
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return sorted(set(cpus))
+
+def format_cpu_list(cpus: List[int]) -> str:
+    cpus = sorted(set(cpus))
+    ranges = []
+    for cpu in cpus:
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+def get_numa_nodes() -> Dict[int, List[int]]:
+    nodes = {}
+    for node_dir in Path("/sys/devices/system/node").glob("node[0-9]*"):
+        try:
+            nodes[int(node_dir.name[4:])] = parse_cpu_list(Path(node_dir, "cpulist").read_text().strip())
+        except (OSError, ValueError):
+            continue
+    nodes = {node: cpus for node, cpus in nodes.items() if len(cpus) > 0}  # memory-only nodes
+    if len(nodes) == 0:
+        # no NUMA information (non-Linux systems): everything is one node
+        nodes[0] = list(range(psutil.cpu_count(logical=True)))
+    return dict(sorted(nodes.items()))
+
+def get_affinity() -> Optional[List[int]]:
+    try:
+        return sorted(psutil.Process().cpu_affinity())
+    except AttributeError:
+        return None # not supported on this platform (MacOS)
+
+def get_core_count() -> int:
+    # number of physical cores this process is allowed to run on
+    affinity = get_affinity()
+    n_cores = psutil.cpu_count(logical=False) or 1
+    if affinity is None or len(affinity) == psutil.cpu_count(logical=True):
+        return n_cores
+    core_ids = set()
+    for cpu in affinity:
+        topology = Path("/sys/devices/system/cpu", "cpu%d" % cpu, "topology")
+        try:
+            core_ids.add((Path(topology, "physical_package_id").read_text().strip(),
+                          Path(topology, "core_id").read_text().strip()))
+        except OSError:
+            core_ids.add(cpu)
+    return max(1, min(len(core_ids), n_cores))
+
+def select_numa_node_auto() -> int:
+    # one instance per socket: claim the first node that is not used by another LyROI process on this host
+    nodes = list(get_numa_nodes().keys())
+    for node in nodes:
+        lock_path = Path(get_lyroi_dir(), "locks", "numa_node%d.lock" % node)
+        if acquire_lock(lock_path):
+            atexit.register(release_lock, lock_path)
+            return node
+    # all sockets are taken: share with the others
+    return nodes[os.getpid() % len(nodes)]
+
+def apply_placement(cpus: Optional[str] = None, numa_node: Optional[str] = None):
+    if cpus is None and numa_node is None:
+        return
+
+    node = None
+    if numa_node is not None:
+        nodes = get_numa_nodes()
+        node = select_numa_node_auto() if numa_node == "auto" else int(numa_node)
+        assert node in nodes, f"NUMA node {node} does not exist. Available nodes: {list(nodes.keys())}"
+        cpu_list = nodes[node]
+    else:
+        cpu_list = parse_cpu_list(cpus)
+        available = range(psutil.cpu_count(logical=True))
+        assert len(cpu_list) > 0 and all(cpu in available for cpu in cpu_list), \
+            f"Invalid CPU list '{cpus}'. Available CPUs: {format_cpu_list(list(available))}"
+
+    if get_affinity() is None:
+        print("CPU placement is not supported on this platform and will be ignored")
+        return
+
+    # the affinity mask is inherited by all child processes, including nnU-Net preprocessing and export workers.
+    # With Linux first-touch memory allocation, pinning to one node also keeps the memory local to that node
+    psutil.Process().cpu_affinity(cpu_list)
+    cpu_str = format_cpu_list(get_affinity())
+    os.environ['GOMP_CPU_AFFINITY'] = cpu_str.replace(",", " ")
+    os.environ['LYROI_CPUS'] = cpu_str
+
+    applied_placement.clear()
+    applied_placement["cpus"] = cpu_str
+    if node is not None:
+        applied_placement["numa_node"] = node
+
+def describe_placement() -> str:
+    if len(applied_placement) == 0:
+        return "not restricted"
+    desc = "CPUs " + applied_placement["cpus"]
+    if "numa_node" in applied_placement:
+        desc += " (NUMA node %d)" % applied_placement["numa_node"]
+    return desc
@@ -0,0 +1,211 @@
+import json
+import re
+import threading
+import time
+from typing import Optional, Tuple
+
+
+class ProgressParser:
+    # Parses the console output of lyroi and lyroi_install into progress values. Kept free of Qt, so that it can be
+    # profiled and benchmarked in isolation
+    tqdm_re = re.compile(r"(\d+)%\|")
+    cases_re = re.compile(r"There are (\d+) cases in the source folder")
+    models_re = re.compile(r"Predicting with model (\d+)/(\d+)")
+    download_re = re.compile("Downloading pretrained model from url:")
+    archives_re = re.compile(r"Downloading \d+ model archives")
+
+    def __init__(self, n_folds=1):
+        self._in_tqdm = False
+        self._current_fold = 0
+        self._current_case = -1
+        self._current_model = -1
+        self.n_cases = 1
+        self.n_models = 1
+        self.n_folds = n_folds
+
+    def parse(self, text: str) -> Tuple[Optional[str], Optional[Tuple[int, int]]]:
+        # returns the text to show in the console (or None) and the task and total progress in percent (or None)
+        text = text.rstrip("\n")
+
+        # matching percent indication. The substring test is much cheaper than the regex on regular lines
+        match = self.tqdm_re.search(text) if "%|" in text else None
+        if match:
+            output = None
+            if not self._in_tqdm:
+                output = "Task in progress...\n"
+                self._current_case += 1  # increment case counter of tqdm loop start
+            self._in_tqdm = True
+            # DO NOT send tqdm lines to console
+            return output, (self.task_progress(match.group(1)), self.total_progress(match.group(1)))
+
+        # skip empty lines in tqdm loop and track the current fold
+        if self._in_tqdm and text.strip() == "":
+            self._current_fold += 1
+            return None, None
+
+        # tdqm loop is over. Reset
+        self._current_fold = 0
+        self._in_tqdm = False
+
+        ### prediction parsing
+        # matching case count
+        match = self.cases_re.search(text) if "cases in the source" in text else None
+        if match:
+            self.set_n_cases(match.group(1))
+            self._current_case = -1  # will become 0 as soon as the first tqdm line is received
+
+        # matching model count
+        match = self.models_re.search(text) if "Predicting with model" in text else None
+        if match:
+            self.set_current_model(match.group(1))
+            self.set_n_models(match.group(2))
+
+        ### installation parsing
+        if "Downloading pretrained" in text and self.download_re.search(text):
+            self._current_model += 1
+            self._current_case = -1
+
+        # parallel downloads share one progress bar
+        if "model archives" in text and self.archives_re.search(text):
+            self.set_n_models(1)
+            self._current_model = 0
+            self._current_case = -1
+
+        # everything else goes to console
+        return text, None
+
+    def set_n_cases(self, n_cases):
+        n_cases = int(n_cases)
+        self.n_cases = n_cases
+
+    def set_n_models(self, n_models):
+        n_models = int(n_models)
+        self.n_models = n_models
+
+    def set_current_model(self, index):
+        index = int(index)
+        index = index - 1
+        self._current_model = index
+
+    def task_progress(self, percent):
+        percent = int(percent)
+        percent = (100 * self._current_fold + percent) / self.n_folds
+        return round(percent)
+
+    def total_progress(self, percent):
+        percent = self.task_progress(percent)  # taking care of folds
+        percent = (100 * self._current_case + percent) / self.n_cases  # taking care of cases
+        percent = (100 * self._current_model + percent) / self.n_models  # taking care of models
+        return round(percent)
+
+
+class JsonlProgressWriter:
+    # Event listener that writes the inference events as JSON lines (one object per line with an "event" key) to a
+    # stream. Overall progress (0..1) and the estimated remaining time in seconds are added to every event but the ones
+    # of a preview (tagged preview=True), whose time is not counted either. Tile events are throttled to one per
+    # interval
+    def __init__(self, stream, interval=0.5):
+        self.stream = stream
+        self.interval = interval
+        self.start_time = time.time()
+        self.n_plans = 1
+        self.n_cases = 1
+        self.plan_index = -1
+        self.case_index = -1
+        self.fold = 0
+        self.n_folds = 1
+        self.tile = 0
+        self.n_tiles = 0
+        self._last_tile_time = 0
+        self._preview_start = None
+        self._lock = threading.Lock()
+
+    def get_progress(self):
+        fold = self.fold + (self.tile / self.n_tiles if self.n_tiles > 0 else 0)
+        case = max(self.case_index, 0) + min(fold / self.n_folds, 1)
+        plan = max(self.plan_index, 0) + min(case / self.n_cases, 1)
+        return min(plan / self.n_plans, 1.0)
+
+    def update(self, event):
+        name = event["event"]
+        if name == "run_start":
+            self.start_time = event["time"]
+            self.n_plans = max(len(event.get("plans", [])), 1)
+            self.n_cases = max(event.get("cases", 1), 1)
+            self.plan_index = -1
+        elif name == "plan_start":
+            self.plan_index += 1
+            self.case_index = -1
+            self.fold, self.tile, self.n_tiles = 0, 0, 0
+        elif name == "case_start":
+            self.case_index += 1
+            self.fold, self.tile, self.n_tiles = 0, 0, 0
+        elif name in ("fold_start", "tile"):
+            self.fold, self.n_folds = event["fold"], max(event["n_folds"], 1)
+            self.tile, self.n_tiles = event.get("tile", 0), event.get("n_tiles", 0)
+        elif name == "fold_end":
+            self.fold, self.tile = event["fold"] + 1, 0
+        elif name == "preview_start":
+            self._preview_start = event["time"]
+        elif name == "preview_end" and self._preview_start is not None:
+            # a preview within the run (lyroi -i folder --preview) does not count for the remaining time
+            if self.start_time <= self._preview_start:
+                self.start_time += event["time"] - self._preview_start
+            self._preview_start = None
+
+    def __call__(self, event):
+        with self._lock:
+            preview = event.get("preview", False)
+            if not preview:
+                self.update(event)
+            if event["event"] == "tile" and event["tile"] < event["n_tiles"]:
+                if event["time"] - self._last_tile_time < self.interval:
+                    return
+                self._last_tile_time = event["time"]
+            record = dict(event)
+            if not preview:
+                record["progress"] = round(self.get_progress(), 4)
+                elapsed = event["time"] - self.start_time
+                if 0 < record["progress"] < 1:
+                    record["eta"] = round(elapsed * (1 - record["progress"]) / record["progress"], 1)
+            try:
+                self.stream.write(json.dumps(record, default=str) + "\n")
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass  # the reader went away, progress reporting must never stop the inference
+
+
+class ProgressEventParser:
+    # Counterpart of JsonlProgressWriter: turns the JSON lines into task (current case) and total progress in percent.
+    # Returns progress only when one of the values changed, which limits the number of updates of the GUI. The estimated
+    # remaining time of the last parsed event is kept in eta
+    def __init__(self):
+        self._last = None
+        self.eta = None
+
+    def parse(self, line: str) -> Optional[Tuple[int, int]]:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return None
+        # events of a preview carry no progress
+        if not isinstance(event, dict) or "progress" not in event:
+            return None
+        self.eta = event.get("eta")
+        name = event.get("event")
+        if name in ("fold_start", "fold_end", "tile"):
+            fold = event["fold"] + (1 if name == "fold_end" else 0)
+            if name == "tile" and event["n_tiles"] > 0:
+                fold += event["tile"] / event["n_tiles"]
+            task = round(100 * fold / max(event["n_folds"], 1))
+        elif name == "case_start":
+            task = 0
+        elif self._last is not None:
+            task = self._last[0]
+        else:
+            task = 0
+        progress = (min(task, 100), round(100 * event["progress"]))
+        if progress == self._last:
+            return None
+        self._last = progress
+        return progress
@@ -0,0 +1,81 @@
+import json
+import platform
+import socket
+from datetime import datetime
+from pathlib import Path
+
+from lyroi import __version__
+from lyroi.placement import describe_placement
+
+
+class RunReport:
+    # collects stage timings per case, plan and stage from the events and writes them as JSON
+    def __init__(self):
+        self.info = {}
+        self.stages = {}
+        self.plans = {}
+        self.cases = {}
+        self.tiles = {}
+
+    def __call__(self, event):
+        name = event["event"]
+        if name == "run_start":
+            self.info.update({k: v for k, v in event.items() if k not in ("event", "time")})
+            self.info["start"] = datetime.fromtimestamp(event["time"]).isoformat(timespec="seconds")
+        elif name == "run_end":
+            self.info["total_seconds"] = round(event["seconds"], 3)
+            self.info["status"] = event.get("status", "finished")
+        elif name == "preview_end":
+            self.info["time_to_first_mask"] = round(event["seconds"], 3)
+        elif name == "preprocessing_reused":
+            saved = self.info.get("preprocessing_saved_seconds", 0) + event["seconds"]
+            self.info["preprocessing_saved_seconds"] = round(saved, 3)
+        elif name in ("tta", "cascade"):
+            # tiles with full test-time augmentation (and the validation against full mirroring) or predicted by the
+            # full ensemble of the cascade
+            target = self.cases.setdefault(event["case"], {}).setdefault("plans", {}).setdefault(event["plan"], {})
+            target[name] = {k: v for k, v in event.items() if k not in ("event", "time", "case", "plan")}
+            tiles = self.tiles.setdefault(name, [0, 0])
+            tiles[0] += event["tiles"]
+            tiles[1] += event["n_tiles"]
+            key = "tta_full_fraction" if name == "tta" else "cascade_tile_fraction"
+            self.info[key] = round(tiles[0] / max(tiles[1], 1), 4)
+        elif name == "early_exit":
+            self.cases.setdefault(event["case"], {})["early_exit"] = {
+                "models": event["models"], "added_volume": event["added_volume"], "skipped": event["skipped"]}
+        elif name == "early_exit_summary":
+            self.info["early_exit"] = {k: v for k, v in event.items() if k not in ("event", "time")}
+        elif name == "stage":
+            self.add_stage(event["stage"], event["seconds"], event.get("case"), event.get("plan"))
+
+    def add_stage(self, stage, seconds, case=None, plan=None):
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+        if case is not None:
+            target = self.cases.setdefault(case, {})
+            if plan is not None:
+                target = target.setdefault("plans", {}).setdefault(plan, {})
+        elif plan is not None:
+            target = self.plans.setdefault(plan, {})
+        else:
+            return
+        target[stage] = target.get(stage, 0) + seconds
+
+    def to_dict(self):
+        def rounded(d):
+            return {k: rounded(v) if isinstance(v, dict) else round(v, 3) if isinstance(v, float) else v
+                    for k, v in d.items()}
+
+        return {
+            "lyroi_version": __version__,
+            "host": socket.gethostname(),
+            "platform": platform.platform(),
+            "cpu_placement": describe_placement(),
+            **self.info,
+            "stages": rounded(self.stages),
+            "plans": rounded(self.plans),
+            "cases": rounded(self.cases),
+        }
+
+    def write(self, report_file):
+        Path(report_file).parent.mkdir(exist_ok=True, parents=True)
+        Path(report_file).write_text(json.dumps(self.to_dict(), indent=2))
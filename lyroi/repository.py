@@ -0,0 +1,99 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+from lyroi.utils import get_lyroi_dir
+
+# Metadata of the online model repository (record URL, VERSION file, archive sizes). All lookups and the downloads of
+# lyroi.download share one HTTP session. Lookups are cached on disk, so that version checks in the GUI and in
+# lyroi_install need one round trip or none
+RECORD_URL = "https://rodare.hzdr.de/record/4160"  # collection of sources, redirects to the latest version
+TIMEOUT = 15
+DEFAULT_TTL = 3600  # seconds, can be changed with LYROI_CACHE_TTL
+
+_session = None
+_pool_size = 0
+_session_lock = threading.Lock()
+_cache_lock = threading.Lock()
+
+
+def get_session(max_connections=8):
+    # the connection pool grows with the number of parallel downloads (lyroi_install --connections)
+    global _session, _pool_size
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+        if max_connections > _pool_size:
+            _pool_size = max_connections
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=_pool_size, max_retries=2)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+def get_cache_path():
+    return str(Path(get_lyroi_dir(), "cache", "repository.json"))
+
+def get_ttl():
+    return float(os.environ.get("LYROI_CACHE_TTL", DEFAULT_TTL))
+
+def load_cache():
+    try:
+        return json.loads(Path(get_cache_path()).read_text())
+    except Exception as e:
+        return {}
+
+def save_cache(cache):
+    cache_path = Path(get_cache_path())
+    try:
+        cache_path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = cache_path.with_suffix(".%d.tmp" % os.getpid())
+        tmp_path.write_text(json.dumps(cache, indent=2))
+        tmp_path.replace(cache_path)
+    except OSError as e:
+        pass  # read-only LyROI directory, the lookups just are not cached
+
+def cached(key, fetch, refresh=False):
+    # value of key from the on-disk cache if it is younger than the TTL, otherwise fetch() and store it
+    with _cache_lock:
+        entry = load_cache().get(key)
+    if not refresh and entry is not None and time.time() - entry["time"] < get_ttl():
+        return entry["value"]
+    value = fetch()
+    with _cache_lock:
+        cache = load_cache()
+        cache[key] = {"value": value, "time": time.time()}
+        save_cache(cache)
+    return value
+
+def clear_cache():
+    Path(get_cache_path()).unlink(missing_ok=True)
+
+def resolve_record_url(refresh=False):
+    def fetch():
+        r = get_session().head(RECORD_URL, allow_redirects=True, timeout=TIMEOUT)
+        r.raise_for_status()
+        return r.url
+    return cached("record_url", fetch, refresh)
+
+def get_versions(repository_url, refresh=False):
+    # content of the VERSION file: latest version per mode
+    def fetch():
+        r = get_session().get(repository_url + "/files/VERSION", timeout=TIMEOUT)
+        r.raise_for_status()
+        return json.loads(r.content.decode("utf-8"))
+    return cached("versions:" + repository_url, fetch, refresh)
+
+def get_file_sizes(urls, refresh=False):
+    # content lengths of the files, requested concurrently
+    def fetch(url):
+        r = get_session().head(url, allow_redirects=True, timeout=TIMEOUT)
+        r.raise_for_status()
+        return int(r.headers["content-length"])
+
+    with ThreadPoolExecutor(max_workers=max(min(len(urls), 8), 1)) as executor:
+        return list(executor.map(lambda url: cached("size:" + url, lambda: fetch(url), refresh), urls))
@@ -0,0 +1,160 @@
+import json
+import threading
+import time
+from pathlib import Path
+
+import psutil
+
+from lyroi.events import add_listener, remove_listener
+from lyroi.placement import get_affinity
+from lyroi.utils import format_file_size
+
+
+def get_device_memory(torch_device):
+    # currently allocated device memory in bytes, None if not available for the device
+    import torch
+    if torch_device is None:
+        return None
+    if torch_device.type == "cuda":
+        return torch.cuda.memory_allocated(torch_device)
+    if torch_device.type == "mps":
+        return torch.mps.driver_allocated_memory()
+    return None
+
+
+class ResourceSampler:
+    # samples memory and cpu usage of this process and its worker children in a background thread. Subscribes to the
+    # inference events to attribute the samples to the cases that are in flight
+    def __init__(self, torch_device=None, interval=0.5):
+        self.torch_device = torch_device
+        self.interval = interval
+        self.samples = []
+        self.cases = {}
+        self.active_cases = set()
+        self.n_cpus = len(get_affinity() or range(psutil.cpu_count(logical=True)))
+        self._processes = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_time = None
+
+    def _get_processes(self):
+        main = psutil.Process()
+        processes = {main.pid: self._processes.get(main.pid, main)}
+        for child in main.children(recursive=True):
+            # keep the process objects, cpu_percent() measures the time since its previous call
+            processes[child.pid] = self._processes.get(child.pid, child)
+        self._processes = processes
+        return processes.values()
+
+    def sample(self):
+        rss, cpu, n_processes = 0, 0.0, 0
+        for process in self._get_processes():
+            try:
+                with process.oneshot():
+                    rss += process.memory_info().rss
+                    cpu += process.cpu_percent(None)
+                n_processes += 1
+            except psutil.Error:
+                pass  # worker exited in the meantime
+        device = get_device_memory(self.torch_device)
+        sample = {"t": round(time.perf_counter() - self._start_time, 2), "rss": rss, "cpu": round(cpu, 1),
+                  "processes": n_processes}
+        if device is not None:
+            sample["device"] = device
+
+        with self._lock:
+            self.samples.append(sample)
+            for case in self.active_cases:
+                stats = self.cases[case]
+                stats["rss_peak"] = max(stats["rss_peak"], rss)
+                stats["cpu_sum"] += cpu
+                stats["n_samples"] += 1
+                if device is not None:
+                    stats["device_peak"] = max(stats.get("device_peak", 0), device)
+
+    def __call__(self, event):
+        name = event["event"]
+        case = event.get("case")
+        with self._lock:
+            if name == "case_start":
+                self.cases.setdefault(case, {"rss_peak": 0, "cpu_sum": 0.0, "n_samples": 0})
+                self.active_cases.add(case)
+                if self.torch_device is not None and self.torch_device.type == "cuda":
+                    import torch
+                    torch.cuda.reset_peak_memory_stats(self.torch_device)
+            elif name == "case_end":
+                self.active_cases.discard(case)
+            elif name == "stage" and event["stage"] == "sliding_window" and case in self.cases:
+                # the sampling interval is too coarse for the short device memory peaks of the sliding window
+                if self.torch_device is not None and self.torch_device.type == "cuda":
+                    import torch
+                    peak = torch.cuda.max_memory_allocated(self.torch_device)
+                    self.cases[case]["device_peak"] = max(self.cases[case].get("device_peak", 0), peak)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._start_time = time.perf_counter()
+        self._stop.clear()
+        add_listener(self)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        remove_listener(self)
+
+    def get_case_stats(self):
+        stats = {}
+        for case, case_stats in self.cases.items():
+            stats[case] = {"rss_peak": case_stats["rss_peak"],
+                           "cpu_mean": round(case_stats["cpu_sum"] / max(case_stats["n_samples"], 1), 1)}
+            if "device_peak" in case_stats:
+                stats[case]["device_peak"] = case_stats["device_peak"]
+        return stats
+
+    def get_summary(self):
+        summary = {"duration": self.samples[-1]["t"] if self.samples else 0,
+                   "n_samples": len(self.samples),
+                   "n_cpus": self.n_cpus,
+                   "rss_peak": max([s["rss"] for s in self.samples], default=0),
+                   "cpu_mean": round(sum(s["cpu"] for s in self.samples) / max(len(self.samples), 1), 1)}
+        # cpu is given in percent of one core
+        summary["cpu_utilization"] = round(summary["cpu_mean"] / self.n_cpus, 1)
+        device = [s["device"] for s in self.samples if "device" in s]
+        device += [c["device_peak"] for c in self.cases.values() if "device_peak" in c]
+        if len(device) > 0:
+            summary["device_peak"] = max(device)
+        return summary
+
+    def write(self, telemetry_file):
+        Path(telemetry_file).parent.mkdir(exist_ok=True, parents=True)
+        telemetry = {"interval": self.interval, "summary": self.get_summary(), "cases": self.get_case_stats(),
+                     "samples": self.samples}
+        Path(telemetry_file).write_text(json.dumps(telemetry, indent=1))
+
+    def print_summary(self):
+        summary = self.get_summary()
+        line = (f"Resource usage: peak memory {format_file_size(summary['rss_peak'])}, average CPU utilization "
+                f"{summary['cpu_utilization']:.1f}% of {summary['n_cpus']} CPUs")
+        if "device_peak" in summary:
+            line += f", peak device memory {format_file_size(summary['device_peak'])}"
+        print(line)
+        for case, stats in self.get_case_stats().items():
+            line = f"  {case}: peak memory {format_file_size(stats['rss_peak'])}, average CPU {stats['cpu_mean']:.0f}%"
+            if "device_peak" in stats:
+                line += f", peak device memory {format_file_size(stats['device_peak'])}"
+            print(line)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,220 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+from lyroi.events import add_listener, remove_listener
+from lyroi.utils import get_lyroi_dir, format_time, update_profile
+from lyroi.placement import get_core_count
+from lyroi.modes import get_model_folders, get_folds, get_suffix_dict
+
+
+def write_synthetic_case(folder, case_id, mode, shape, spacing, seed=0):
+    rng = np.random.default_rng(seed)
+    affine = np.diag(list(spacing) + [1.0])
+
+    # body-like ellipsoid, so that cropping to nonzero region does not trivially shrink the volume
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    body = sum(((g - s / 2) / (s / 2.2)) ** 2 for g, s in zip(grid, shape)) < 1
+
+    for modality, suffix in get_suffix_dict(mode).items():
+        if modality == "CT":
+            vol = np.full(shape, -1000, dtype=np.int16)
+            vol[body] = rng.normal(40, 60, size=int(body.sum())).astype(np.int16)
+        else:
+            vol = np.zeros(shape, dtype=np.float32)
+            vol[body] = rng.gamma(2.0, 0.5, size=int(body.sum()))
+            # a few hot spots to keep the networks busy
+            for _ in range(5):
+                center = [rng.integers(s // 4, 3 * s // 4) for s in shape]
+                spot = sum(((g - c) / 4) ** 2 for g, c in zip(grid, center)) < 1
+                vol[spot] += 10.0
+        nib.save(nib.Nifti1Image(vol, affine), Path(folder, case_id + suffix + ".nii.gz"))
+
+def write_synthetic_cases(folder, mode, n_cases, shape, spacing):
+    Path(folder).mkdir(exist_ok=True, parents=True)
+    for i in range(n_cases):
+        write_synthetic_case(folder, "synthetic_%03d" % i, mode, shape, spacing, seed=i)
+
+def get_candidates(device):
+    n_cores = get_core_count()
+    powers = [2 ** i for i in range(int(np.log2(n_cores)) + 1)]
+    if device == "cpu":
+        thread_limit = min(8, n_cores)
+    elif device == "cpu-max":
+        thread_limit = n_cores
+    else:
+        thread_limit = min(4, n_cores)  # the host only feeds the accelerator
+    threads = sorted(set([t for t in powers if t <= thread_limit] + [thread_limit]))
+    n_proc = sorted(set([t for t in powers if t <= n_cores] + [n_cores]))
+    pools = sorted(set([p for p in [1, 2, 3, 4, 6] if p <= max(1, n_cores // 2)]))
+    return {"torch_threads": threads,
+            "n_proc": n_proc,
+            "num_processes_preprocessing": pools,
+            "num_processes_segmentation_export": pools}
+
+def get_default_settings(device):
+    n_cores = get_core_count()
+    threads = {"cpu": min(8, n_cores), "cpu-max": n_cores}.get(device, 1)
+    return {"torch_threads": threads,
+            "n_proc": n_cores,
+            "num_processes_preprocessing": 3,
+            "num_processes_segmentation_export": 3}
+
+def _run_trial(settings, device, input_folder, output_folder, model_folder, folds, result_queue):
+    # executed in a fresh process, so that OMP/MKL and nnU-Net pick up the environment at import time
+    os.environ['OMP_NUM_THREADS'] = str(settings["torch_threads"])
+    os.environ['MKL_NUM_THREADS'] = str(settings["torch_threads"])
+    os.environ['nnUNet_def_n_proc'] = str(settings["n_proc"])
+    try:
+        from lyroi.nnunet_interface import nnunet_predict, get_torch_device, shutdown_worker_pools
+        torch_device = get_torch_device(device, settings["torch_threads"])
+        start_time = time.time()
+        nnunet_predict(input_folder, output_folder, model_folder, folds, torch_device, progress_bar=False,
+                       num_processes_preprocessing=settings["num_processes_preprocessing"],
+                       num_processes_segmentation_export=settings["num_processes_segmentation_export"])
+        result_queue.put(time.time() - start_time)
+        shutdown_worker_pools()  # not done at exit in a multiprocessing child
+    except Exception as e:
+        print("Trial failed:", e)
+        result_queue.put(None)
+
+def run_trial(settings, device, input_folder, output_folder, model_folder, folds):
+    context = multiprocessing.get_context("spawn")
+    result_queue = context.Queue()
+    process = context.Process(target=_run_trial,
+                              args=(settings, device, str(input_folder), str(output_folder), model_folder, folds,
+                                    result_queue))
+    process.start()
+    process.join()
+    try:
+        return result_queue.get(timeout=5)
+    except queue.Empty:
+        return None  # the trial process died without reporting back
+
+def tune(mode, device, shape=(192, 192, 256), spacing=(2.0, 2.0, 3.0), n_cases=3, folds=None, exhaustive=False):
+    model_folder = get_model_folders(mode)[0]
+    if folds is None:
+        folds = get_folds(mode)[:1]
+    candidates = get_candidates(device)
+    results = {}
+
+    with tempfile.TemporaryDirectory(prefix="tune-", dir=get_lyroi_dir()) as tmp_dir:
+        input_folder = Path(tmp_dir, "input")
+        output_folder = Path(tmp_dir, "output")
+        print(f"Generating {n_cases} synthetic case(s) of shape {tuple(shape)}")
+        write_synthetic_cases(input_folder, mode, n_cases, shape, spacing)
+
+        def evaluate(settings):
+            key = tuple(sorted(settings.items()))
+            if key not in results:
+                print("Trial:", ", ".join(f"{k}={v}" for k, v in settings.items()), end=" ... ", flush=True)
+                elapsed = run_trial(settings, device, input_folder, output_folder, model_folder, folds)
+                print(format_time(elapsed) if elapsed is not None else "failed")
+                results[key] = elapsed
+            return results[key]
+
+        if exhaustive:
+            names = list(candidates.keys())
+            for values in itertools.product(*candidates.values()):
+                evaluate(dict(zip(names, values)))
+        else:
+            # coordinate descent: optimize one parameter at a time, keeping the best values for the others
+            best = get_default_settings(device)
+            for name, values in candidates.items():
+                timings = {}
+                for value in values:
+                    timings[value] = evaluate({**best, name: value})
+                timings = {k: v for k, v in timings.items() if v is not None}
+                if len(timings) > 0:
+                    best[name] = min(timings, key=timings.get)
+
+    successful = {k: v for k, v in results.items() if v is not None}
+    if len(successful) == 0:
+        raise RuntimeError("All tuning trials failed, the performance profile was not updated")
+
+    best_key = min(successful, key=successful.get)
+    profile = dict(best_key)
+    profile["time"] = round(successful[best_key], 3)
+    profile["mode"] = mode
+    profile["shape"] = list(shape)
+    profile["date"] = datetime.now().isoformat(timespec="seconds")
+
+    def keep_plan_seconds(previous):
+        # measured by the runs, not by the tuning
+        return {**profile, "plan_seconds": previous["plan_seconds"]} if "plan_seconds" in previous else profile
+
+    update_profile(device, keep_plan_seconds)
+    return profile
+
+def compare_masks(mask, reference):
+    # voxel and lesion sensitivity of mask with respect to reference, and the Dice coefficient of both
+    from scipy import ndimage
+    lesions, n_lesions = ndimage.label(reference)
+    detected = len(np.setdiff1d(np.unique(lesions[mask]), [0]))
+    overlap = np.count_nonzero(mask & reference)
+    volume = np.count_nonzero(mask) + np.count_nonzero(reference)
+    return {"voxel_sensitivity": overlap / np.count_nonzero(reference) if reference.any() else 1.0,
+            "lesions": n_lesions,
+            "detected_lesions": detected,
+            "dice": 2 * overlap / volume if volume > 0 else 1.0}
+
+def benchmark_cascade(mode, device, input_folder, thresholds, reference_folder=None):
+    # runs the full ensemble and the cascade with each candidate threshold on the cases of input_folder. Sensitivity is
+    # measured against the masks in reference_folder (<case>.nii.gz), or against the full ensemble without them
+    from lyroi.inference import predict_from_folder, get_cases
+    cases = sorted(get_cases(input_folder, mode))
+    runs = [("full", None)] + [("%g" % threshold, threshold) for threshold in thresholds]
+    stages = {}
+
+    def collect(event):
+        if event["event"] == "stage" and event["stage"] in ("preprocessing", "sliding_window"):
+            stages[event["stage"]] = stages.get(event["stage"], 0) + event["seconds"]
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="cascade-", dir=get_lyroi_dir()) as tmp_dir:
+        add_listener(collect)
+        try:
+            for name, threshold in runs:
+                print(f"\nPredicting {len(cases)} case(s) " +
+                      ("with the full ensemble" if threshold is None else f"with the cascade (threshold {name})"))
+                stages.clear()
+                output = Path(tmp_dir, name)
+                output.mkdir()
+                start_time = time.time()
+                predict_from_folder(input_folder, output, mode, device, progress_bar=False, cascade=threshold)
+                results[name] = {"threshold": threshold, "seconds": time.time() - start_time,
+                                 "sliding_window_seconds": stages.get("sliding_window", 0)}
+        finally:
+            remove_listener(collect)
+
+        for name, threshold in runs:
+            totals = {"overlap": 0, "reference": 0, "lesions": 0, "detected_lesions": 0}
+            dice = []
+            for case_id in cases:
+                mask = np.asarray(nib.load(Path(tmp_dir, name, case_id + ".nii.gz")).dataobj) > 0
+                reference_file = Path(reference_folder or Path(tmp_dir, "full"), case_id + ".nii.gz")
+                reference = np.asarray(nib.load(reference_file).dataobj) > 0
+                comparison = compare_masks(mask, reference)
+                totals["overlap"] += comparison["voxel_sensitivity"] * np.count_nonzero(reference)
+                totals["reference"] += np.count_nonzero(reference)
+                totals["lesions"] += comparison["lesions"]
+                totals["detected_lesions"] += comparison["detected_lesions"]
+                dice.append(comparison["dice"])
+            results[name].update({
+                "voxel_sensitivity": totals["overlap"] / totals["reference"] if totals["reference"] > 0 else 1.0,
+                "lesion_sensitivity": (totals["detected_lesions"] / totals["lesions"] if totals["lesions"] > 0
+                                       else 1.0),
+                "mean_dice": float(np.mean(dice)),
+            })
+    full_seconds = results["full"]["sliding_window_seconds"]
+    for result in results.values():
+        result["speedup"] = full_seconds / result["sliding_window_seconds"] if result["sliding_window_seconds"] else None
+    return results
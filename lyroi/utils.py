@@ -3,10 +3,12 @@ import os
 import shutil
 import sys
 import math
-import requests
-import psutil
 import hashlib
+import socket
+import time
+import uuid
 
+from contextlib import contextmanager
 from typing import Union, List, overload
 from pathlib import Path
 from lyroi.modes import get_model_folders, get_folds, get_archive_names
@@ -46,11 +48,11 @@ def format_file_size(size_bytes):
    s = round(size_bytes / p, 2)
    return "%s %s" % (s, size_name[i])
 
-def get_repository_url():
+def get_repository_url(refresh=False):
+    from lyroi.repository import resolve_record_url
     try:
         # collection of sources. Should automatically resolve to the latest versions of the models
-        r = requests.head("https://rodare.hzdr.de/record/4160", allow_redirects=True)
-        return r.url
+        return resolve_record_url(refresh)
     except Exception as e:
         exit("Cannot reach the online model repository! Please check your internet connection or contact the developer.")
 
@@ -62,46 +64,90 @@ def get_download_urls(mode, repository_url = None):
     return download_urls
 
 def get_download_size(mode):
+    from lyroi.repository import get_file_sizes
     download_urls = get_download_urls(mode)
     try:
-        size = 0
-        for url in download_urls:
-            r = requests.head(url)
-            size += int(r.headers['content-length'])
-        return size
+        return sum(get_file_sizes(download_urls))
     except Exception as e:
         exit("Cannot locate the model files! Please check your internet connection or contact the developer.")
 
-def install_model(mode):
-    from nnunetv2.model_sharing.model_download import download_and_install_from_url
-    repository_url = get_repository_url()
-    ver = check_version_online(mode, repository_url)
-
-    # downloading and installing
-    download_urls = get_download_urls(mode, repository_url)
-    print("Wait until all downloads are finished")
-    for url in download_urls:
-        download_and_install_from_url(url)
-
-    # writing a current version
-    model_folders = get_model_folders(mode)
-    for folder in model_folders:
-        Path(folder, "VERSION").write_text(ver)
+def install_model(mode, from_dir=None, mirror=None, max_connections=3, system=False):
+    from lyroi.download import install_models
+    install_models(mode, from_dir=from_dir, mirror=mirror, max_connections=max_connections, system=system)
 
 def check_version_online(mode, repository_url = None):
+    from lyroi.repository import get_versions
     if repository_url is None:
         repository_url = get_repository_url()
     try:
-        r = requests.get(repository_url + "/files/VERSION")
-        version_file = r.content.decode("utf-8")
-        j_file = json.loads(version_file)
-        return j_file[mode]
+        return get_versions(repository_url)[mode]
     except Exception as e:
         exit("Cannot find version info in the online model repository! Please contact the developer.")
 
-def check_version_local(mode):
+def get_manifest_path(mode, root=None):
+    root = get_model_root(mode) if root is None else root
+    return str(Path(root, "manifest_" + mode + ".json"))
+
+def read_manifest(mode, root=None):
+    try:
+        return json.loads(Path(get_manifest_path(mode, root)).read_text())
+    except Exception:
+        return None
+
+def get_model_files(mode, root=None):
+    # files that make up an installation: dataset and plans of every model and the checkpoints of all folds
+    files = []
+    for folder in get_model_folders(mode, root):
+        files += [Path(folder, "dataset.json"), Path(folder, "plans.json")]
+        files += [Path(folder, "fold_" + str(fold), "checkpoint_final.pth") for fold in get_folds(mode)]
+    return files
+
+def write_manifest(mode, version, root):
+    # written at the end of the installation. Status checks then only read this file instead of probing every file
+    from concurrent.futures import ThreadPoolExecutor
+    from lyroi.download import compute_checksum
+    files = get_model_files(mode, root)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        checksums = list(executor.map(compute_checksum, files))
+    manifest = {
+        "mode": mode,
+        "version": version,
+        "installed": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "files": {str(Path(file).relative_to(root)):
+                      {"size": Path(file).stat().st_size, "checksum": checksum}
+                  for file, checksum in zip(files, checksums)},
+    }
+    manifest_path = Path(get_manifest_path(mode, root))
+    tmp_path = manifest_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2))
+    tmp_path.replace(manifest_path)
+
+def verify_model(mode, root=None):
+    # deep check of an installation against its manifest. Returns a list of problems (empty if everything is fine)
+    from lyroi.download import verify_checksum
+    root = get_model_root(mode) if root is None else root
+    manifest = read_manifest(mode, root)
+    if manifest is None:
+        return ["No installation manifest found"]
+    problems = []
+    for name, info in manifest["files"].items():
+        file = Path(root, name)
+        if not file.exists():
+            problems.append(f"{name}: missing")
+        elif file.stat().st_size != info["size"]:
+            problems.append(f"{name}: size mismatch")
+        elif not verify_checksum(file, info["checksum"]):
+            problems.append(f"{name}: checksum mismatch")
+    return problems
+
+def check_version_local(mode, root=None):
+    manifest = read_manifest(mode, root)
+    if manifest is not None:
+        return manifest["version"]
+
+    # installations without a manifest
     version_list = []
-    model_folders = get_model_folders(mode)
+    model_folders = get_model_folders(mode, root)
     for folder in model_folders:
         if Path(folder, "VERSION").exists():
             version_list.append(Path(folder, "VERSION").read_text())
@@ -116,9 +162,14 @@ def check_version_local(mode):
 
     return uniques.pop()
 
-def check_model(mode):
+def check_model(mode, root=None):
+    root = get_model_root(mode) if root is None else root
+    if read_manifest(mode, root) is not None:
+        return True
+
+    # installations without a manifest (e.g., older versions of LyROI) are checked file by file
     try:
-        folder_list = get_model_folders(mode)
+        folder_list = get_model_folders(mode, root)
     except Exception as e:
         return False
     if len(folder_list) == 0:
@@ -141,6 +192,69 @@ def get_lyroi_dir():
 def get_models_dir():
     return str(Path(get_lyroi_dir(), "nnUNet_results"))
 
+def get_system_dir():
+    # optional system-wide LyROI directory (e.g., /opt/lyroi) with models shared by all users, usually read-only
+    return os.environ.get("LYROI_SYSTEM_DIR")
+
+def get_system_models_dir():
+    return str(Path(get_system_dir(), "nnUNet_results")) if get_system_dir() is not None else None
+
+def get_store_dirs():
+    # model stores in lookup order: the per-user store overlays the system-wide one
+    stores = [get_models_dir()]
+    if get_system_models_dir() is not None:
+        stores.append(get_system_models_dir())
+    return stores
+
+def get_pointer_path(store, mode):
+    return str(Path(store, "current_" + mode))
+
+def get_store_root(store, mode):
+    # installations are versioned folders in <store>/versions and the pointer file names the current one, so that an
+    # installation becomes visible at once. Older LyROI versions extracted the models directly into the store
+    try:
+        return str(Path(store, "versions", Path(get_pointer_path(store, mode)).read_text().strip()))
+    except OSError as e:
+        return store
+
+def get_model_root(mode):
+    # folder with the Dataset001_* folder of the mode: from the first store in which the mode is installed
+    roots = [get_store_root(store, mode) for store in get_store_dirs()]
+    return next((root for root in roots if check_model(mode, root)), roots[0])
+
+def get_profile_path():
+    return str(Path(get_lyroi_dir(), "profile.json"))
+
+def load_profile(device=None):
+    # per-device performance profile written by lyroi_tune
+    profile_path = Path(get_profile_path())
+    if not profile_path.exists():
+        return {}
+    try:
+        profiles = json.loads(profile_path.read_text())
+    except Exception as e:
+        print("Cannot read the performance profile " + str(profile_path) + ", using defaults")
+        return {}
+    if device is None:
+        return profiles
+    return profiles.get(device, {})
+
+def update_profile(device, update):
+    # read-modify-write of the profile of a device under a lock, so that concurrent runs do not lose each other's
+    # updates. update gets the current profile of the device and returns the new one
+    lock_path = Path(get_lyroi_dir(), "locks", "profile.lock")
+    wait_for_lock(lock_path, timeout=60, interval=0.1)
+    try:
+        profiles = load_profile()
+        profiles[device] = update(profiles.get(device, {}))
+        profile_path = Path(get_profile_path())
+        profile_path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = profile_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(profiles, indent=2))
+        tmp_path.replace(profile_path)
+    finally:
+        release_lock(lock_path)
+
 def get_tmp_dir(output_dir: Path, mode: str, run_id: Union[str, List[str]]):
     if isinstance(run_id, list):
         run_id = [str(x) for x in run_id] # just to make sure
@@ -151,12 +265,155 @@ def get_tmp_dir(output_dir: Path, mode: str, run_id: Union[str, List[str]]):
     run_hash = hashlib.md5(run_id.encode()).hexdigest()[:16]
     return str(Path(output_dir, ".lyroi-"+run_hash))
 
-def clean_temp_dir(output_dir: Path, mode: str, run_id: Union[str, List[str]]):
-    shutil.rmtree(get_tmp_dir(output_dir, mode, run_id), ignore_errors=True)
+def get_scratch_dir(scratch=None):
+    # fast local storage (e.g., /dev/shm or a local NVMe drive) for the temporary directories instead of the output
+    # folder, set with --scratch or LYROI_SCRATCH
+    return scratch if scratch is not None else os.environ.get("LYROI_SCRATCH")
+
+def get_run_prefix(output_dir: Path, mode: str, run_id: Union[str, List[str]], scratch=None):
+    if scratch is None:
+        return get_tmp_dir(output_dir, mode, run_id)
+    # runs with different output folders share the scratch directory
+    run_id = run_id if isinstance(run_id, list) else [run_id]
+    return get_tmp_dir(Path(scratch), mode, [Path(output_dir).absolute()] + run_id)
+
+def clean_temp_dir(output_dir: Path, mode: str, run_id: Union[str, List[str]], scratch=None):
+    # temporary directories of earlier runs with the same inputs that are no longer running. Runs with a scratch
+    # directory fall back to the output folder if the scratch directory is too small, so both are cleaned
+    prefixes = [get_run_prefix(output_dir, mode, run_id)]
+    if scratch is not None:
+        prefixes.append(get_run_prefix(output_dir, mode, run_id, scratch))
+    return sum(reclaim_run_dirs(prefix, include_unlocked=True) for prefix in prefixes)
+
+def get_run_lock_path(tmp_dir):
+    return str(tmp_dir) + ".lock"
+
+def create_run_dir(output_dir: Path, mode: str, run_id: Union[str, List[str]], scratch=None):
+    # unique temporary directory of a run (<get_tmp_dir>-<token>) owned by the PID lock file next to it, so that
+    # concurrent runs on the same inputs and output folder never share or delete each other's intermediates
+    prefix = get_run_prefix(output_dir, mode, run_id, scratch)
+    reclaim_run_dirs(prefix)
+    while True:
+        tmp_dir = prefix + "-" + uuid.uuid4().hex[:8]
+        # the lock is taken before the directory exists, so a directory without a lock is never one of a live run
+        if acquire_lock(get_run_lock_path(tmp_dir), mode=mode):
+            Path(tmp_dir).mkdir(parents=True)
+            return tmp_dir
+
+def release_run_dir(tmp_dir):
+    delete_dir(tmp_dir)
+    release_lock(get_run_lock_path(tmp_dir))
+
+def reclaim_run_dirs(prefix, include_unlocked=False):
+    # removes the temporary directories starting with prefix whose owner process has died. Directories without a lock
+    # (left by older LyROI versions) are only removed on request. Returns the number of removed directories
+    prefix = Path(prefix)
+    removed = 0
+    for path in prefix.parent.glob(prefix.name + "*"):
+        # run locks have unique names and are never taken over (see acquire_lock), so a stale one can be removed without
+        # the guard
+        if path.name.endswith(".lock"):
+            # lock of a run that died between removing its directory and releasing the lock
+            if not Path(str(path)[:-len(".lock")]).exists() and is_lock_stale(path):
+                path.unlink(missing_ok=True)
+            continue
+        lock_path = Path(get_run_lock_path(path))
+        if lock_path.exists() and is_lock_stale(lock_path) or not lock_path.exists() and include_unlocked:
+            delete_dir(path)
+            lock_path.unlink(missing_ok=True)
+            removed += 1
+    return removed
 
 def delete_dir(temp_dir: Path):
     shutil.rmtree(temp_dir, ignore_errors=True)
 
+def read_lock(lock_path: Path):
+    try:
+        return json.loads(Path(lock_path).read_text())
+    except Exception:
+        return None
+
+def is_lock_stale(lock_path: Path):
+    info = read_lock(lock_path)
+    if info is None:
+        # unreadable lock. Give the owner a moment in case it is still being written
+        try:
+            return time.time() - Path(lock_path).stat().st_mtime > 10
+        except FileNotFoundError:
+            return True
+    if info.get("host") != socket.gethostname():
+        return False # cannot check processes on other hosts
+    import psutil
+    return not psutil.pid_exists(info.get("pid", -1))
+
+@contextmanager
+def lock_guard(lock_path: Path):
+    # exclusive OS lock on <lock>.guard, held while a stale lock is taken over. The OS releases it when the process dies,
+    # so it cannot go stale itself. The guard file is never removed, a removed file could be locked twice
+    with open(str(lock_path) + ".guard", "a+") as guard:
+        guard.seek(0)
+        if os.name == "nt":
+            import msvcrt
+            msvcrt.locking(guard.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(guard.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                guard.seek(0)
+                msvcrt.locking(guard.fileno(), msvcrt.LK_UNLCK, 1)
+
+def create_lock(lock_path: Path, info):
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        json.dump(info, f)
+    return True
+
+def acquire_lock(lock_path: Path, **info):
+    # PID lock file. Returns False if the lock is held by a live process. A stale lock is replaced under the guard and
+    # checked again there, so that of two processes that both found it stale only one takes it over
+    lock_path = Path(lock_path)
+    lock_path.parent.mkdir(exist_ok=True, parents=True)
+    info = {"pid": os.getpid(), "host": socket.gethostname(), "time": time.time(), **info}
+    if create_lock(lock_path, info):
+        return True
+    if not is_lock_stale(lock_path):
+        return False
+    with lock_guard(lock_path):
+        if not lock_path.exists():
+            return create_lock(lock_path, info)  # released in the meantime
+        if not is_lock_stale(lock_path):
+            return False  # taken over by another process in the meantime
+        tmp_path = Path(str(lock_path) + ".%d.tmp" % os.getpid())
+        tmp_path.write_text(json.dumps(info))
+        tmp_path.replace(lock_path)
+        return read_lock(lock_path) == info
+
+def wait_for_lock(lock_path: Path, timeout, message=None, interval=1.0, **info):
+    # a lock of another host is never considered stale, so a crashed owner there would block forever
+    if acquire_lock(lock_path, **info):
+        return
+    if message is not None:
+        print(message)
+    start_time = time.time()
+    while not acquire_lock(lock_path, **info):
+        if time.time() - start_time > timeout:
+            owner = read_lock(lock_path) or {}
+            raise TimeoutError(f"Timed out after {format_time(timeout)} waiting for the lock {lock_path}, held by "
+                               f"process {owner.get('pid')} on {owner.get('host')}. If that process is no longer "
+                               f"running, delete the lock file")
+        time.sleep(interval)
+
+def release_lock(lock_path: Path):
+    info = read_lock(lock_path)
+    if info is not None and info.get("pid") == os.getpid():
+        Path(lock_path).unlink(missing_ok=True)
+
 def check_setup():
     status = True
     lyroi_dir = get_lyroi_dir()
@@ -168,7 +425,10 @@ def check_setup():
     status = status and Path(lyroi_dir) in Path(models_dir).parents
     return status
 
-def setup_lyroi():
+def setup_lyroi(device=None, cpus=None, numa_node=None):
+    from lyroi.placement import apply_placement, get_core_count
+    apply_placement(cpus, numa_node) # first, so that the thread counts below respect the placement
+
     lyroi_dir = get_lyroi_dir()
     if not Path(lyroi_dir).exists():
         print("Creating LyROI directory: " + lyroi_dir)
@@ -182,15 +442,17 @@ def setup_lyroi():
     os.environ['nnUNet_preprocessed'] = models_dir
     os.environ['nnUNet_results'] = models_dir # only this one matters
     # some performance tweeks:
+    profile = load_profile(device) if device is not None else {}
+    n_cores = get_core_count()
+    n_threads = min(profile.get("torch_threads", n_cores), n_cores)
     os.environ['nnUNet_def_n_proc'] =(
-        str(psutil.cpu_count(logical=False))) if 'nnUNet_def_n_proc' not in os.environ \
+        str(min(profile.get("n_proc", n_cores), n_cores))) if 'nnUNet_def_n_proc' not in os.environ \
         else str(os.environ['nnUNet_def_n_proc'])
-    os.environ['OMP_NUM_THREADS'] = str(psutil.cpu_count(logical=False))
-    os.environ['MKL_NUM_THREADS'] = str(psutil.cpu_count(logical=False))
+    os.environ['OMP_NUM_THREADS'] = str(n_threads)
+    os.environ['MKL_NUM_THREADS'] = str(n_threads)
     os.environ['OMP_PROC_BIND'] = "close"
     os.environ['OMP_PLACES'] = "cores"
     os.environ['OMP_SCHEDULE'] = "static"
-    os.environ['GOMP_CPU_AFFINITY '] = "N-M"
 
 
 if __name__ == "__main__":
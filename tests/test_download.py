@@ -0,0 +1,217 @@
+import functools
+import hashlib
+import http.server
+import io
+import json
+import os
+import re
+import socket
+import tempfile
+import threading
+import unittest
+import zipfile
+from pathlib import Path
+from unittest import mock
+
+from lyroi import download
+from lyroi.modes import get_archive_names, get_folds, mode_list
+from lyroi.utils import (check_model, read_manifest, get_model_root, get_models_dir, acquire_lock, release_lock,
+                         read_lock, wait_for_lock)
+
+MODE = "petct"
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    # stand-in for the model repository: SimpleHTTPRequestHandler with single "bytes=<start>-" ranges
+    requests = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        self.requests.append((self.command, self.path, self.headers.get("Range")))
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        path = Path(self.translate_path(self.path))
+        if match is None or not path.is_file():
+            return super().send_head()
+        size = path.stat().st_size
+        start = int(match.group(1))
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Range", "bytes %d-%d/%d" % (start, size - 1, size))
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        return f
+
+
+def make_archive(file, mode, plan):
+    # model archive with the layout of the repository: dataset folder, model folder, plans and one checkpoint per fold
+    folder = "Dataset001_Test/nnUNetTrainer__%s__%s" % (plan, mode_list[mode].model_config)
+    with zipfile.ZipFile(file, "w") as zip_file:
+        zip_file.writestr(folder + "/dataset.json", json.dumps({"plan": plan}))
+        zip_file.writestr(folder + "/plans.json", json.dumps({"plan": plan}))
+        for fold in get_folds(mode):
+            zip_file.writestr(folder + "/fold_%s/checkpoint_final.pth" % fold, os.urandom(64 * 1024))
+
+def md5(file):
+    return "md5:" + hashlib.md5(Path(file).read_bytes()).hexdigest()
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        self.served = Path(self.root, "served")
+        self.served.mkdir()
+        for name, plan in zip(get_archive_names(MODE), mode_list[MODE].model_plans):
+            make_archive(Path(self.served, name), MODE, plan)
+        Path(self.served, "VERSION").write_text(json.dumps({MODE: "1.0"}))
+        Path(self.served, download.CHECKSUM_FILE).write_text(
+            json.dumps({name: md5(Path(self.served, name)) for name in get_archive_names(MODE)}))
+
+        RangeRequestHandler.requests = []
+        handler = functools.partial(RangeRequestHandler, directory=str(self.served))
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%d" % self.server.server_port
+
+        self.environment = mock.patch.dict(os.environ, {"LYROI_DIR": str(Path(self.root, "lyroi"))})
+        self.environment.start()
+        os.environ.pop("LYROI_SYSTEM_DIR", None)
+        self.session = download.get_session()
+        self.progress = download.DownloadProgress(disable=True)
+
+    def tearDown(self):
+        self.progress.close()
+        self.environment.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def write_partial(self, name, target, size):
+        Path(str(target) + ".part").write_bytes(Path(self.served, name).read_bytes()[:size])
+
+    def test_resume(self):
+        name = get_archive_names(MODE)[0]
+        expected = Path(self.served, name).read_bytes()
+        for checksum in (md5(Path(self.served, name)), None):
+            target = Path(self.root, "downloads", name)
+            target.parent.mkdir(exist_ok=True)
+            target.unlink(missing_ok=True)
+            self.write_partial(name, target, 1000)
+            RangeRequestHandler.requests = []
+            download.download_file(self.url + "/" + name, target, self.session, self.progress, checksum)
+            self.assertEqual(target.read_bytes(), expected)
+            self.assertFalse(Path(str(target) + ".part").exists())
+            self.assertEqual(RangeRequestHandler.requests, [("GET", "/" + name, "bytes=1000-")])
+
+    def test_complete_partial(self):
+        # a partial download that already is complete is answered with 416
+        name = get_archive_names(MODE)[0]
+        target = Path(self.root, name)
+        self.write_partial(name, target, Path(self.served, name).stat().st_size)
+        download.download_file(self.url + "/" + name, target, self.session, self.progress)
+        self.assertEqual(target.read_bytes(), Path(self.served, name).read_bytes())
+
+    def test_larger_partial(self):
+        # leftover of another version that is larger than the file: the download restarts
+        name = get_archive_names(MODE)[0]
+        target = Path(self.root, name)
+        Path(str(target) + ".part").write_bytes(os.urandom(Path(self.served, name).stat().st_size + 10))
+        download.download_file(self.url + "/" + name, target, self.session, self.progress)
+        self.assertEqual(target.read_bytes(), Path(self.served, name).read_bytes())
+
+    def test_checksum_mismatch(self):
+        name = get_archive_names(MODE)[0]
+        target = Path(self.root, name)
+        with self.assertRaisesRegex(Exception, "Checksum mismatch"):
+            download.download_file(self.url + "/" + name, target, self.session, self.progress, "md5:" + "0" * 32)
+        self.assertFalse(target.exists())
+        self.assertFalse(Path(str(target) + ".part").exists())
+
+    def test_source_size(self):
+        size = sum(Path(self.served, name).stat().st_size for name in get_archive_names(MODE))
+        self.assertEqual(download.get_source_size(MODE, mirror=self.url), size)
+        self.assertEqual(download.get_source_size(MODE, from_dir=str(self.served)), size)
+
+    def check_installation(self):
+        root = get_model_root(MODE)
+        self.assertTrue(check_model(MODE, root))
+        self.assertEqual(read_manifest(MODE, root)["version"], "1.0")
+
+    def test_install_from_mirror(self):
+        with mock.patch("sys.stdout", io.StringIO()):
+            download.install_models(MODE, mirror=self.url, progress_bar=False)
+        self.check_installation()
+        self.assertEqual(list(Path(download.get_download_dir()).iterdir()), [])
+
+    def test_install_from_dir(self):
+        with mock.patch("sys.stdout", io.StringIO()):
+            download.install_models(MODE, from_dir=str(self.served), progress_bar=False)
+        self.check_installation()
+        self.assertEqual(RangeRequestHandler.requests, [])
+
+    def test_install_corrupted_mirror(self):
+        name = get_archive_names(MODE)[1]
+        Path(self.served, name).write_bytes(Path(self.served, name).read_bytes()[:-1] + b"x")
+        with mock.patch("sys.stdout", io.StringIO()):
+            with self.assertRaisesRegex(Exception, "Checksum mismatch"):
+                download.install_models(MODE, mirror=self.url, progress_bar=False)
+            with self.assertRaisesRegex(AssertionError, "Checksum mismatch"):
+                download.install_models(MODE, from_dir=str(self.served), progress_bar=False)
+        self.assertFalse(check_model(MODE, get_model_root(MODE)))
+
+    def test_download_to(self):
+        # a folder populated with --download-to can be served as a mirror
+        target = Path(self.root, "store")
+        with mock.patch("sys.stdout", io.StringIO()):
+            download.download_models(MODE, target, mirror=self.url, progress_bar=False)
+        for name in get_archive_names(MODE):
+            self.assertEqual(Path(target, name).read_bytes(), Path(self.served, name).read_bytes())
+        self.assertEqual(json.loads(Path(target, download.CHECKSUM_FILE).read_text()),
+                         json.loads(Path(self.served, download.CHECKSUM_FILE).read_text()))
+
+    def test_stale_lock(self):
+        lock_path = Path(self.root, "locks", "test.lock")
+        lock_path.parent.mkdir()
+        # owner on this host that is no longer running: taken over
+        lock_path.write_text(json.dumps({"pid": 2 ** 22 + 1, "host": socket.gethostname()}))
+        self.assertTrue(acquire_lock(lock_path))
+        self.assertEqual(read_lock(lock_path)["pid"], os.getpid())
+        release_lock(lock_path)
+        self.assertFalse(lock_path.exists())
+
+    def test_lock_timeout(self):
+        # owner on another host cannot be checked
+        lock_path = Path(self.root, "locks", "test.lock")
+        lock_path.parent.mkdir()
+        lock_path.write_text(json.dumps({"pid": 1234, "host": "other-host"}))
+        self.assertFalse(acquire_lock(lock_path))
+        with self.assertRaisesRegex(TimeoutError, re.escape(str(lock_path)) + ".*1234 on other-host"):
+            wait_for_lock(lock_path, timeout=0.2, interval=0.05)
+
+    def test_remove_legacy_installation(self):
+        # models extracted directly into the store by older versions, next to the models of another mode
+        store = Path(get_models_dir())
+        legacy = Path(store, "Dataset001_Test")
+        for plan in mode_list[MODE].model_plans + ["OtherPlans"]:
+            Path(legacy, "nnUNetTrainer__%s__%s" % (plan, mode_list[MODE].model_config)).mkdir(parents=True)
+        with mock.patch("sys.stdout", io.StringIO()):
+            download.install_models(MODE, from_dir=str(self.served), progress_bar=False)
+            # still the previous installation
+            self.assertEqual(len(list(legacy.iterdir())), len(mode_list[MODE].model_plans) + 1)
+            download.install_models(MODE, from_dir=str(self.served), progress_bar=False)
+        self.assertEqual([path.name for path in legacy.iterdir()],
+                         ["nnUNetTrainer__OtherPlans__%s" % mode_list[MODE].model_config])
+        self.check_installation()
+
+
+if __name__ == "__main__":
+    unittest.main()
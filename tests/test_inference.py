@@ -0,0 +1,84 @@
+import json
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from lyroi.inference import (get_plan_order, get_timing_key, get_shared_fingerprints, get_preprocessing_caches,
+                             is_on_scratch)
+
+PLANS = {
+    "transpose_forward": [0, 1, 2],
+    "image_reader_writer": "NibabelIOWithReorient",
+    "foreground_intensity_properties_per_channel": {"0": {"mean": 1.0, "std": 2.0}},
+    "configurations": {"3d_fullres": {"preprocessor_name": "DefaultPreprocessor", "spacing": [2.0, 2.0, 3.0],
+                                      "normalization_schemes": ["CTNormalization"], "use_mask_for_norm": [False],
+                                      "resampling_fn_data": "resample_data_or_seg_to_shape",
+                                      "resampling_fn_data_kwargs": {"is_seg": False, "order": 3},
+                                      "patch_size": [64, 64, 64]}},
+}
+
+
+def create_model_folder(parent, name, spacing=(2.0, 2.0, 3.0), patch_size=(64, 64, 64), checkpoint_size=100):
+    folder = Path(parent, name)
+    plans = json.loads(json.dumps(PLANS))
+    plans["configurations"]["3d_fullres"].update({"spacing": list(spacing), "patch_size": list(patch_size)})
+    folder.mkdir(parents=True)
+    Path(folder, "plans.json").write_text(json.dumps(plans))
+    Path(folder, "dataset.json").write_text(json.dumps({"channel_names": {"0": "CT"}, "labels": {"background": 0}}))
+    for fold in range(2):
+        Path(folder, f"fold_{fold}").mkdir()
+        Path(folder, f"fold_{fold}", "checkpoint_final.pth").write_bytes(b"\0" * checkpoint_size)
+    return str(folder)
+
+
+class InferenceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        # plan_a and plan_b only differ in the patch size, which preprocessing does not depend on
+        self.plan_a = create_model_folder(self.tmp_dir.name, "plan_a", checkpoint_size=300)
+        self.plan_b = create_model_folder(self.tmp_dir.name, "plan_b", patch_size=(96, 96, 96), checkpoint_size=100)
+        self.plan_c = create_model_folder(self.tmp_dir.name, "plan_c", spacing=(1.0, 1.0, 1.5), checkpoint_size=200)
+        self.model_folders = [self.plan_a, self.plan_b, self.plan_c]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_plan_order(self):
+        # without timings of every plan, the smallest checkpoints go first
+        self.assertEqual(get_plan_order(self.model_folders, [0, 1]), [self.plan_b, self.plan_c, self.plan_a])
+        self.assertEqual(get_plan_order(self.model_folders, [0, 1], {"plan_a": 1.0, "plan_b": 3.0}),
+                         [self.plan_b, self.plan_c, self.plan_a])
+        plan_seconds = {"plan_a": 1.0, "plan_b": 3.0, "plan_c": 2.0}
+        self.assertEqual(get_plan_order(self.model_folders, [0, 1], plan_seconds),
+                         [self.plan_a, self.plan_c, self.plan_b])
+
+    def test_timing_key(self):
+        self.assertNotEqual(get_timing_key("full", False, None), get_timing_key("adaptive", False, None))
+        self.assertNotEqual(get_timing_key("full", False, None), get_timing_key("full", False, 0.5))
+
+    def test_shared_fingerprints(self):
+        fingerprints = get_shared_fingerprints(self.model_folders)
+        self.assertIsNotNone(fingerprints[self.plan_a])
+        self.assertEqual(fingerprints[self.plan_a], fingerprints[self.plan_b])
+        self.assertIsNone(fingerprints[self.plan_c])
+
+        # the preview shares the preprocessing of plan_c
+        preview = create_model_folder(self.tmp_dir.name, "preview", spacing=(1.0, 1.0, 1.5))
+        caches = get_preprocessing_caches(self.model_folders, Path(self.tmp_dir.name, "run"), preview)
+        self.assertEqual(caches[self.plan_a], caches[self.plan_b])
+        self.assertEqual(caches[self.plan_c], caches[preview])
+        self.assertNotEqual(caches[self.plan_a], caches[self.plan_c])
+        self.assertEqual(caches[self.plan_a].parent, Path(self.tmp_dir.name, "run", "preprocessed"))
+
+    def test_is_on_scratch(self):
+        with mock.patch.dict("os.environ"):
+            os.environ.pop("LYROI_SCRATCH", None)
+            self.assertFalse(is_on_scratch(Path(self.tmp_dir.name, "run")))
+        self.assertTrue(is_on_scratch(Path(self.tmp_dir.name, "run"), self.tmp_dir.name))
+        self.assertFalse(is_on_scratch(Path(self.tmp_dir.name, "output", "run"), self.tmp_dir.name))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from lyroi.memory import (load_plan_info, get_configuration, schedule_cases, estimate_peak, WEIGHTS_PER_CHECKPOINT,
+                          PROCESS_OVERHEAD)
+
+PLANS = {
+    "transpose_forward": [0, 1, 2],
+    "image_reader_writer": "NibabelIOWithReorient",
+    "configurations": {
+        "3d_fullres": {"spacing": [2.0, 2.0, 3.0], "patch_size": [64, 64, 64]},
+        "3d_fullres_large": {"inherits_from": "3d_fullres", "patch_size": [128, 128, 128]},
+        "3d_fullres_large_fine": {"inherits_from": "3d_fullres_large", "spacing": [1.0, 1.0, 1.5]},
+    },
+}
+
+
+class LoadPlanInfoTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.model_folder = Path(self.tmp_dir.name)
+        Path(self.model_folder, "plans.json").write_text(json.dumps(PLANS))
+        Path(self.model_folder, "dataset.json").write_text(json.dumps({"labels": {"background": 0, "lesion": 1}}))
+        for fold in range(2):
+            Path(self.model_folder, "fold_%d" % fold).mkdir()
+            Path(self.model_folder, "fold_%d" % fold, "checkpoint_final.pth").write_bytes(b"\0" * 1000)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_inherits_from(self):
+        plan_info = load_plan_info(self.model_folder, "3d_fullres_large_fine")
+        self.assertEqual(plan_info["spacing"], [1.0, 1.0, 1.5])
+        self.assertEqual(plan_info["patch_size"], [128, 128, 128])
+        self.assertEqual(load_plan_info(self.model_folder)["patch_size"], [64, 64, 64])
+        self.assertEqual(plan_info["n_folds"], 2)
+        self.assertEqual(plan_info["checkpoint_size"], 1000)
+
+    def test_circular_inheritance(self):
+        plans = {"configurations": {"a": {"inherits_from": "b"}, "b": {"inherits_from": "a"}}}
+        with self.assertRaises(AssertionError):
+            get_configuration(plans, "a")
+
+    def test_weights_per_checkpoint(self):
+        try:
+            import torch
+        except ImportError:
+            self.skipTest("torch is not installed")
+        # a checkpoint as written by nnUNetTrainer.save_checkpoint after a step of its SGD optimizer
+        network = torch.nn.Sequential(torch.nn.Conv3d(2, 32, 3), torch.nn.InstanceNorm3d(32, affine=True),
+                                      torch.nn.Conv3d(32, 64, 3), torch.nn.Conv3d(64, 2, 1))
+        optimizer = torch.optim.SGD(network.parameters(), 0.01, weight_decay=3e-5, momentum=0.99, nesterov=True)
+        network(torch.rand(1, 2, 8, 8, 8)).sum().backward()
+        optimizer.step()
+        checkpoint_file = Path(self.model_folder, "checkpoint.pth")
+        torch.save({"network_weights": network.state_dict(), "optimizer_state": optimizer.state_dict(),
+                    "grad_scaler_state": None, "init_args": {}, "trainer_name": "nnUNetTrainer"}, checkpoint_file)
+        weights = sum(w.numel() * w.element_size() for w in network.state_dict().values())
+        self.assertAlmostEqual(weights / checkpoint_file.stat().st_size, WEIGHTS_PER_CHECKPOINT, delta=0.05)
+
+
+def get_estimate(size):
+    # case estimate with every term of estimate_case_memory set to size
+    return {key: size for key in ("preprocessing", "prediction", "export", "queued_data", "queued_logits", "model",
+                                  "merge")}
+
+
+class ScheduleCasesTest(unittest.TestCase):
+    def test_single_batch(self):
+        estimates = {"small": get_estimate(10 ** 6), "large": get_estimate(10 ** 7)}
+        batches = schedule_cases(estimates, 100 * 1024 ** 3, 3, 3)
+        self.assertEqual(batches, [{"cases": ["large", "small"], "pools": (3, 3)}])
+
+    def test_smaller_pools_for_large_cases(self):
+        small, large = get_estimate(10 ** 6), get_estimate(2 * 1024 ** 3)
+        estimates = {"small_0": small, "large": large, "small_1": small}
+        # enough for the small cases with full pools, but not for the large case
+        budget = estimate_peak(large, 2, 1)
+        self.assertLess(budget, estimate_peak(large, 3, 3))
+        self.assertGreaterEqual(budget, estimate_peak(small, 3, 3))
+        batches = schedule_cases(estimates, budget, 3, 3)
+        self.assertEqual(batches, [{"cases": ["large"], "pools": (2, 1)},
+                                   {"cases": ["small_0", "small_1"], "pools": (3, 3)}])
+
+    def test_case_over_budget(self):
+        estimates = {"small": get_estimate(10 ** 6), "huge": get_estimate(100 * 1024 ** 3)}
+        batches = schedule_cases(estimates, 8 * PROCESS_OVERHEAD + 10 ** 8, 3, 3)
+        # the case that does not fit is predicted alone with the smallest pools
+        self.assertEqual(batches, [{"cases": ["huge"], "pools": (1, 1)}, {"cases": ["small"], "pools": (3, 3)}])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import re
+import tempfile
+import unittest
+from pathlib import Path
+
+from lyroi.metrics import MetricsWriter
+
+try:
+    from prometheus_client.parser import text_string_to_metric_families
+except ImportError:
+    text_string_to_metric_families = None
+
+HISTOGRAM_SUFFIXES = ("_bucket", "_sum", "_count")
+
+
+class MetricsWriterTest(unittest.TestCase):
+    def test_prometheus_text_format(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            writer = MetricsWriter(Path(tmp_dir, "lyroi.prom"), "petct", "cpu")
+            writer({"event": "run_start", "cases": 3, "time": 0.0})
+            writer({"event": "stage", "stage": "model_load", "plan": "plan_a", "seconds": 2.5, "time": 0.0})
+            writer({"event": "case_start", "case": "case_0", "time": 10.0})
+            writer({"event": "case_complete", "case": "case_0", "time": 55.0})
+            writer({"event": "run_end", "status": "failed", "time": 60.0})
+            text = Path(tmp_dir, "lyroi.prom").read_text()
+
+        self.assertNotIn("# EOF", text)
+        # every sample belongs to the family of the TYPE line before it
+        types = {}
+        family = None
+        for line in text.splitlines():
+            match = re.fullmatch(r"# TYPE (\w+) (counter|gauge|histogram)", line)
+            if match:
+                family = match.group(1)
+                types[family] = match.group(2)
+                continue
+            if line.startswith("#"):
+                self.assertRegex(line, r"^# HELP \w+ .+$")
+                continue
+            name = re.fullmatch(r'(\w+)\{(\w+="[^"]*",?)*\} [0-9.e+-]+', line).group(1)
+            if types[family] == "histogram":
+                self.assertIn(name, [family + suffix for suffix in HISTOGRAM_SUFFIXES])
+            else:
+                self.assertEqual(name, family)
+        self.assertEqual(types["lyroi_cases_completed_total"], "counter")
+        self.assertEqual(types["lyroi_cases_failed_total"], "counter")
+
+        if text_string_to_metric_families is not None:
+            samples = {(sample.name, sample.labels.get("le")): sample.value
+                       for metric in text_string_to_metric_families(text) for sample in metric.samples}
+            self.assertEqual(samples[("lyroi_cases_completed_total", None)], 1)
+            self.assertEqual(samples[("lyroi_cases_failed_total", None)], 2)
+            self.assertEqual(samples[("lyroi_queue_depth", None)], 0)
+            self.assertEqual(samples[("lyroi_case_latency_seconds_bucket", "30")], 0)
+            self.assertEqual(samples[("lyroi_case_latency_seconds_bucket", "60")], 1)
+            self.assertEqual(samples[("lyroi_case_latency_seconds_bucket", "+Inf")], 1)
+            self.assertEqual(samples[("lyroi_model_load_seconds", None)], 2.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
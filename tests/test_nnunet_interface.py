@@ -0,0 +1,216 @@
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+import torch
+from nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape
+from nnunetv2.utilities.label_handling.label_handling import LabelManager
+from nnunetv2.utilities.plans_handling.plans_handler import ConfigurationManager, PlansManager
+
+from lyroi import nnunet_interface
+from lyroi.nnunet_interface import (LyroiPredictor, convert_logits_file_to_segmentation, store_cached_case,
+                                    load_cached_case, remove_cached_case, get_cache_files)
+
+PATCH_SIZE = [16, 16, 16]
+
+CONFIGURATION = {
+    "data_identifier": "synthetic", "preprocessor_name": "DefaultPreprocessor", "batch_size": 2,
+    "patch_size": PATCH_SIZE, "median_image_size_in_voxels": [32, 32, 32], "spacing": [3.0, 2.0, 2.0],
+    "normalization_schemes": ["ZScoreNormalization"], "use_mask_for_norm": [False],
+    "resampling_fn_data": "resample_data_or_seg_to_shape", "resampling_fn_seg": "resample_data_or_seg_to_shape",
+    "resampling_fn_data_kwargs": {"is_seg": False, "order": 3, "order_z": 0, "force_separate_z": None},
+    "resampling_fn_seg_kwargs": {"is_seg": True, "order": 1, "order_z": 0, "force_separate_z": None},
+    "resampling_fn_probabilities": "resample_data_or_seg_to_shape",
+    "resampling_fn_probabilities_kwargs": {"is_seg": False, "order": 1, "order_z": 0, "force_separate_z": None},
+    "architecture": {}, "batch_dice": False,
+}
+
+# the fp16 logits of nnU-Net underflow where the gaussian weights are tiny, in the corners of the outer tiles. The
+# prediction paths are compared without the border of the volume
+INTERIOR = (slice(None), slice(2, -2), slice(2, -2), slice(2, -2))
+
+PLANS = {
+    "dataset_name": "Dataset001_Synthetic", "plans_name": "nnUNetPlans",
+    "original_median_spacing_after_transp": [3.0, 2.0, 2.0], "original_median_shape_after_transp": [32, 32, 32],
+    "image_reader_writer": "SimpleITKIO", "transpose_forward": [0, 2, 1], "transpose_backward": [0, 2, 1],
+    "configurations": {"3d_fullres": CONFIGURATION}, "experiment_planner_used": "ExperimentPlanner",
+    "label_manager": "LabelManager", "foreground_intensity_properties_per_channel": {},
+}
+
+
+def get_network(n_channels=1, n_heads=2):
+    return torch.nn.Sequential(torch.nn.Conv3d(n_channels, 4, 3, padding=1), torch.nn.ReLU(),
+                               torch.nn.Conv3d(4, n_heads, 3, padding=1))
+
+def get_predictor(n_folds=2, scratch_dir=None, out_of_core="off"):
+    # predictor with a small network and random weights for every fold, on a synthetic configuration
+    predictor = LyroiPredictor(tile_step_size=0.5, use_gaussian=True, use_mirroring=True,
+                               perform_everything_on_device=False, device=torch.device("cpu"), verbose=False,
+                               allow_tqdm=False, out_of_core=out_of_core, scratch_dir=scratch_dir)
+    torch.manual_seed(0)
+    network = get_network()
+    parameters = []
+    for _ in range(n_folds):
+        for module in network.modules():
+            if isinstance(module, torch.nn.Conv3d):
+                module.reset_parameters()
+        parameters.append({k: v.clone() for k, v in network.state_dict().items()})
+    predictor.network = network
+    predictor.list_of_parameters = parameters
+    predictor.configuration_manager = ConfigurationManager(CONFIGURATION)
+    predictor.label_manager = LabelManager({"background": 0, "lesion": 1}, None)
+    predictor.allowed_mirroring_axes = (0, 1, 2)
+    return predictor
+
+def assert_logits_close(logits, reference):
+    torch.testing.assert_close(logits[INTERIOR].float(), reference[INTERIOR].float(), atol=5e-3, rtol=0)
+
+def get_data(shape=(40, 36, 30)):
+    generator = torch.Generator().manual_seed(1)
+    data = torch.randn((1, *shape), generator=generator)
+    data[:, 10:20, 12:22, 8:18] += 3  # a "lesion"
+    return data
+
+
+class SelectAccumulationTest(unittest.TestCase):
+    def test_out_of_core_setting(self):
+        predictor = get_predictor(out_of_core="on")
+        self.assertEqual(predictor.select_accumulation((1, 32, 32, 32)), "disk")
+        predictor.out_of_core = "off"
+        self.assertEqual(predictor.select_accumulation((1, 32, 32, 32)), "cpu")
+        predictor.on_device = True
+        self.assertEqual(predictor.select_accumulation((1, 32, 32, 32)), "device")
+
+    def test_device_without_memory_query(self):
+        # the free memory of accelerators other than CUDA cannot be queried, their default is kept
+        predictor = get_predictor(out_of_core="auto")
+        predictor.on_device = True
+        with mock.patch.object(nnunet_interface.psutil, "virtual_memory", return_value=SimpleNamespace(available=1)):
+            self.assertEqual(predictor.select_accumulation((1, 32, 32, 32)), "device")
+
+    def test_free_memory(self):
+        predictor = get_predictor(out_of_core="auto")
+        self.assertEqual(predictor.select_accumulation((1, 32, 32, 32)), "cpu")
+        with mock.patch.object(nnunet_interface.psutil, "virtual_memory", return_value=SimpleNamespace(available=1)):
+            self.assertEqual(predictor.select_accumulation((1, 32, 32, 32)), "disk")
+
+
+class PredictLogitsTest(unittest.TestCase):
+    def setUp(self):
+        self.data = get_data()
+        self.full = get_predictor().predict_logits_from_preprocessed_data(self.data).float()
+
+    def test_adaptive_tta_with_all_tiles_equals_full_mirroring(self):
+        predictor = get_predictor()
+        predictor.tta = "adaptive"
+        events = []
+        with mock.patch.object(nnunet_interface, "TTA_CONFIDENCE", 1.01), \
+                mock.patch.object(nnunet_interface, "emit", lambda event, **data: events.append((event, data))):
+            adaptive = predictor.predict_logits_from_preprocessed_data(self.data)
+        tta = [data for event, data in events if event == "tta"][0]
+        self.assertEqual(tta["tiles"], tta["n_tiles"])
+        self.assertEqual(adaptive.shape, self.full.shape)
+        assert_logits_close(adaptive, self.full)
+
+    def test_adaptive_tta_without_uncertain_tiles(self):
+        # a single fold cannot disagree, so no tile is mirrored
+        predictor = get_predictor(n_folds=1)
+        predictor.tta = "adaptive"
+        with mock.patch.object(nnunet_interface, "TTA_CONFIDENCE", 0.0):
+            adaptive = predictor.predict_logits_from_preprocessed_data(self.data)
+        no_mirroring = get_predictor(n_folds=1)
+        no_mirroring.use_mirroring = False
+        assert_logits_close(adaptive, no_mirroring.predict_logits_from_preprocessed_data(self.data))
+
+    def test_disk_equals_cpu_accumulation(self):
+        with tempfile.TemporaryDirectory() as scratch_dir:
+            predictor = get_predictor(scratch_dir=scratch_dir, out_of_core="on")
+            disk = predictor.predict_logits_from_preprocessed_data(self.data).float()
+            # the logits file is kept for the export worker
+            self.assertTrue(Path(predictor.logits_file["file"]).is_file())
+        self.assertEqual(disk.shape, self.full.shape)
+        assert_logits_close(disk, self.full)
+
+    def test_cascade_with_all_candidates_equals_full_ensemble(self):
+        predictor = get_predictor()
+        predictor.cascade = 0.0
+        assert_logits_close(predictor.predict_logits_from_preprocessed_data(self.data), self.full)
+
+    def test_cascade_without_candidates_keeps_coarse_pass(self):
+        predictor = get_predictor()
+        predictor.cascade = 1.01
+        cascade = predictor.predict_logits_from_preprocessed_data(self.data)
+        coarse = get_predictor()
+        coarse.list_of_parameters = coarse.list_of_parameters[:1]
+        coarse.use_mirroring = False
+        coarse.tile_step_size = 1.0
+        torch.testing.assert_close(cascade, coarse.predict_logits_from_preprocessed_data(self.data).float())
+
+    def test_cascade_tiles(self):
+        # only tiles within the margin of a candidate voxel are predicted with the full ensemble
+        predictor = get_predictor()
+        candidates = torch.zeros((1, *self.data.shape[1:]))
+        candidates[0, 0, 0, 0] = 1
+        coarse = torch.zeros((2, *self.data.shape[1:]), dtype=torch.half)
+        events = []
+        with mock.patch.object(nnunet_interface, "emit", lambda event, **data: events.append((event, data))):
+            prediction = predictor._predict_tiles(self.data, False, candidates, coarse)
+        cascade = [data for event, data in events if event == "cascade"][0]
+        self.assertEqual(cascade["tiles"], 1)
+        self.assertEqual(cascade["n_tiles"], len(predictor._internal_get_sliding_window_slicers(self.data.shape[1:])))
+        # the voxels that no other tile covers equal the full ensemble, all voxels outside the tile the coarse logits
+        torch.testing.assert_close(prediction[:, 2:8, 2:8, 2:8], self.full[:, 2:8, 2:8, 2:8], atol=5e-3, rtol=0)
+        self.assertTrue((prediction[:, 16:] == 0).all())
+        self.assertTrue((prediction[:, :, 16:] == 0).all())
+
+
+class PreprocessingCacheTest(unittest.TestCase):
+    def test_store_load_remove(self):
+        data = np.random.default_rng(0).normal(size=(1, 8, 9, 10)).astype(np.float32)
+        properties = {"spacing": [1.0, 1.0, 1.0]}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_dir = Path(tmp_dir, "preprocessed", "fingerprint")
+            ofile = str(Path(tmp_dir, "output", "case_001"))
+            store_cached_case(cache_dir, ofile, data, properties, {"preprocessing": 2.0})
+            cached = load_cached_case(cache_dir, ofile)
+            np.testing.assert_array_equal(cached["data"].numpy(), data)
+            self.assertEqual(cached["data_properties"], properties)
+            self.assertEqual(cached["ofile"], ofile)
+            self.assertEqual(cached["saved"], 2.0)
+            del cached
+            remove_cached_case(cache_dir, ofile)
+            self.assertFalse(any(file.exists() for file in get_cache_files(cache_dir, ofile)))
+
+
+class LogitsFileTest(unittest.TestCase):
+    def test_equals_nnunet_export(self):
+        plans_manager = PlansManager(PLANS)
+        configuration_manager = plans_manager.get_configuration("3d_fullres")
+        properties = {"spacing": [2.5, 1.5, 1.2], "shape_after_cropping_and_before_resampling": (24, 30, 33),
+                      "shape_before_cropping": (30, 36, 40), "bbox_used_for_cropping": [[2, 26], [3, 33], [4, 37]]}
+        rng = np.random.default_rng(0)
+        for labels, regions in [({"background": 0, "a": 1, "b": 2}, None),
+                                ({"background": 0, "a": [1, 2], "b": 2}, [1, 2])]:
+            label_manager = LabelManager(labels, regions)
+            logits = rng.normal(size=(label_manager.num_segmentation_heads, 20, 22, 25)).astype(np.float16) * 3
+            reference = convert_predicted_logits_to_segmentation_with_correct_shape(
+                torch.from_numpy(logits), plans_manager, configuration_manager, label_manager, properties)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                # padded logits file of an out-of-core prediction
+                logits_file = str(Path(tmp_dir, "logits.dat"))
+                padded = np.memmap(logits_file, dtype=np.float16, mode="w+", shape=(logits.shape[0], 22, 24, 25))
+                padded[:, 1:21, 2:24] = logits
+                padded.flush()
+                del padded
+                segmentation = convert_logits_file_to_segmentation(
+                    {"file": logits_file, "dtype": "float16", "shape": (logits.shape[0], 22, 24, 25),
+                     "slicer": (slice(None), slice(1, 21), slice(2, 24), slice(0, 25))},
+                    plans_manager, configuration_manager, label_manager, properties)
+            np.testing.assert_array_equal(segmentation, reference)
+
+
+if __name__ == "__main__":
+    unittest.main()